@@ -0,0 +1,13 @@
+'''
+nexradpy: search, download, grid and flatten NEXRAD radar data
+
+Importing the package only loads the station tables. Submodules are imported on their
+own (from nexradpy import clean, nexrad) and load pyart, boto, pandas and the like when
+they are first used, so station lookups and short lived workers start quickly.
+
+    import nexradpy
+    nexradpy.getStationsFromDomain(40.901954, -73.632802, 40.460969, -74.363177, 20000)
+'''
+
+from .stations import STATION_IDS, STATION_LATLONS, stationsInDomain
+from .s3_nexrad_search import S3NEXRADHelper, getStationsFromDomain
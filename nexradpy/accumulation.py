@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+
+import numpy as np
+
+
+HOUR = 3600
+# longest time between scans that is still integrated (seconds), longer gaps count as missing
+MAX_GAP = 15 * 60
+
+
+class HourlyAccumulator:
+    '''
+    Streaming hourly rain totals from rain rate scans at irregular times. Scans come in
+    time order, the rate is taken to change linearly between consecutive scans and each
+    interval is integrated into the hours it overlaps. An hour is emitted as soon as a
+    scan at or after its end arrives, so only the hours the current interval overlaps are
+    held in memory, each as one total and one coverage array. Hours inside a gap that is
+    too long to integrate are still emitted, as NaN with no coverage, so missing data never
+    reads as 0 mm.
+    '''
+
+    def __init__(self, shape, max_gap=MAX_GAP, hour_offset=0):
+        '''
+        args: shape of the rate arrays (grid cells or gauge points), longest integrated gap
+              in seconds, seconds after the top of the hour that hours start (ex. 51 * 60
+              for ASOS hours ending at :51)
+        '''
+        self.shape = tuple(shape)
+        self.max_gap = max_gap
+        self.hour_offset = hour_offset
+        self.last_time = None
+        self.last_rates = None
+        # hour start (epoch seconds) to [total mm, covered seconds] arrays
+        self.hours = {}
+
+    def add(self, scan_time, rates):
+        '''
+        args: scan time (numpy datetime64 or datetime), rain rate array in mm/h, NaN or
+              masked where there is no estimate
+        returns: list of (hour start as numpy datetime64, total mm, covered fraction) for the
+                 hours this scan closes, totals are NaN where nothing was covered
+        '''
+        time = int(np.datetime64(scan_time, 's').astype(np.int64))
+        rates = np.ma.filled(np.ma.asarray(rates, dtype=np.float64), np.nan)
+        if rates.shape != self.shape:
+            raise ValueError('rates are %s, accumulator is %s' % (rates.shape, self.shape))
+        if self.last_time is not None and time < self.last_time:
+            raise ValueError('scans must be added in time order')
+
+        if self.last_time is not None and 0 < time - self.last_time <= self.max_gap:
+            self._integrate(self.last_time, self.last_rates, time, rates)
+        elif self.last_time is not None:
+            self._hours_between(self.last_time, time)
+
+        self.last_time = time
+        self.last_rates = rates
+        return self._emit(lambda hour_end: hour_end <= time)
+
+    def flush(self):
+        '''
+        returns: the hours still open, as add does, for the end of a run
+        '''
+        return self._emit(lambda hour_end: True)
+
+    def _integrate(self, start, start_rates, end, end_rates):
+        '''
+        adds the trapezoid integral of the rates over [start, end] to every hour it overlaps
+        '''
+        valid = ~(np.isnan(start_rates) | np.isnan(end_rates))
+        slope = np.where(valid, (end_rates - start_rates) / float(end - start), 0.0)
+        start_rates = np.where(valid, start_rates, 0.0)
+
+        for hour, (total, covered) in self._hours_between(start, end):
+            a = max(start, hour)
+            b = min(end, hour + HOUR)
+            # mean rate over [a, b] is the rate at its midpoint
+            mid_rates = start_rates + slope * ((a + b) / 2.0 - start)
+            total += mid_rates * (b - a) / HOUR
+            covered += valid * (b - a)
+
+    def _hours_between(self, start, end):
+        '''
+        returns: list of (hour start, [total, covered]) for every hour overlapping [start, end),
+                 opening the ones not held yet
+        '''
+        hours = []
+        hour = self._hour_start(start)
+        while hour < end:
+            hours.append((hour, self.hours.setdefault(hour, [np.zeros(self.shape), np.zeros(self.shape)])))
+            hour += HOUR
+        return hours
+
+    def _emit(self, closed):
+        '''
+        args: function of hour end (epoch seconds) returning if the hour is complete
+        returns: list of (hour start, total mm, covered fraction) for the closed hours
+        '''
+        emitted = []
+        for hour in sorted(self.hours):
+            if not closed(hour + HOUR):
+                break
+            total, covered = self.hours.pop(hour)
+            total[covered == 0] = np.nan
+            emitted.append((np.datetime64(hour, 's'), total, covered / HOUR))
+        return emitted
+
+    def _hour_start(self, time):
+        return (time - self.hour_offset) // HOUR * HOUR + self.hour_offset
+
+
+def hourly_totals(scans, shape, **accumulator_args):
+    '''
+    args: iterable of (scan time, rain rate array) in time order, shape of the arrays,
+          HourlyAccumulator args
+    returns: generator of (hour start, total mm, covered fraction) as each hour closes, the
+             scans are consumed one at a time so a long run never holds them all
+    '''
+    accumulator = HourlyAccumulator(shape, **accumulator_args)
+    for scan_time, rates in scans:
+        for hour in accumulator.add(scan_time, rates):
+            yield hour
+    for hour in accumulator.flush():
+        yield hour
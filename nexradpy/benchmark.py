@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+
+import argparse
+import bisect
+import datetime
+import hashlib
+import json
+import os
+import platform
+import shutil
+import tempfile
+import time
+import numpy as np
+import pyart
+
+from . import clean, gridding, nexrad
+from .metadata import STATION_INDEX
+from .s3_nexrad_search import NEXRAD_BUCKET, S3NEXRADHelper
+
+
+RESULTS_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'data', 'cache', 'benchmark.json'))
+REPEATS = 5
+STATION = 'KOKX'
+SEARCH_DAY = datetime.datetime(2015, 5, 5)
+
+# volume and bucket sizes, small keeps a run to a few seconds for tests
+SIZES = {
+    'full': {'sweeps': 4, 'rays': 720, 'gates': 920, 'grid_points': 200, 'stations': 8,
+             'scans_per_day': 240, 'file_bytes': 1 << 20, 'downloads': 20, 'domains': 1000,
+             'level3_files': 48, 'processes': None},
+    'small': {'sweeps': 2, 'rays': 180, 'gates': 200, 'grid_points': 41, 'stations': 2,
+              'scans_per_day': 24, 'file_bytes': 1 << 12, 'downloads': 4, 'domains': 20,
+              'level3_files': 4, 'processes': 2},
+}
+# Level 3 products written to the synthetic tree, NCDC names lead with the station and WMO header
+LEVEL3_PRODUCTS = ['N1P', 'DAA']
+
+
+class LocalBucket:
+    '''
+    In-memory stand-in for the noaa-nexrad-level2 bucket with the same key layout and the
+    list / get_key interface S3NEXRADHelper uses
+    '''
+
+    def __init__(self, keys):
+        '''
+        args: dict of key name to bytes
+        '''
+        self.keys = keys
+        self.names = sorted(keys)
+
+    def list(self, prefix='', delimiter='', marker=''):
+        start = bisect.bisect_right(self.names, marker) if marker else bisect.bisect_left(self.names, prefix)
+        for name in self.names[start:]:
+            if not name.startswith(prefix):
+                break
+            yield LocalKey(name, self.keys[name])
+
+    def get_key(self, name):
+        if name not in self.keys:
+            return None
+        return LocalKey(name, self.keys[name])
+
+
+class LocalKey:
+
+    def __init__(self, name, data):
+        self.name = name
+        self.data = data
+        self.size = len(data)
+
+    @property
+    def etag(self):
+        # only hashed when asked for, listing a real bucket does not hash the objects
+        return '"%s"' % hashlib.md5(self.data).hexdigest()
+
+    def get_file(self, fp, headers=None):
+        offset = 0
+        if headers and 'Range' in headers:
+            offset = int(headers['Range'][len('bytes='):-1])
+        fp.write(self.data[offset:])
+
+
+def make_bucket(stations, day, scans_per_day, file_bytes):
+    '''
+    args: list of station ids, datetime of the day, scans per station, bytes per file
+    returns: LocalBucket with a day of YYYY/MM/DD/STATION/STATIONYYYYMMDD_HHMMSS_V06.gz keys
+    '''
+    data = np.random.RandomState(0).bytes(file_bytes)
+    keys = {}
+    for station in stations:
+        for scan in range(scans_per_day):
+            scan_time = day + datetime.timedelta(seconds=scan * 86400 // scans_per_day)
+            keys[scan_time.strftime('%Y/%m/%d/') + station + '/' + station +
+                 scan_time.strftime('%Y%m%d_%H%M%S_V06.gz')] = data
+    return LocalBucket(keys)
+
+
+def make_volume(sweeps, rays, gates, seed=0):
+    '''
+    args: sweeps, rays per sweep and gates per ray
+    returns: radar pyart obj shaped like a WSR-88D Level II volume at STATION
+    '''
+    station = next(station for station in STATION_INDEX if station['station_id'] == STATION)
+    radar = pyart.testing.make_empty_ppi_radar(gates, rays, sweeps)
+    radar.range['data'] = np.arange(gates) * 250.0 + 2125.0
+    radar.azimuth['data'] = np.tile(np.arange(rays) * 360.0 / rays, sweeps)
+    angles = np.array([0.5, 0.9, 1.3, 1.8, 2.4, 3.1, 4.0, 5.1, 6.4, 8.0, 10.0, 12.5, 15.6, 19.5])[:sweeps]
+    radar.elevation['data'] = np.repeat(angles, rays)
+    radar.fixed_angle['data'] = angles
+    radar.latitude['data'][:] = station['latitude']
+    radar.longitude['data'][:] = station['longitude']
+    radar.altitude['data'][:] = station['station_elevation']
+    radar.metadata['instrument_name'] = STATION
+    radar.metadata['vcp_pattern'] = 212
+    radar.init_gate_x_y_z()
+    radar.init_gate_altitude()
+    radar.init_gate_longitude_latitude()
+
+    rng = np.random.RandomState(seed)
+    data = np.ma.masked_less(rng.uniform(-20, 60, (sweeps * rays, gates)), 0)
+    radar.add_field('reflectivity', {'data': data, 'units': 'dBZ'})
+    return radar
+
+
+def make_level3():
+    '''
+    returns: radar pyart obj shaped like a 1 km x 1 degree Level 3 precipitation product at STATION
+    '''
+    radar = make_volume(1, 360, 230)
+    radar.range['data'] = np.arange(230) * 1000.0 + 500.0
+    radar.range['meters_between_gates'] = 1000.0
+    radar.init_gate_x_y_z()
+    radar.init_gate_longitude_latitude()
+    radar.add_field('radar_estimated_rain_rate', {'data': radar.fields.pop('reflectivity')['data'] / 10.0})
+    return radar
+
+
+def make_level3_tree(folder, files):
+    '''
+    args: folder to write to, files per product
+    returns: list of the file paths, named and laid out in hour folders like the NCDC Level 3
+             download so index_files walks it as it would the real one
+    the files are CF/Radial, read_synthetic_level3 stands in for the Level 3 decoder
+    '''
+    level3 = make_level3()
+    paths = []
+    for scan in range(files):
+        scan_time = SEARCH_DAY + datetime.timedelta(minutes=5 * scan)
+        hour_dir = os.path.join(folder, scan_time.strftime('%Y%m%d'), scan_time.strftime('%H'))
+        os.makedirs(hour_dir, exist_ok=True)
+        for product in LEVEL3_PRODUCTS:
+            path = os.path.join(hour_dir, '%s_SDUS51_%s%s_%s' % (STATION, product, STATION[1:],
+                                                                 scan_time.strftime('%Y%m%d%H%M')))
+            pyart.io.write_cfradial(path, level3)
+            paths.append(path)
+    return paths
+
+
+def read_synthetic_level3(infile, prod):
+    '''
+    args: path from make_level3_tree, product code
+    returns: radar pyart obj, read like nexrad.read_level3 reads a Level 3 file
+    '''
+    return pyart.io.read_cfradial(infile)
+
+
+def flatten_tree(folder, output, processes):
+    '''
+    args: folder of Level 3 files, output path, worker processes (1 for nexrad.flatten)
+    returns: rows written
+    indexes the folder and writes every product of it through a ColumnWriter, as nexrad.main does
+    '''
+    writer = nexrad.ColumnWriter(output, fmt='csv')
+    index = nexrad.index_files(folder)
+    tasks = [(path, product) for product in nexrad.PRODUCTS for timestamp, path in index.get(product, [])]
+    if processes == 1:
+        for infile, product in tasks:
+            nexrad.flatten(writer, infile, nexrad.STATS, product)
+    else:
+        nexrad.flatten_parallel(writer, tasks, processes=processes)
+    writer.close()
+    return writer.rows
+
+
+def time_call(function, repeats):
+    '''
+    args: function of no arguments, times to call it
+    returns: dict of min / median / mean seconds per call
+    '''
+    seconds = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        seconds.append(time.perf_counter() - start)
+    return {'min': min(seconds), 'median': float(np.median(seconds)), 'mean': float(np.mean(seconds)),
+            'repeats': repeats}
+
+
+def run(output=RESULTS_PATH, repeats=REPEATS, size='full'):
+    '''
+    args: path to write the JSON results to (None to skip), repeats per benchmark, key of SIZES
+    returns: dict of results, seconds per call of each benchmark
+    '''
+    sizes = SIZES[size]
+    work_dir = tempfile.mkdtemp(prefix='nexradpy-benchmark-')
+    results = {}
+    # keep the caches the benchmarks fill out of the repo cache
+    saved = (clean.CACHE_DIR, clean.IBOUNDS_CACHE, clean._ibounds_cache, gridding._weights_cache,
+             nexrad.read_level3)
+    clean.CACHE_DIR = work_dir
+    clean.IBOUNDS_CACHE = os.path.join(work_dir, 'grid_ibounds.json')
+    # the synthetic Level 3 files are CF/Radial, the pool workers inherit the reader when forked
+    nexrad.read_level3 = read_synthetic_level3
+    try:
+        stations = [STATION] + [station['station_id'] for station in STATION_INDEX
+                                if station['station_id'] != STATION][:sizes['stations'] - 1]
+        bucket = make_bucket(stations, SEARCH_DAY, sizes['scans_per_day'], sizes['file_bytes'])
+        helper = S3NEXRADHelper(verbose=False, threads=4, bucket_factory=lambda: bucket)
+
+        rng = np.random.RandomState(0)
+        lats = rng.uniform(25, 49, sizes['domains'])
+        lons = rng.uniform(-124, -67, sizes['domains'])
+        results['station_search'] = time_call(lambda: [helper.getStationsFromDomain(
+                lat + 1, lon + 1, lat, lon, 3000) for lat, lon in zip(lats, lons)], repeats)
+        results['station_search']['queries'] = sizes['domains']
+
+        results['listing'] = time_call(lambda: helper.searchNEXRADS3(
+                SEARCH_DAY, SEARCH_DAY + datetime.timedelta(days=1), stations), repeats)
+
+        keys = helper.searchNEXRADS3(SEARCH_DAY, SEARCH_DAY + datetime.timedelta(days=1), [STATION])
+        keys = keys[:sizes['downloads']]
+        download_dir = os.path.join(work_dir, 'downloads')
+
+        def download():
+            shutil.rmtree(download_dir, ignore_errors=True)
+            os.makedirs(download_dir)
+            helper.downloadNEXRADFiles(download_dir, keys)
+
+        results['download'] = time_call(download, repeats)
+        results['download']['bytes'] = sizes['file_bytes'] * len(keys)
+        helper.close()
+
+        radar = make_volume(sizes['sweeps'], sizes['rays'], sizes['gates'])
+
+        def cold_grid():
+            gridding._weights_cache.clear()
+            return clean.get_grid(radar, sizes['grid_points'], ['reflectivity'])
+
+        results['grid_cold'] = time_call(cold_grid, repeats)
+        grid = clean.get_grid(radar, sizes['grid_points'], ['reflectivity'])
+        results['grid'] = time_call(lambda: clean.get_grid(radar, sizes['grid_points'], ['reflectivity']), repeats)
+        results['grid_pyart'] = time_call(lambda: pyart.map.grid_from_radars(
+                (radar,), grid_shape=(1, sizes['grid_points'], sizes['grid_points']),
+                grid_limits=((2000, 2000), (-123000.0, 123000.0), (-123000.0, 123000.0)),
+                fields=['reflectivity']), repeats)
+
+        results['ibounds_cold'] = time_call(lambda: clean.compute_grid_ibounds(grid, clean.BBOX), repeats)
+        results['ibounds'] = time_call(lambda: clean.get_grid_ibounds(grid, clean.BBOX), repeats)
+
+        level3_dir = os.path.join(work_dir, 'level3')
+        files = len(make_level3_tree(level3_dir, sizes['level3_files']))
+        flatten_output = os.path.join(work_dir, 'flatten.csv')
+        for name, processes in (('flatten', 1), ('flatten_parallel', sizes['processes'])):
+            rows = []
+            results[name] = time_call(lambda: rows.append(flatten_tree(level3_dir, flatten_output, processes)), repeats)
+            results[name]['files'] = files
+            results[name]['rows'] = rows[-1]
+    finally:
+        (clean.CACHE_DIR, clean.IBOUNDS_CACHE, clean._ibounds_cache, gridding._weights_cache,
+         nexrad.read_level3) = saved
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        'created': datetime.datetime.utcnow().isoformat() + 'Z',
+        'size': size,
+        'sizes': sizes,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pyart': pyart.__version__,
+        'bucket': NEXRAD_BUCKET,
+        'results': results,
+    }
+    if output is not None:
+        os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    return report
+
+
+def compare(baseline, current, threshold=1.2):
+    '''
+    args: two run reports (or paths to their JSON), slowdown ratio that counts as a regression
+    returns: dict of benchmark name to median current / baseline ratio for the regressions
+    '''
+    reports = []
+    for report in (baseline, current):
+        if isinstance(report, str):
+            with open(report) as f:
+                report = json.load(f)
+        reports.append(report['results'])
+
+    ratios = {name: reports[1][name]['median'] / reports[0][name]['median']
+              for name in reports[0] if name in reports[1] and reports[0][name]['median'] > 0}
+    return {name: ratio for name, ratio in ratios.items() if ratio > threshold}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time the nexradpy pipeline offline')
+    parser.add_argument('--output', default=RESULTS_PATH)
+    parser.add_argument('--repeats', type=int, default=REPEATS)
+    parser.add_argument('--size', choices=sorted(SIZES), default='full')
+    parser.add_argument('--baseline', help='earlier results to check for regressions')
+    args = parser.parse_args()
+
+    report = run(args.output, args.repeats, args.size)
+    for name, timing in sorted(report['results'].items()):
+        print('%-16s %10.4f s' % (name, timing['median']))
+    if args.baseline:
+        for name, ratio in sorted(compare(args.baseline, report).items()):
+            print('REGRESSION %s %.2fx slower' % (name, ratio))
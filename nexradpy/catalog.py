@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+import calendar
+import datetime
+import os
+import sqlite3
+import time
+
+
+CATALOG_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'data', 'cache', 'nexrad_listings.sqlite'))
+
+# Seconds a listing of the current UTC day is trusted, that day's folder is still filling up
+CURRENT_DAY_TTL = 15*60
+# Seconds after the end of a UTC day that its last volumes can still be arriving in the bucket
+DAY_CLOSE_DELAY = 60*60
+
+
+class S3ListingCatalog:
+    """Local SQLite catalog of the key listing of each YYYY/MM/DD/STATION prefix.
+
+    Days that are over never change in noaa-nexrad-level2, so a listing made after
+    its day ended (plus DAY_CLOSE_DELAY for late uploads) never expires. Any other
+    listing, including one of an earlier day made while that day was still filling,
+    expires after current_day_ttl seconds.
+    """
+
+    def __init__(self, path=CATALOG_PATH, current_day_ttl=CURRENT_DAY_TTL):
+        """Opens (and creates if needed) the catalog
+
+        path: sqlite file to keep the catalog in, ':memory:' for a throwaway catalog
+        current_day_ttl: seconds a listing of the current day is trusted
+        """
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.current_day_ttl = current_day_ttl
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS listings ('
+                'prefix TEXT NOT NULL PRIMARY KEY, '
+                'listed_at REAL NOT NULL, '
+                'keys TEXT NOT NULL'
+                ')')
+        self.connection.commit()
+
+    def get(self, prefix):
+        """Look up the listing for a prefix
+
+        prefix: day/station prefix ex. "2015/05/06/KSGF"
+
+        returns: list of key names or None if the prefix is missing or expired
+        """
+        row = self.connection.execute('SELECT listed_at, keys FROM listings WHERE prefix = ?',
+                (prefix,)).fetchone()
+        if row is None:
+            return None
+
+        listed_at, keys = row
+        if not self._isFinal(prefix, listed_at) and time.time() - listed_at > self.current_day_ttl:
+            return None
+
+        return keys.split('\n') if keys else []
+
+    def putMany(self, listings):
+        """Store listings in one transaction
+
+        listings: dict of prefix to list of key names
+        """
+        listed_at = time.time()
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO listings (prefix, listed_at, keys) VALUES (?, ?, ?)',
+                    [(prefix, listed_at, '\n'.join(keys)) for prefix, keys in listings.items()])
+
+    def close(self):
+        self.connection.close()
+
+    def _isFinal(self, prefix, listed_at):
+        """Boolean of if the listing was made once the prefix's day was over, so it has every key"""
+        prefix_date = datetime.date(int(prefix[0:4]), int(prefix[5:7]), int(prefix[8:10]))
+        day_end = calendar.timegm((prefix_date + datetime.timedelta(days=1)).timetuple())
+        return listed_at >= day_end + DAY_CLOSE_DELAY
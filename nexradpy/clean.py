@@ -1,23 +1,35 @@
 #!/usr/bin/env python3
 
+import json
 import os
+import tempfile
 import numpy as np
-import matplotlib.pyplot as plt
-import pandas as pd
-import geopandas as gpd
-import pyart
-import rtree
-from shapely.geometry import Point, box
+
+# pyart is imported where it is used, it takes seconds to load
+from . import metrics
+from .gridding import grid_from_radar
 
 
 INDIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '../..', 'data/raw/temp'))
 INFILE = '/KOKX20150505_050626_V06.gz'
 POINTS_IN_GRID = 200
 BBOX = [-74.363177, 40.460969, -73.632802, 40.901954]
+GRID_HEIGHT = 2000
+# grid spacing in meters for bbox grids, same as POINTS_IN_GRID over the full +-123 km domain
+BBOX_GRID_SPACING = 246000.0 / (POINTS_IN_GRID - 1)
+# points sampled along each bbox edge, edges are curved in the radar's projection
+BBOX_EDGE_POINTS = 50
+CACHE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'data', 'cache'))
+IBOUNDS_CACHE = os.path.join(CACHE_DIR, 'grid_ibounds.json')
+
+# grid index bounds by grid_key, loaded from IBOUNDS_CACHE on first use
+_ibounds_cache = None
 
 
 def inter_points(pts, target_shape):
     '''
+    takes: geopandas GeoDataFrame of points (its spatial index needs rtree), shapely shape
+    returns: the points that intersect target_shape
     '''
     spatial_index = pts.sindex
     possible_matches_index = list(spatial_index.intersection(target_shape.bounds))
@@ -30,70 +42,153 @@ def get_grid(radar, xy_len, fields):
     '''
     args: radar pyart obj, xy_len (int) points to have in each dimension, list of fields (strs)
     returns: grid pyart obj
+    interpolation weights are built once per station, VCP and grid, later scans are
+    gridded with sparse mat-vecs (see gridding.py)
     TODO: correct grid limits to bounding box
     '''
+    import pyart
+
     gatefilter = pyart.filters.GateFilter(radar)
     gatefilter.exclude_transition()
     
-    grid = pyart.map.grid_from_radars(
-            (radar,), gatefilters=(gatefilter, ),
+    grid = grid_from_radar(
+            radar, gatefilter=gatefilter,
             grid_shape=(1, xy_len, xy_len),
-            grid_limits=((2000, 2000), (-123000.0, 123000.0), (-123000.0, 123000.0)),
-            fields=['reflectivity'])
+            grid_limits=((GRID_HEIGHT, GRID_HEIGHT), (-123000.0, 123000.0), (-123000.0, 123000.0)),
+            fields=fields)
 
     return grid
 
 
+def get_bbox_grid(radar, bbox, fields, spacing=BBOX_GRID_SPACING, height=GRID_HEIGHT):
+    '''
+    args: radar pyart obj, bbox [minlon, minlat, maxlon, maxlat], list of fields (strs),
+          grid spacing in meters, grid height in meters above the radar
+    returns: grid pyart obj covering only the bbox
+    gates whose radius of influence misses the bbox grid are dropped before interpolation,
+    so the work follows the bbox area rather than the radar footprint
+    '''
+    import pyart
+
+    gatefilter = pyart.filters.GateFilter(radar)
+    gatefilter.exclude_transition()
+
+    grid_shape, grid_limits = bbox_grid_limits(radar, bbox, spacing, height)
+    return grid_from_radar(radar, grid_shape, grid_limits, fields, gatefilter=gatefilter)
+
+
+def bbox_grid_limits(radar, bbox, spacing=BBOX_GRID_SPACING, height=GRID_HEIGHT):
+    '''
+    args: radar pyart obj, bbox [minlon, minlat, maxlon, maxlat], grid spacing in meters,
+          grid height in meters above the radar
+    returns: grid_shape (1, ny, nx), grid_limits ((z, z), (y0, y1), (x0, x1)) of the smallest
+             grid on the spacing lattice around the radar that covers the bbox
+    '''
+    import pyart
+
+    # bbox perimeter in the radar centered azimuthal equidistant projection pyart grids in
+    edge = np.linspace(0.0, 1.0, BBOX_EDGE_POINTS)
+    lons = np.concatenate([bbox[0] + (bbox[2] - bbox[0]) * edge, np.full(BBOX_EDGE_POINTS, bbox[2]),
+                           bbox[2] - (bbox[2] - bbox[0]) * edge, np.full(BBOX_EDGE_POINTS, bbox[0])])
+    lats = np.concatenate([np.full(BBOX_EDGE_POINTS, bbox[1]), bbox[1] + (bbox[3] - bbox[1]) * edge,
+                           np.full(BBOX_EDGE_POINTS, bbox[3]), bbox[3] - (bbox[3] - bbox[1]) * edge])
+    x, y = pyart.core.geographic_to_cartesian_aeqd(
+            lons, lats, radar.longitude['data'][0], radar.latitude['data'][0])
+
+    # snap outwards to the lattice so grids of nearby bboxes share points
+    x_min, x_max = np.floor(x.min() / spacing), np.ceil(x.max() / spacing)
+    y_min, y_max = np.floor(y.min() / spacing), np.ceil(y.max() / spacing)
+
+    grid_shape = (1, int(y_max - y_min) + 1, int(x_max - x_min) + 1)
+    grid_limits = ((height, height), (y_min * spacing, y_max * spacing), (x_min * spacing, x_max * spacing))
+    return grid_shape, grid_limits
+
+
+@metrics.stage('ibounds')
 def get_grid_ibounds(grid, bbox):
     '''
     takes: grid pyart obj, list of coordinate boundaries
     returns: 4-tuple of bounds (outer min, outer max, inner min, inner max)
+    grids from the same radar location, grid shape and grid limits share bounds, so they
+    are computed once and kept in IBOUNDS_CACHE
     '''
-    grid_lat = [lat for arr in grid.point_latitude['data'][0] for lat in arr]
-    grid_lon = [lon for arr in grid.point_longitude['data'][0] for lon in arr]
-    grid_ij = [(i,j) for i, arr in enumerate(grid.point_longitude['data'][0]) for j,n in enumerate(arr)]
+    global _ibounds_cache
+    if _ibounds_cache is None:
+        _ibounds_cache = {}
+        if os.path.exists(IBOUNDS_CACHE):
+            # a cache that can't be read is rebuilt
+            try:
+                with open(IBOUNDS_CACHE) as f:
+                    _ibounds_cache = dict(json.load(f))
+            except (OSError, ValueError, TypeError):
+                _ibounds_cache = {}
+
+    key = grid_key(grid, bbox)
+    if key not in _ibounds_cache:
+        _ibounds_cache[key] = compute_grid_ibounds(grid, bbox)
+
+        # each process writes its own temporary file, replacing the cache is atomic
+        cache_dir = os.path.dirname(IBOUNDS_CACHE)
+        os.makedirs(cache_dir, exist_ok=True)
+        with tempfile.NamedTemporaryFile('w', dir=cache_dir, suffix='.tmp', delete=False) as f:
+            json.dump(_ibounds_cache, f)
+        os.replace(f.name, IBOUNDS_CACHE)
+
+    return tuple(_ibounds_cache[key])
+
+
+def grid_key(grid, bbox):
+    '''
+    takes: grid pyart obj, list of coordinate boundaries
+    returns: str identifying radar location, grid shape, grid limits and bbox
+    '''
+    origin = (round(float(grid.origin_latitude['data'][0]), 6),
+              round(float(grid.origin_longitude['data'][0]), 6))
+    limits = [(float(axis['data'][0]), float(axis['data'][-1])) for axis in (grid.z, grid.y, grid.x)]
 
-    grid_lon = []
-    grid_ij = []
-    for i, arr in enumerate(grid.point_longitude['data'][0]):
-        for j, lon in enumerate(arr):
-            grid_lon.append(lon)     
-            grid_ij.append((i,j))
+    return json.dumps([origin, (grid.nz, grid.ny, grid.nx), limits, [float(b) for b in bbox]])
 
-    # assumes lat, lon coordinates of points are indexed the same way in grid
+
+def compute_grid_ibounds(grid, bbox):
+    '''
+    takes: grid pyart obj, list of coordinate boundaries
+    returns: 4-tuple of bounds (outer min, outer max, inner min, inner max)
+    '''
+    # lat, lon coordinates of points are indexed the same way in grid
     # see test/experiment.py for a rough check
-    geometry = [Point(xy) for xy in zip(grid_lon, grid_lat)]
-    
-    # set up spatial join
-    df = pd.DataFrame()
-    point_gdf = gpd.GeoDataFrame(df, crs=4326, geometry=geometry)
-    point_gdf['grid_index'] = grid_ij
-
-    # restrict points to those within box
-    point_gdf = inter_points(point_gdf, box(*bbox))
-
-    iindexes = []
-    jindexes = []
-    for ij in point_gdf['grid_index']:
-        iindexes.append(ij[0])
-        jindexes.append(ij[1])
-    
-    # i indexes outermost grid array
-    i_min = min(iindexes)
-    i_max = max(iindexes)
+    grid_lat = np.asarray(grid.point_latitude['data'][0])
+    grid_lon = np.asarray(grid.point_longitude['data'][0])
+
+    # restrict points to those within box (edges included)
+    in_box = ((grid_lon >= bbox[0]) & (grid_lon <= bbox[2]) &
+              (grid_lat >= bbox[1]) & (grid_lat <= bbox[3]))
+    if not in_box.any():
+        raise ValueError('No grid points within bbox %s' % (bbox,))
 
-    # j indexes inner grid array
-    # could get min, max j within i, but min(min) and max(max) won't take much more space 
+    # i indexes outermost grid array, j indexes inner grid array
+    # could get min, max j within i, but min(min) and max(max) won't take much more space
     # since grid is rectangular
-    j_min = min(jindexes)
-    j_max = max(jindexes)
-    
-    return (i_min, i_max, j_min, j_max)
+    iindexes, jindexes = np.nonzero(in_box)
+
+    return (int(iindexes.min()), int(iindexes.max()), int(jindexes.min()), int(jindexes.max()))
+
+
+def trim_grid(grid, field, ibounds):
+    '''
+    takes: grid pyart obj, field name (str), 4-tuple of bounds from get_grid_ibounds
+    returns: field data within bounds, (z, i, j) array
+    '''
+    i_min, i_max, j_min, j_max = ibounds
+    return grid.fields[field]['data'][:, i_min:i_max + 1, j_min:j_max + 1]
 
 
 if __name__ == '__main__':
     global radar, grid_ibounds
+    import pyart
+
     radar = pyart.io.read(INDIR + INFILE) 
     grid = get_grid(radar, POINTS_IN_GRID, fields=['reflectivity'])
     grid_ibounds = get_grid_ibounds(grid, BBOX)
     print(grid_ibounds)
+    print(trim_grid(grid, 'reflectivity', grid_ibounds).shape)
+    print(get_bbox_grid(radar, BBOX, fields=['reflectivity']).fields['reflectivity']['data'].shape)
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+
+import multiprocessing
+import os
+import sys
+import numpy as np
+import netCDF4
+
+from .clean import BBOX, BBOX_GRID_SPACING, GRID_HEIGHT, get_bbox_grid
+
+
+TIME_UNITS = 'seconds since 1970-01-01T00:00:00Z'
+COMPRESSION_LEVEL = 4
+# files handed to a worker at a time
+POOL_CHUNKSIZE = 4
+
+
+class GridCube:
+    '''
+    Append-only (time, y, x) store of gridded scans in a NetCDF4 file. time is the
+    unlimited dimension and every field is chunked one scan per chunk and zlib
+    compressed, so appending a scan writes one new chunk and never touches earlier
+    ones, and readers can slice any window of time without loading the cube.
+    '''
+
+    def __init__(self, path, grid=None, fields=None):
+        '''
+        args: path of the .nc file, grid pyart obj and list of fields (strs) to lay out
+              a new cube, when path already exists the grid is ignored and fields, if given,
+              must be the fields of the cube
+        '''
+        self.path = path
+        if os.path.exists(path):
+            self.dataset = netCDF4.Dataset(path, 'a')
+            self.fields = [name for name, variable in self.dataset.variables.items()
+                           if variable.dimensions == ('time', 'y', 'x')]
+            if fields is not None and sorted(fields) != sorted(self.fields):
+                self.dataset.close()
+                raise ValueError('%s has fields %s, not %s' % (path, self.fields, list(fields)))
+        else:
+            if grid is None or fields is None:
+                raise ValueError('grid and fields are needed to create %s' % path)
+            self.dataset = netCDF4.Dataset(path, 'w', format='NETCDF4')
+            self.fields = list(fields)
+            self._create(grid)
+
+        self.shape = (len(self.dataset.dimensions['y']), len(self.dataset.dimensions['x']))
+        self._times = set(self.dataset.variables['time'][:].tolist())
+
+    def _create(self, grid):
+        '''
+        args: grid pyart obj the cube is laid out like
+        '''
+        self.dataset.createDimension('time', None)
+        self.dataset.createDimension('y', grid.ny)
+        self.dataset.createDimension('x', grid.nx)
+
+        time = self.dataset.createVariable('time', 'f8', ('time',))
+        time.units = TIME_UNITS
+        time.calendar = 'standard'
+        for name, axis in (('y', grid.y), ('x', grid.x)):
+            variable = self.dataset.createVariable(name, 'f8', (name,))
+            variable.units = 'm'
+            variable[:] = axis['data']
+
+        lons, lats = grid.get_point_longitude_latitude()
+        for name, data in (('lat', lats), ('lon', lons)):
+            variable = self.dataset.createVariable(name, 'f8', ('y', 'x'))
+            variable.units = 'degrees_north' if name == 'lat' else 'degrees_east'
+            variable[:] = data
+
+        self.dataset.origin_latitude = float(grid.origin_latitude['data'][0])
+        self.dataset.origin_longitude = float(grid.origin_longitude['data'][0])
+        self.dataset.height = float(grid.z['data'][0])
+
+        for field in self.fields:
+            variable = self.dataset.createVariable(
+                    field, 'f4', ('time', 'y', 'x'), zlib=True, complevel=COMPRESSION_LEVEL,
+                    chunksizes=(1, grid.ny, grid.nx), fill_value=np.float32(np.nan))
+            variable.units = grid.fields[field].get('units', '')
+
+    def __contains__(self, scan_time):
+        return float(scan_time) in self._times
+
+    def __len__(self):
+        return len(self.dataset.dimensions['time'])
+
+    def append(self, scan_time, arrays):
+        '''
+        args: scan time in seconds since the epoch, dict of field name to (y, x) array
+        returns: boolean of whether the scan was written, scans already in the cube are skipped
+        '''
+        if scan_time in self:
+            return False
+
+        index = len(self)
+        for field in self.fields:
+            data = np.ma.filled(np.ma.asarray(arrays[field], dtype=np.float32), np.nan)
+            if data.shape != self.shape:
+                raise ValueError('%s is %s, cube is %s' % (field, data.shape, self.shape))
+            self.dataset.variables[field][index] = data
+        self.dataset.variables['time'][index] = scan_time
+
+        self._times.add(float(scan_time))
+        return True
+
+    def times(self):
+        '''
+        returns: array of scan times as datetimes
+        '''
+        time = self.dataset.variables['time']
+        return netCDF4.num2date(time[:], time.units)
+
+    def sync(self):
+        self.dataset.sync()
+
+    def close(self):
+        self.dataset.close()
+
+
+def grid_scan(args):
+    '''
+    args: tuple of (Level II file path, bbox, list of fields, spacing, height)
+    returns: tuple of (file path, scan time in seconds since the epoch, dict of field name to
+             (y, x) array, grid pyart obj) or (file path, None, None, error message) if the file
+             could not be read or gridded
+    runs in the pool workers, each worker keeps its own gridding weights cache
+    '''
+    import pyart
+
+    path, bbox, fields, spacing, height = args
+    try:
+        radar = pyart.io.read(path)
+        grid = get_bbox_grid(radar, bbox, fields, spacing=spacing, height=height)
+    except Exception as e:
+        return path, None, None, '%s: %s' % (type(e).__name__, e)
+
+    scan_time = netCDF4.date2num(pyart.util.datetime_from_grid(grid), TIME_UNITS)
+    arrays = {field: grid.fields[field]['data'][0] for field in fields}
+    # the grid itself is only needed to lay out a new cube, keep it off the result pipe
+    grid.fields = {field: {'units': grid.fields[field].get('units', '')} for field in fields}
+    return path, float(scan_time), arrays, grid
+
+
+def grid_files_to_cube(paths, cube_path, bbox=BBOX, fields=('reflectivity',), spacing=BBOX_GRID_SPACING,
+                       height=GRID_HEIGHT, processes=None, verbose=True):
+    '''
+    args: list of Level II file paths (one station), path of the cube .nc file, bbox
+          [minlon, minlat, maxlon, maxlat], fields (strs), grid spacing and height in meters,
+          number of worker processes (None for one per cpu, 1 to grid in this process)
+    returns: number of scans appended
+    scans are appended in the order of paths as they come back from the pool and the cube is
+    synced after each one, so an interrupted run keeps what was written and a rerun only
+    appends scans that are missing
+    '''
+    fields = list(fields)
+    tasks = [(path, bbox, fields, spacing, height) for path in paths]
+
+    # an existing cube with other fields is rejected before any file is gridded
+    cube = GridCube(cube_path, fields=fields) if os.path.exists(cube_path) else None
+
+    pool = None
+    if processes == 1:
+        results = map(grid_scan, tasks)
+    else:
+        pool = multiprocessing.Pool(processes)
+        results = pool.imap(grid_scan, tasks, chunksize=POOL_CHUNKSIZE)
+
+    appended = 0
+    try:
+        for path, scan_time, arrays, grid in results:
+            if scan_time is None:
+                # grid is the error message for scans that failed
+                print('Skipping %s, %s' % (path, grid), file=sys.stderr)
+                continue
+            if cube is None:
+                cube = GridCube(cube_path, grid, fields)
+            if cube.append(scan_time, arrays):
+                cube.sync()
+                appended += 1
+                if verbose:
+                    print('Appended %s' % path)
+        if pool is not None:
+            pool.close()
+            pool.join()
+    except BaseException:
+        # bailing out with results still pending, don't wait on the workers
+        if pool is not None:
+            pool.terminate()
+        raise
+    finally:
+        if cube is not None:
+            cube.close()
+
+    return appended
+
+
+if __name__ == '__main__':
+    # python -m nexradpy.cube cube.nc KOKX20150505_050626_V06.gz ...
+    grid_files_to_cube(sorted(sys.argv[2:]), sys.argv[1])
@@ -1,22 +1,60 @@
+import collections
+import concurrent.futures
+import hashlib
+import io
+import os
+import re
+import threading
+import time
+
+import numpy
+import pandas
 import psycopg2
+import psycopg2.pool
 
 # Globals
 DATABASE = 'radar_db'
-TABLE = 'ref'
+TABLE = 'observations'
+# scratch table the benchmark loads and drops, never TABLE
+BENCH_TABLE = TABLE + '_bench_%d'
 LOOKUP = 'lookup'
+USER = 'postgres'
+PASSWORD = '<your password>'
 connection = None
 cursor = None
+pool = None
+
+# rows per COPY and rows between commits
+COPY_ROWS = 100000
+COMMIT_ROWS = 1000000
+
+# Columns written by nexrad.ColumnWriter and their postgres types, month / day / hour / minute
+# are left out since they are in scan_time
+OBSERVATION_COLUMNS = [('name', 'VARCHAR NOT NULL'), ('product', 'CHAR(3)'), ('azimuth', 'SMALLINT'),
+		('dist', 'REAL'), ('lon', 'REAL'), ('lat', 'REAL'), ('observation', 'REAL'),
+		('scan_time', 'TIMESTAMP NOT NULL')]
+
+# postgres cuts identifiers at 63 characters, partition names leave room for the index suffix
+MAX_PARTITION_NAME = 63 - len('_scan_time')
+# milliseconds partition DDL waits for locks on the parent tables before failing
+DDL_LOCK_TIMEOUT = 60000
+
+# (table, month, name) partitions known to be committed, writer threads create them one at a time
+_partitions = set()
+_partitions_lock = threading.Lock()
 
-'''
-Placeholder
-'''
-def add_entry_db(i_id, f_id, f_screen):
-	insert_query = "INSERT INTO " + TABLE + " (icon_id, follower_id, follower_screen) VALUES(%s, %s, %s)"
-	values = [i_id, f_id, f_screen]
-	# print(values)
+def add_entry_db(values, table_name = TABLE):
+	'''
+	Inserts one observation, values ordered like OBSERVATION_COLUMNS
+	'''
+	names = [name for name, sql_type in OBSERVATION_COLUMNS]
+	insert_query = ('INSERT INTO ' + table_name + ' (' + ', '.join(names) + ') VALUES (' +
+			', '.join(['%s'] * len(names)) + ')')
 
 	# Insert values
 	if not cursor is None:
+		scan_time = numpy.datetime64(values[names.index('scan_time')], 'M')
+		ensure_partitions([(scan_time, values[names.index('name')])], table_name, conn = connection)
 		cursor.execute(insert_query, values)
 
 	return True
@@ -25,28 +63,123 @@ def connect_db(dbname = DATABASE):
 	global connection, cursor
 	try:
 		connection = psycopg2.connect(database = dbname,
-								      user = 'postgres',
-								      password = '<your password>')
+								      user = USER,
+								      password = PASSWORD)
 		cursor = connection.cursor()
 	except:
 		print('Make sure DB exists!')
 
-'''
-Placeholder
-'''
-def create_table(table_name = TABLE):
-	create_query = ('CREATE TABLE IF NOT EXISTS ' + TABLE + ' ('
-			'ID serial NOT NULL PRIMARY KEY, '
-			'icon_id BIGINT NOT NULL, '
-			'follower_id BIGINT NOT NULL, '
-			'follower_screen VARCHAR NOT NULL'
-			')')
+def create_table(table_name = TABLE, cur = None):
+	'''
+	Observations partitioned by month of scan_time, each month partitioned by station
+	(gauge or stat name). Partitions are made on demand by ensure_partitions.
+	'''
+	create_query = ('CREATE TABLE IF NOT EXISTS ' + table_name + ' (' +
+			', '.join(name + ' ' + sql_type for name, sql_type in OBSERVATION_COLUMNS) +
+			') PARTITION BY RANGE (scan_time)')
+
+	(cur or cursor).execute(create_query)
+
+def partition_name(table_name, month, name = None):
+	'''
+	Takes table name, numpy datetime64 month and optional station name
+	Returns partition table name ex. observations_201407_nyc_d9fc5e29, station names are
+	cleaned up and shortened to fit postgres identifiers, so a hash of the name keeps
+	them apart
+	'''
+	partition = table_name + '_' + str(month).replace('-', '')
+	if name is not None:
+		digest = hashlib.sha1(name.encode('utf-8')).hexdigest()[:8]
+		cleaned = re.sub('[^a-z0-9]+', '_', name.lower()).strip('_')
+		cleaned = cleaned[:max(MAX_PARTITION_NAME - len(partition) - len(digest) - 2, 0)].strip('_')
+		partition += '_' + cleaned + '_' + digest if cleaned else '_' + digest
+	return partition
+
+def missing_partitions(keys, table_name = TABLE):
+	'''
+	Takes (numpy datetime64 month, station name) pairs
+	Returns list of the (table, month, name) partitions not known to be committed
+	'''
+	missing = []
+	for month, name in keys:
+		key = (table_name, numpy.datetime64(month, 'M'), name)
+		if key not in _partitions and key not in missing:
+			missing.append(key)
+	return missing
+
+def ensure_partitions(keys, table_name = TABLE, db_pool = None, conn = None):
+	'''
+	Takes (numpy datetime64 month, station name) pairs about to be written and either a pool
+	to borrow an autocommit connection from or, without one, the writer's own connection
+	(which is committed, pending rows included)
+	Creates the month and station partitions that are missing, each station partition with
+	a BRIN index on scan_time, and commits them before returning so every writer can COPY
+	into them. Partitions are only remembered once their commit went through.
+	The DDL locks the parent tables, which writers with open transactions hold locks on, so
+	callers commit before asking for new partitions and the DDL gives up after
+	DDL_LOCK_TIMEOUT rather than waiting forever.
+	'''
+	## Known partitions never wait on the lock
+	if not missing_partitions(keys, table_name):
+		return
 
-	# Re-write with placeholder
-	cursor.execute(create_query)
+	with _partitions_lock:
+		missing = missing_partitions(keys, table_name)
+		if not missing:
+			return
+
+		if db_pool is not None:
+			ddl = db_pool.getconn()
+			try:
+				ddl.autocommit = True
+				cur = ddl.cursor()
+				cur.execute('SET lock_timeout = %s', [DDL_LOCK_TIMEOUT])
+				try:
+					for key in missing:
+						_create_partition(cur, *key)
+				finally:
+					cur.execute('RESET lock_timeout')
+					cur.close()
+			finally:
+				ddl.autocommit = False
+				db_pool.putconn(ddl)
+		else:
+			cur = conn.cursor()
+			cur.execute('SET LOCAL lock_timeout = %s', [DDL_LOCK_TIMEOUT])
+			for key in missing:
+				_create_partition(cur, *key)
+			conn.commit()
+
+		_partitions.update(missing)
+
+def _create_partition(cur, table_name, month, name):
+	month_table = partition_name(table_name, month)
+	cur.execute('CREATE TABLE IF NOT EXISTS ' + month_table + ' PARTITION OF ' + table_name +
+			' FOR VALUES FROM (%s) TO (%s) PARTITION BY LIST (name)',
+			[str(month) + '-01', str(month + 1) + '-01'])
+
+	station_table = partition_name(table_name, month, name)
+	cur.execute('CREATE TABLE IF NOT EXISTS ' + station_table + ' PARTITION OF ' + month_table +
+			' FOR VALUES IN (%s)', [name])
+	cur.execute('CREATE INDEX IF NOT EXISTS ' + station_table + '_scan_time ON ' +
+			station_table + ' USING brin (scan_time)')
+
+def gauge_series(name, start, end, table_name = TABLE, cur = None):
+	'''
+	Takes station name and scan_time range [start, end)
+	Returns rows of (scan_time, product, azimuth, dist, observation), only the station's
+	partitions for the months in range are scanned
+	'''
+	cur = cur or cursor
+	cur.execute('SELECT scan_time, product, azimuth, dist, observation FROM ' + table_name +
+			' WHERE name = %s AND scan_time >= %s AND scan_time < %s ORDER BY scan_time',
+			[name, start, end])
+	return cur.fetchall()
 
 def drop_table(table_name = TABLE):
-	cursor.execute('DROP TABLE IF EXISTS ' + TABLE)
+	cursor.execute('DROP TABLE IF EXISTS ' + table_name + ' CASCADE')
+	for key in [key for key in _partitions if key[0] == table_name]:
+		_partitions.discard(key)
 
 def commit_db():
 	connection.commit()
@@ -56,3 +189,190 @@ def close_db():
 	connection.close()
 	return
 
+# Bulk loading
+def connect_pool(dbname = DATABASE, minconn = 1, maxconn = 8):
+	'''
+	Opens the module pool, one connection per parallel writer plus one for creating partitions
+	'''
+	global pool
+	pool = psycopg2.pool.ThreadedConnectionPool(minconn, maxconn, database = dbname,
+			user = USER, password = PASSWORD)
+	return pool
+
+def close_pool():
+	global pool
+	if pool is not None:
+		pool.closeall()
+		pool = None
+
+def columns_to_csv(columns, names, buf):
+	'''
+	Takes dict of columns (from nexrad.extract), the names to write and a text buffer
+	Appends the rows as CSV for COPY, masked / NaN / NaT values are empty (NULL)
+	'''
+	frame = pandas.DataFrame({name: numpy.ma.filled(columns[name], numpy.nan)
+			if numpy.ma.isMaskedArray(columns[name]) else columns[name] for name in names},
+			columns = names)
+	frame.to_csv(buf, header = False, index = False, na_rep = '', date_format = '%Y-%m-%d %H:%M:%S')
+
+class BulkLoader:
+	'''
+	Streams column batches into a table with COPY FROM STDIN. Drop in for
+	nexrad.ColumnWriter, so nexrad.flatten_parallel can write straight to postgres.
+	Takes its connection from the pool (or connection) given and hands it back on close.
+	Rows are copied straight into their station partitions. COPY still locks the parent
+	tables until commit, so the writer commits before any new partition is created.
+	'''
+	def __init__(self, table_name = TABLE, db_pool = None, conn = None,
+			copy_rows = COPY_ROWS, commit_rows = COMMIT_ROWS):
+		self.table_name = table_name
+		if conn is not None:
+			self.pool = None
+			self.connection = conn
+		else:
+			self.pool = db_pool or pool
+			if self.pool is None:
+				raise ValueError('No connection or pool to load with, call connect_pool first')
+			self.connection = self.pool.getconn()
+		self.cursor = self.connection.cursor()
+		self.copy_rows = copy_rows
+		self.commit_rows = commit_rows
+		self.names = [name for name, sql_type in OBSERVATION_COLUMNS]
+		self.copy_query = 'COPY %s (' + ', '.join(self.names) + ') FROM STDIN WITH (FORMAT csv)'
+		self.batches = []
+		self.buffered = 0
+		self.uncommitted = 0
+		self.rows = 0
+
+	def write(self, columns):
+		self.batches.append(columns)
+		self.buffered += len(columns[self.names[0]])
+		if self.buffered >= self.copy_rows:
+			self.flush()
+
+	def flush(self):
+		if not self.buffered:
+			return
+		# rows of every (month, station) in the batches, then one COPY per partition
+		buffers = collections.OrderedDict()
+		for columns in self.batches:
+			keys = pandas.DataFrame({'month': columns['scan_time'].astype('datetime64[M]'),
+					'name': columns['name']})
+			for (month, name), rows in keys.groupby(['month', 'name'], sort = False).indices.items():
+				key = (numpy.datetime64(month, 'M'), name)
+				if key not in buffers:
+					buffers[key] = io.StringIO()
+				columns_to_csv({column: columns[column][rows] for column in self.names}, self.names,
+						buffers[key])
+
+		## Rows copied so far lock the parent tables until committed, commit them before the
+		## partition DDL waits on those locks
+		if missing_partitions(buffers, self.table_name):
+			if self.uncommitted:
+				self.commit()
+			ensure_partitions(buffers, self.table_name, db_pool = self.pool, conn = self.connection)
+		for (month, name), buf in buffers.items():
+			buf.seek(0)
+			self.cursor.copy_expert(self.copy_query % partition_name(self.table_name, month, name), buf)
+
+		self.rows += self.buffered
+		self.uncommitted += self.buffered
+		self.batches = []
+		self.buffered = 0
+		if self.uncommitted >= self.commit_rows:
+			self.commit()
+
+	def commit(self):
+		self.connection.commit()
+		self.uncommitted = 0
+
+	def close(self):
+		self.flush()
+		self.commit()
+		self.cursor.close()
+		if self.pool is not None:
+			self.pool.putconn(self.connection)
+
+def load_parallel(sources, table_name = TABLE, db_pool = None, **loader_args):
+	'''
+	Takes list of iterables of column batches, loaded on as many writer threads (each with
+	its own pooled connection) as the pool allows, one connection is kept for creating
+	partitions
+	Returns rows loaded
+	'''
+	sources = list(sources)
+	if not sources:
+		return 0
+	db_pool = db_pool or pool
+	if db_pool is None:
+		raise ValueError('No connection pool, call connect_pool first')
+	if db_pool.maxconn < 2:
+		raise ValueError('load_parallel needs a pool of at least 2 connections')
+
+	def load(source):
+		loader = BulkLoader(table_name, db_pool = db_pool, **loader_args)
+		try:
+			for columns in source:
+				loader.write(columns)
+		finally:
+			loader.close()
+		return loader.rows
+
+	## More sources than connections queue up for a free writer
+	workers = min(len(sources), db_pool.maxconn - 1)
+	with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+		return sum(executor.map(load, sources))
+
+def benchmark(rows = 200000, dbname = DATABASE, table_name = None):
+	'''
+	Rows per second of add_entry_db per-row INSERTs against BulkLoader COPY on a local postgres
+	Loads a scratch table (BENCH_TABLE by default) that is dropped afterwards
+	'''
+	global connection, cursor
+	table_name = table_name or BENCH_TABLE % os.getpid()
+	if table_name == TABLE:
+		raise ValueError('The benchmark drops its table, not running it on ' + TABLE)
+	columns = {
+		'name': numpy.full(rows, 'NYC', dtype = object),
+		'product': numpy.full(rows, 'N1P', dtype = object),
+		'azimuth': numpy.arange(rows, dtype = numpy.int16) % 360,
+		'dist': numpy.arange(rows, dtype = numpy.float32),
+		'lon': numpy.random.uniform(-74, -73, rows),
+		'lat': numpy.random.uniform(40, 41, rows),
+		'observation': numpy.random.uniform(0, 50, rows).astype(numpy.float32),
+		'scan_time': numpy.full(rows, numpy.datetime64('2014-07-03T17:56:00'), dtype = 'datetime64[s]'),
+	}
+	names = [name for name, sql_type in OBSERVATION_COLUMNS]
+
+	connect_db(dbname)
+	try:
+		drop_table(table_name)
+		create_table(table_name)
+		commit_db()
+
+		# per-row path, one INSERT round trip per row
+		per_row = min(rows, 20000)
+		start = time.time()
+		for i in range(per_row):
+			add_entry_db([columns[name][i].item() if hasattr(columns[name][i], 'item')
+					else columns[name][i] for name in names], table_name)
+		commit_db()
+		insert_rate = per_row / (time.time() - start)
+
+		start = time.time()
+		loader = BulkLoader(table_name, conn = connection)
+		loader.write(columns)
+		loader.close()
+		copy_rate = rows / (time.time() - start)
+	finally:
+		connection.rollback()
+		drop_table(table_name)
+		commit_db()
+		close_db()
+
+	print('INSERT per row: %d rows/s' % insert_rate)
+	print('COPY: %d rows/s (%.0fx)' % (copy_rate, copy_rate / insert_rate))
+	return insert_rate, copy_rate
+
+if __name__ == '__main__':
+	benchmark()
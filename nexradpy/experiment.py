@@ -9,7 +9,7 @@ import pandas as pd
 import geopandas as gpd
 from shapely.geometry import Point, box
 
-from context import utils
+from . import utils
 
 
 INDIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'data/raw/temp'))
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+
+
+RAW_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'data', 'raw'))
+CACHE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'data', 'cache', 'gauges'))
+GAUGE_FILES = [os.path.join(RAW_DIR, 'nj_gauges_20102018.csv'), os.path.join(RAW_DIR, 'nyc_gauges_20102018.csv')]
+# station metadata (station, lat, lon), no time column
+METADATA_FILES = [os.path.join(RAW_DIR, 'nj_gauges_metadata.csv'), os.path.join(RAW_DIR, 'nyc_gauges_metadata.csv')]
+
+# IEM ASOS download columns (https://mesonet.agron.iastate.edu/ASOS/), 'M' is missing and
+# 'T' is a trace of precipitation
+STATION_COLUMN = 'station'
+TIME_COLUMN = 'valid'
+DTYPES = {'station': str, 'lon': np.float32, 'lat': np.float32, 'p01i': np.float32}
+MISSING = ['M', '']
+TRACE = 'T'
+TRACE_VALUE = 0.0001
+# csv hashes by absolute path with the (size, mtime) they were computed at, kept in each cache dir
+HASHES_FILE = 'csv_hashes.json'
+
+
+def file_hash(path):
+    '''
+    args: path to a file
+    returns: sha1 hex digest of its contents
+    '''
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def csv_hash(path, cache_dir=CACHE_DIR):
+    '''
+    args: path to a gauge csv, cache directory
+    returns: sha1 hex digest of the csv, only recomputed when its size or mtime changed since
+             it was last hashed
+    '''
+    stat = os.stat(path)
+    key = os.path.abspath(path)
+    hashes_path = os.path.join(cache_dir, HASHES_FILE)
+    hashes = {}
+    if os.path.exists(hashes_path):
+        with open(hashes_path) as f:
+            hashes = json.load(f)
+
+    size, mtime, digest = hashes.get(key, (None, None, None))
+    if (size, mtime) != (stat.st_size, stat.st_mtime_ns):
+        digest = file_hash(path)
+        hashes[key] = (stat.st_size, stat.st_mtime_ns, digest)
+
+        os.makedirs(cache_dir, exist_ok=True)
+        with tempfile.NamedTemporaryFile('w', dir=cache_dir, suffix='.tmp', delete=False) as f:
+            json.dump(hashes, f)
+        os.replace(f.name, hashes_path)
+
+    return digest
+
+
+def cache_path(path, cache_dir=CACHE_DIR):
+    '''
+    args: path to a gauge csv, cache directory
+    returns: path of the csv's cache, keyed on the csv contents so edits invalidate it
+    '''
+    name = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(cache_dir, '%s-%s.parquet' % (name, csv_hash(path, cache_dir)[:16]))
+
+
+def read_csv(path, dtypes=DTYPES, station_column=STATION_COLUMN, time_column=TIME_COLUMN):
+    '''
+    args: path to a gauge csv, dict of column name to dtype (columns missing from the csv are
+          ignored), station and time column names, time_column None for csvs without times
+          like the station metadata
+    returns: DataFrame with explicit dtypes, parsed times, sorted by station and time
+    '''
+    header = pd.read_csv(path, nrows=0).columns
+    if time_column is not None and time_column not in header:
+        raise ValueError('%s has no %s column, pass time_column=None for metadata' % (path, time_column))
+    dtypes = {column: dtype for column, dtype in dtypes.items() if column in header}
+    # numeric columns go through str first so trace values can be mapped
+    numeric = [column for column, dtype in dtypes.items() if dtype is not str]
+
+    frame = pd.read_csv(path, dtype={column: str for column in dtypes}, na_values=MISSING,
+                        keep_default_na=False, parse_dates=[time_column] if time_column is not None else False)
+    for column in numeric:
+        values = frame[column].replace(TRACE, str(TRACE_VALUE))
+        frame[column] = pd.to_numeric(values, errors='coerce').astype(dtypes[column])
+
+    return frame.sort_values(_sort_columns(station_column, time_column)).reset_index(drop=True)
+
+
+def build_cache(path, cache_dir=CACHE_DIR, station_column=STATION_COLUMN, time_column=TIME_COLUMN, **read_args):
+    '''
+    args: path to a gauge csv, cache directory, station and time column names (None for
+          metadata), read_csv args
+    returns: path of the Parquet dataset, partitioned by station and year (station only
+             without a time column) so loads only open the files of the stations and years
+             they ask for
+    '''
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    target = cache_path(path, cache_dir)
+    if os.path.exists(target):
+        return target
+
+    frame = read_csv(path, station_column=station_column, time_column=time_column, **read_args)
+    partition_cols = [station_column]
+    if time_column is not None:
+        frame['year'] = frame[time_column].dt.year.astype(np.int16)
+        partition_cols.append('year')
+
+    # written aside in a directory of its own and moved in place so a half written cache is
+    # never read, if another process got there first its cache is kept
+    building = tempfile.mkdtemp(dir=cache_dir, prefix=os.path.basename(target) + '.building-')
+    try:
+        pq.write_to_dataset(pa.Table.from_pandas(frame, preserve_index=False), building,
+                            partition_cols=partition_cols)
+        os.rename(building, target)
+    except OSError:
+        if not os.path.exists(target):
+            raise
+    finally:
+        shutil.rmtree(building, ignore_errors=True)
+
+    return target
+
+
+def load_gauges(path, stations=None, start=None, end=None, columns=None, cache_dir=CACHE_DIR,
+                station_column=STATION_COLUMN, time_column=TIME_COLUMN, **read_args):
+    '''
+    args: path to a gauge csv, optional list of stations, optional [start, end) time range,
+          optional list of columns, cache directory, station and time column names (None for
+          metadata, which can't take a time range), read_csv args
+    returns: DataFrame of the matching observations sorted by station and time
+    the csv is parsed once into the cache, station and year filters are pushed down to the
+    Parquet partitions so a single gauge query only reads that gauge's files
+    '''
+    import pyarrow.parquet as pq
+
+    dataset = build_cache(path, cache_dir, station_column, time_column, **read_args)
+
+    if stations is not None and len(stations) == 0:
+        raise ValueError('No stations to load')
+    if time_column is None and (start is not None or end is not None):
+        raise ValueError('%s has no time column to take a time range of' % path)
+
+    conditions = []
+    if start is not None:
+        conditions.append(('year', '>=', pd.Timestamp(start).year))
+    if end is not None:
+        conditions.append(('year', '<=', pd.Timestamp(end).year))
+    if stations is not None:
+        filters = [[(station_column, '=', station)] + conditions for station in stations]
+    else:
+        filters = [conditions] if conditions else None
+
+    if columns is not None:
+        columns = list(dict.fromkeys(_sort_columns(station_column, time_column) + list(columns)))
+    frame = pq.ParquetDataset(dataset, filters=filters).read(columns=columns).to_pandas()
+
+    # partition keys come back as categories, the year only serves the pushdown
+    frame[station_column] = frame[station_column].astype(str)
+    frame = frame.drop(columns=[column for column in ['year'] if column in frame])
+    if start is not None:
+        frame = frame[frame[time_column] >= pd.Timestamp(start)]
+    if end is not None:
+        frame = frame[frame[time_column] < pd.Timestamp(end)]
+
+    return frame.sort_values(_sort_columns(station_column, time_column)).reset_index(drop=True)
+
+
+def load_metadata(path, stations=None, columns=None, cache_dir=CACHE_DIR, station_column=STATION_COLUMN, **read_args):
+    '''
+    args: path to a gauge metadata csv (ex. METADATA_FILES), optional lists of stations and
+          columns, cache directory, station column name, read_csv args
+    returns: DataFrame of the stations' metadata sorted by station, cached like load_gauges
+    '''
+    return load_gauges(path, stations=stations, columns=columns, cache_dir=cache_dir,
+                       station_column=station_column, time_column=None, **read_args)
+
+
+def _sort_columns(station_column, time_column):
+    return [station_column] if time_column is None else [station_column, time_column]
+
+
+if __name__ == '__main__':
+    for path in GAUGE_FILES:
+        print(build_cache(path))
+    for path in METADATA_FILES:
+        print(build_cache(path, time_column=None))
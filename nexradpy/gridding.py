@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+
+import hashlib
+import json
+import os
+import numpy as np
+import scipy.sparse
+
+from . import metrics
+
+
+# pyart.map.grid_from_radars defaults for the dist_beam radius of influence and
+# weighting, the weights below reproduce map_gates_to_grid with these parameters
+NB = 1.0
+BSP = 1.0
+MIN_RADIUS = 250.0
+WEIGHTING = 'Barnes2'
+
+# gates expanded at once while building weights, bounds the candidate cell arrays
+GATE_BLOCK = 10000
+
+# GridWeights by weights_key
+_weights_cache = {}
+
+
+class GridWeights:
+    '''
+    Sparse (grid cells x gates) interpolation weights for one radar scan geometry
+    and grid configuration. Gridding a field is a pair of sparse mat-vecs, one for
+    the weighted values and one for the weights of the gates that are included.
+    Only the gates that reach the grid are kept, so a small grid only reads the
+    gates around it.
+    '''
+
+    def __init__(self, matrix, gates, ngates, grid_shape, azimuth, sweep_start, sweep_end):
+        '''
+        args: scipy sparse matrix (cells x kept gates), flat (ray * ngates + gate) index of
+              each kept gate, gates per ray, grid_shape (nz, ny, nx), ray azimuths and sweep
+              start / end ray indexes the weights were built for
+        '''
+        self.matrix = matrix.tocsr()
+        self.gates = np.asarray(gates)
+        self.ngates = int(ngates)
+        self.grid_shape = tuple(grid_shape)
+        self.azimuth = np.asarray(azimuth)
+        self.sweep_start = np.asarray(sweep_start)
+        self.sweep_end = np.asarray(sweep_end)
+
+    @metrics.stage('interpolate')
+    def grid_field(self, radar, field, gatefilter=None):
+        '''
+        args: radar pyart obj, field name (str), optional pyart GateFilter
+        returns: masked array of grid_shape, masked where no included gate is in range
+        '''
+        data = radar.fields[field]['data']
+        excluded = np.ma.getmaskarray(data)
+        if gatefilter is not None:
+            excluded = excluded | gatefilter.gate_excluded
+
+        rays = self.ray_order(radar)[self.gates // self.ngates]
+        gates = self.gates % self.ngates
+        included = ~excluded[rays, gates]
+        values = np.where(included, np.ma.getdata(data)[rays, gates], 0.0)
+
+        # renormalize the weights over the gates that are included in this scan
+        weight_sum = self.matrix.dot(included.astype(np.float64))
+        value_sum = self.matrix.dot(values.astype(np.float64))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            grid = value_sum / weight_sum
+        metrics.count('gates_processed', len(self.gates))
+
+        return np.ma.masked_array(grid, weight_sum == 0).reshape(self.grid_shape)
+
+    def ray_order(self, radar):
+        '''
+        args: radar pyart obj with the same sweeps as the weights
+        returns: index of the radar ray nearest in azimuth to each ray the weights were
+                 built for, within the same sweep
+        '''
+        azimuth = radar.azimuth['data']
+        if len(azimuth) == len(self.azimuth) and np.array_equal(azimuth, self.azimuth):
+            return np.arange(len(azimuth))
+
+        order = np.empty(len(self.azimuth), dtype=int)
+        radar_starts = radar.sweep_start_ray_index['data']
+        radar_ends = radar.sweep_end_ray_index['data']
+        for sweep, (start, end) in enumerate(zip(self.sweep_start, self.sweep_end)):
+            radar_start = radar_starts[sweep]
+            sweep_azimuth = azimuth[radar_start:radar_ends[sweep] + 1]
+            by_azimuth = np.argsort(sweep_azimuth)
+            sorted_azimuth = sweep_azimuth[by_azimuth]
+
+            # nearest neighbour on the circle is either side of the insertion point
+            target = self.azimuth[start:end + 1]
+            after = np.searchsorted(sorted_azimuth, target) % len(sorted_azimuth)
+            before = (after - 1) % len(sorted_azimuth)
+            nearest = np.where(_angle_between(target, sorted_azimuth[before]) <=
+                               _angle_between(target, sorted_azimuth[after]), before, after)
+            order[start:end + 1] = radar_start + by_azimuth[nearest]
+
+        return order
+
+    def save(self, path):
+        '''
+        args: path of an .npz file to write
+        '''
+        scipy.sparse.save_npz(path, self.matrix.tocoo())
+        np.savez(path + '.rays.npz', gates=self.gates, ngates=self.ngates, grid_shape=self.grid_shape,
+                 azimuth=self.azimuth, sweep_start=self.sweep_start, sweep_end=self.sweep_end)
+
+    @classmethod
+    def load(cls, path):
+        '''
+        args: path of an .npz file written by save
+        returns: GridWeights
+        '''
+        rays = np.load(path + '.rays.npz')
+        return cls(scipy.sparse.load_npz(path), rays['gates'], rays['ngates'], rays['grid_shape'],
+                   rays['azimuth'], rays['sweep_start'], rays['sweep_end'])
+
+
+@metrics.stage('weights')
+def build_grid_weights(radar, grid_shape, grid_limits, nb=NB, bsp=BSP, min_radius=MIN_RADIUS,
+                       weighting=WEIGHTING):
+    '''
+    args: radar pyart obj, grid_shape (nz, ny, nx), grid_limits ((z0, z1), (y0, y1), (x0, x1))
+          in meters from the radar, dist_beam radius of influence parameters, weighting
+          ('Barnes2', 'Barnes' or 'Cressman')
+    returns: GridWeights
+    follows pyart.map.map_gates_to_grid for a single radar with the grid origin on it:
+    every gate spreads to the cells within its radius of influence
+    '''
+    gate_z = (radar.gate_altitude['data'] - radar.altitude['data'][0]).ravel().astype(np.float32)
+    gate_y = radar.gate_y['data'].ravel().astype(np.float32)
+    gate_x = radar.gate_x['data'].ravel().astype(np.float32)
+
+    roi = np.sqrt(gate_x**2 + gate_y**2 + gate_z**2) * np.tan(np.radians(nb * bsp))
+    roi = np.maximum(roi, min_radius)
+
+    # gate positions relative to the first grid point, per axis (z, y, x), in float32 like pyart
+    coords = [gate_z - grid_limits[0][0], gate_y - grid_limits[1][0], gate_x - grid_limits[2][0]]
+    steps = [(limits[1] - limits[0]) / (n - 1.0) if n > 1 else 0.0 for limits, n in zip(grid_limits, grid_shape)]
+
+    # index range of the cells each gate could reach, as pyart's find_min / find_max
+    lows = []
+    spans = []
+    for coord, step, n in zip(coords, steps, grid_shape):
+        if step == 0:
+            low = np.zeros(len(coord), dtype=int)
+            high = np.zeros(len(coord), dtype=int)
+        else:
+            low = np.maximum(np.ceil((coord - roi) / step), 0).astype(int)
+            high = np.minimum(np.floor((coord + roi) / step), n - 1).astype(int)
+        lows.append(low)
+        spans.append(np.maximum(high - low + 1, 0))
+
+    reaches = (spans[0] > 0) & (spans[1] > 0) & (spans[2] > 0)
+
+    rows = []
+    cols = []
+    weights = []
+    gates = np.flatnonzero(reaches)
+    for block in range(0, len(gates), GATE_BLOCK):
+        block_gates = gates[block:block + GATE_BLOCK]
+        nz, ny, nx = [span[block_gates] for span in spans]
+        counts = nz * ny * nx
+
+        # one entry per (gate, candidate cell)
+        gate_of = np.repeat(np.arange(len(block_gates)), counts)
+        local = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        xi = local % nx[gate_of]
+        local //= nx[gate_of]
+        yi = local % ny[gate_of]
+        zi = local // ny[gate_of]
+
+        cell_index = []
+        dist2 = 0.0
+        for axis, offset in enumerate((zi, yi, xi)):
+            index = lows[axis][block_gates][gate_of] + offset
+            cell_index.append(index)
+            dist2 = dist2 + (steps[axis] * index - coords[axis][block_gates][gate_of])**2
+
+        roi2 = roi[block_gates][gate_of]**2
+        near = dist2 <= roi2
+        dist2 = dist2[near]
+        roi2 = roi2[near]
+
+        if weighting == 'Barnes2':
+            weight = np.exp(-dist2 / (roi2 / 4)) + 1e-5
+        elif weighting == 'Barnes':
+            weight = np.exp(-dist2 / (2 * roi2)) + 1e-5
+        elif weighting == 'Cressman':
+            weight = (roi2 - dist2) / (roi2 + dist2)
+        else:
+            raise ValueError('Unsupported weighting: %s' % weighting)
+
+        rows.append(np.ravel_multi_index([index[near] for index in cell_index], grid_shape))
+        cols.append(block + gate_of[near])
+        weights.append(weight)
+
+    if rows:
+        rows, cols, weights = np.concatenate(rows), np.concatenate(cols), np.concatenate(weights)
+    # columns index gates, the gates whose radius of influence misses the grid are left out
+    matrix = scipy.sparse.coo_matrix((weights, (rows, cols)),
+                                     shape=(int(np.prod(grid_shape)), len(gates)))
+
+    return GridWeights(matrix, gates, radar.ngates, grid_shape, radar.azimuth['data'],
+                       radar.sweep_start_ray_index['data'], radar.sweep_end_ray_index['data'])
+
+
+def weights_key(radar, grid_shape, grid_limits, **params):
+    '''
+    args: radar pyart obj, grid_shape, grid_limits, build_grid_weights parameters
+    returns: str identifying station, VCP, scan geometry and grid configuration
+    '''
+    geometry = [radar.metadata.get('instrument_name', ''), str(radar.metadata.get('vcp_pattern', '')),
+                [round(float(angle), 1) for angle in radar.fixed_angle['data']],
+                radar.ngates, float(radar.range['data'][0]), float(radar.range['data'][-1]),
+                round(float(radar.latitude['data'][0]), 6), round(float(radar.longitude['data'][0]), 6)]
+    grid = [list(grid_shape), [list(map(float, limits)) for limits in grid_limits]]
+
+    return json.dumps([geometry, grid, sorted(params.items())])
+
+
+def get_grid_weights(radar, grid_shape, grid_limits, cache_dir=None, **params):
+    '''
+    args: radar pyart obj, grid_shape, grid_limits, optional directory to persist weights in,
+          build_grid_weights parameters
+    returns: GridWeights, built once per station, VCP and grid configuration
+    '''
+    key = weights_key(radar, grid_shape, grid_limits, **params)
+    if key in _weights_cache:
+        return _weights_cache[key]
+
+    path = None
+    if cache_dir is not None:
+        path = os.path.join(cache_dir, hashlib.sha1(key.encode()).hexdigest() + '.npz')
+
+    if path is not None and os.path.exists(path):
+        weights = GridWeights.load(path)
+    else:
+        weights = build_grid_weights(radar, grid_shape, grid_limits, **params)
+        if path is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            weights.save(path)
+
+    _weights_cache[key] = weights
+    return weights
+
+
+@metrics.stage('grid')
+def grid_from_radar(radar, grid_shape, grid_limits, fields, gatefilter=None, cache_dir=None, **params):
+    '''
+    args: radar pyart obj, grid_shape, grid_limits, list of fields (strs), optional pyart
+          GateFilter, optional directory to persist weights in, build_grid_weights parameters
+    returns: grid pyart obj, as pyart.map.grid_from_radars((radar,), ...) would
+    '''
+    # pyart is only needed to wrap the result, the weights work on any radar like object
+    import pyart
+
+    weights = get_grid_weights(radar, grid_shape, grid_limits, cache_dir=cache_dir, **params)
+
+    grid_fields = {}
+    for field in fields:
+        grid_fields[field] = dict(radar.fields[field])
+        grid_fields[field]['data'] = weights.grid_field(radar, field, gatefilter)
+
+    get_metadata = pyart.config.get_metadata
+    time = get_metadata('grid_time')
+    time['data'] = np.array([radar.time['data'][0]])
+    time['units'] = radar.time['units']
+
+    axes = []
+    for name, limits, n in zip(('z', 'y', 'x'), grid_limits, grid_shape):
+        axis = get_metadata(name)
+        axis['data'] = np.linspace(limits[0], limits[1], n)
+        axes.append(axis)
+
+    origin_latitude = get_metadata('origin_latitude')
+    origin_latitude['data'] = radar.latitude['data'][:1]
+    origin_longitude = get_metadata('origin_longitude')
+    origin_longitude['data'] = radar.longitude['data'][:1]
+    origin_altitude = get_metadata('origin_altitude')
+    origin_altitude['data'] = radar.altitude['data'][:1]
+
+    z, y, x = axes
+    return pyart.core.Grid(time, grid_fields, dict(radar.metadata), origin_latitude, origin_longitude,
+                           origin_altitude, x, y, z)
+
+
+def _angle_between(a, b):
+    '''
+    returns: absolute difference of angles in degrees, wrapped to [0, 180]
+    '''
+    return np.abs((a - b + 180.0) % 360.0 - 180.0)
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+
+EARTH_RADIUS = 6371000.0
+# gauge observations (IEM ASOS p01i) are the precipitation of the hour ending at valid
+GAUGE_WINDOW = pd.Timedelta(hours=1)
+# scans read from the radar values at once by training_set
+SCAN_CHUNK = 64
+
+# PointLocators by geometry key
+_locators = {}
+
+
+class PointLocator:
+    '''
+    KD-tree over the gates or grid cells of one station geometry. Points are placed on
+    the unit sphere so chord distances order like great circle distances everywhere.
+    '''
+
+    def __init__(self, lats, lons):
+        '''
+        args: arrays of point latitudes and longitudes in degrees, any shape
+        '''
+        self.shape = np.shape(lats)
+        self.tree = cKDTree(_unit_xyz(np.ravel(lats), np.ravel(lons)))
+
+    def query(self, lats, lons, k=1):
+        '''
+        args: arrays of query latitudes and longitudes, number of nearest points
+        returns: tuple of (distances in meters, flat point indexes), shaped (n,) or (n, k)
+        '''
+        chord, index = self.tree.query(_unit_xyz(np.asarray(lats), np.asarray(lons)), k=k)
+        return 2 * EARTH_RADIUS * np.arcsin(np.minimum(chord / 2, 1.0)), index
+
+
+def get_locator(key, lats, lons):
+    '''
+    args: hashable key of the geometry (ex. station, product and resolution or a cube path),
+          point latitudes and longitudes
+    returns: PointLocator, built once per key
+    '''
+    if key not in _locators:
+        _locators[key] = PointLocator(lats, lons)
+    return _locators[key]
+
+
+def nearest_points(gauges, locator, k=1, max_distance=None, name_column='station'):
+    '''
+    args: gauge metadata DataFrame (name, lat, lon), PointLocator, number of nearest points,
+          optional distance in meters beyond which matches are dropped, gauge name column
+    returns: DataFrame of gauge name, point (flat index into the locator's points) and distance,
+             k rows per gauge
+    '''
+    distance, index = locator.query(gauges['lat'].values, gauges['lon'].values, k=k)
+    matches = pd.DataFrame({name_column: np.repeat(gauges[name_column].values, k),
+                            'point': np.ravel(index), 'distance': np.ravel(distance)},
+                           columns=[name_column, 'point', 'distance'])
+    if max_distance is not None:
+        matches = matches[matches['distance'] <= max_distance]
+    return matches.reset_index(drop=True)
+
+
+def match_scans(observations, scan_times, window=GAUGE_WINDOW, time_column='valid'):
+    '''
+    args: gauge observations DataFrame, scan times (datetime64 array-like), window ending at
+          each observation's time
+    returns: DataFrame of the observations repeated once per scan in (time - window, time],
+             with scan (index into scan_times) and scan_time columns
+    the scan times are sorted once and every window is two binary searches, so the pairs
+    come from one sorted merge rather than a loop over hours
+    '''
+    scan_times = np.asarray(scan_times, dtype='datetime64[ns]')
+    order = np.argsort(scan_times, kind='mergesort')
+    sorted_times = scan_times[order]
+
+    ends = observations[time_column].values.astype('datetime64[ns]')
+    first = np.searchsorted(sorted_times, ends - np.timedelta64(window), side='right')
+    last = np.searchsorted(sorted_times, ends, side='right')
+    counts = last - first
+
+    rows = np.repeat(np.arange(len(observations)), counts)
+    positions = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(first, counts)
+
+    matched = observations.iloc[rows].reset_index(drop=True)
+    matched['scan'] = order[positions]
+    matched['scan_time'] = sorted_times[positions]
+    return matched
+
+
+def latest_scan(observations, scan_times, tolerance=GAUGE_WINDOW, time_column='valid'):
+    '''
+    args: gauge observations DataFrame, scan times, how far back a scan may be
+    returns: observations with the scan (index into scan_times) and scan_time of the last scan
+             at or before each observation, NaN / NaT where there is none within tolerance
+    '''
+    scans = pd.DataFrame({'scan_time': np.asarray(scan_times, dtype='datetime64[ns]')})
+    scans['scan'] = np.arange(len(scans))
+    scans = scans.sort_values('scan_time')
+
+    observations = observations.assign(_order=np.arange(len(observations)),
+                                       _time=observations[time_column].values.astype('datetime64[ns]'))
+    matched = pd.merge_asof(observations.sort_values('_time'), scans, left_on='_time', right_on='scan_time',
+                            direction='backward', tolerance=tolerance)
+    return matched.sort_values('_order').drop(columns=['_order', '_time']).reset_index(drop=True)
+
+
+def training_set(gauges, observations, scan_times, values, locator, k=1, window=GAUGE_WINDOW,
+                 value_column='p01i', time_column='valid', name_column='station', scan_chunk=SCAN_CHUNK):
+    '''
+    args: gauge metadata DataFrame (name, lat, lon), gauge observations DataFrame (name,
+          time, value), scan times, (time, points...) array of radar values for those scans
+          (ex. a GridCube field), PointLocator over the points, nearest points per gauge, window,
+          column names, scans read at a time
+    returns: DataFrame of one row per gauge observation with scans, with the radar value
+             averaged over the scans in its window and the k nearest points, and the number of
+             scans it covers
+    '''
+    cells = nearest_points(gauges, locator, k=k, name_column=name_column)
+    observations = observations[[name_column, time_column, value_column]].assign(row=np.arange(len(observations)))
+    pairs = match_scans(observations, scan_times, window, time_column)
+    pairs = pairs.merge(cells[[name_column, 'point']], on=name_column)
+
+    # only the matched points of the matched scans are read, a chunk of scans at a time
+    scans, scan_rows = np.unique(pairs['scan'].values, return_inverse=True)
+    points, point_columns = np.unique(pairs['point'].values, return_inverse=True)
+    block = np.empty((len(scans), len(points)))
+    for start in range(0, len(scans), scan_chunk):
+        block[start:start + scan_chunk] = _read_points(values, scans[start:start + scan_chunk],
+                                                       points, locator.shape)
+    pairs['radar'] = block[scan_rows, point_columns]
+
+    # average the points of each scan, then the scans of each observation
+    per_scan = pairs.groupby(['row', 'scan'])['radar'].mean()
+    radar = per_scan.groupby(level='row').agg(['mean', 'count'])
+
+    result = pairs.drop_duplicates('row').set_index('row')[[name_column, time_column, value_column]]
+    result = result.loc[radar.index]
+    result['radar'] = radar['mean'].values
+    result['scans'] = radar['count'].values
+    return result.reset_index(drop=True)
+
+
+def _read_points(values, scans, points, shape):
+    '''
+    args: (time, points...) array or netCDF4 variable, sorted scan indexes, sorted flat point
+          indexes, shape of the points
+    returns: (scans, points) float array, masked values are NaN
+    the box spanned by the points along each axis is read, netCDF4 variables index each axis
+    on its own while numpy arrays need np.ix_ for the same
+    '''
+    axes = [np.unique(index, return_inverse=True) for index in np.unravel_index(points, shape)]
+    box = (scans,) + tuple(unique for unique, inverse in axes)
+    box = values[np.ix_(*box)] if isinstance(values, np.ndarray) else values[box]
+    box = np.ma.filled(np.ma.asarray(box, dtype=float), np.nan)
+    return box[(slice(None),) + tuple(inverse for unique, inverse in axes)]
+
+
+def _unit_xyz(lats, lons):
+    '''
+    returns: (n, 3) array of points on the unit sphere
+    '''
+    lats = np.radians(lats)
+    lons = np.radians(lons)
+    cos_lats = np.cos(lats)
+    return np.column_stack([cos_lats * np.cos(lons), cos_lats * np.sin(lons), np.sin(lats)])
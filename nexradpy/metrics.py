@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+
+import bisect
+import functools
+import json
+import os
+import threading
+import time
+
+
+# collection is off unless turned on here or with enable(), a disabled stage is one
+# attribute check per call
+ENABLED = os.environ.get('NEXRADPY_METRICS', '') not in ('', '0')
+PREFIX = 'nexradpy'
+# upper bounds of the stage latency buckets in seconds, like Prometheus' default buckets
+# stretched out to the minutes a volume download or decode can take
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+SEPARATOR = '/'
+
+_lock = threading.Lock()
+_local = threading.local()
+# counter name to total
+_counters = {}
+# stage path to Histogram
+_histograms = {}
+
+
+class Histogram:
+    '''
+    Latency histogram of one stage, bucket counts plus the count, sum, min and max of
+    every observation.
+    '''
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        # the last count is for observations above the largest bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = float('inf')
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+
+    def snapshot(self):
+        '''
+        returns: dict of count, sum, min, max, mean and the per bucket counts keyed by upper bound
+        '''
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'min': self.min if self.count else 0.0,
+            'max': self.max,
+            'mean': self.sum / self.count if self.count else 0.0,
+            'buckets': dict(zip([str(bound) for bound in self.buckets] + ['+Inf'], self.counts)),
+        }
+
+
+class stage:
+    '''
+    Times a block (with stage('download'):) or every call of a function (@stage('grid'))
+    into the histogram of the stage's path. Stages opened while another is running on the
+    same thread nest under it, so 'interpolate' inside 'grid' is recorded as 'grid/interpolate'.
+    Worker threads start their own nesting and worker processes keep their own totals.
+    '''
+
+    def __init__(self, name):
+        self.name = name
+        self.path = None
+        self.start = None
+
+    def __enter__(self):
+        if not ENABLED:
+            return self
+        stack = _stack()
+        self.path = stack[-1] + SEPARATOR + self.name if stack else self.name
+        stack.append(self.path)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.start is None:
+            return False
+        elapsed = time.perf_counter() - self.start
+        _stack().pop()
+        observe(self.path, elapsed)
+        self.start = None
+        return False
+
+    def __call__(self, f):
+        name = self.name
+
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return f(*args, **kwargs)
+            with stage(name):
+                return f(*args, **kwargs)
+        return wrapper
+
+
+def enable():
+    global ENABLED
+    ENABLED = True
+
+
+def disable():
+    global ENABLED
+    ENABLED = False
+
+
+def enabled():
+    return ENABLED
+
+
+def count(name, value=1):
+    '''
+    args: counter name (ex. 'bytes_downloaded'), amount to add
+    '''
+    if not ENABLED:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def observe(path, seconds):
+    '''
+    args: stage path, seconds it took, for timings taken outside of a stage
+    '''
+    if not ENABLED:
+        return
+    with _lock:
+        if path not in _histograms:
+            _histograms[path] = Histogram()
+        _histograms[path].observe(seconds)
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+
+def snapshot():
+    '''
+    returns: dict of 'counters' (name to total) and 'stages' (path to Histogram.snapshot)
+    '''
+    with _lock:
+        return {
+            'counters': dict(_counters),
+            'stages': {path: histogram.snapshot() for path, histogram in _histograms.items()},
+        }
+
+
+def to_json(path=None):
+    '''
+    args: optional path to write the snapshot to
+    returns: the snapshot as a JSON str
+    '''
+    text = json.dumps(snapshot(), indent=2, sort_keys=True)
+    if path is not None:
+        _write(path, text)
+    return text
+
+
+def to_prometheus(path=None):
+    '''
+    args: optional path to write the snapshot to (ex. for the node exporter textfile collector)
+    returns: the snapshot in the Prometheus text exposition format, counters as
+             PREFIX_<name>_total and stages as the PREFIX_stage_seconds histogram
+    '''
+    current = snapshot()
+    lines = []
+    for name, total in sorted(current['counters'].items()):
+        metric = '%s_%s_total' % (PREFIX, name)
+        lines.append('# TYPE %s counter' % metric)
+        lines.append('%s %s' % (metric, total))
+
+    if current['stages']:
+        metric = '%s_stage_seconds' % PREFIX
+        lines.append('# TYPE %s histogram' % metric)
+    for stage_path, histogram in sorted(current['stages'].items()):
+        label = 'stage="%s"' % stage_path.replace('\\', '\\\\').replace('"', '\\"')
+        cumulative = 0
+        # Prometheus buckets count every observation at or below their bound
+        for bound, bucket_count in histogram['buckets'].items():
+            cumulative += bucket_count
+            lines.append('%s_bucket{%s,le="%s"} %d' % (metric, label, bound, cumulative))
+        lines.append('%s_sum{%s} %r' % (metric, label, histogram['sum']))
+        lines.append('%s_count{%s} %d' % (metric, label, histogram['count']))
+
+    text = '\n'.join(lines) + '\n'
+    if path is not None:
+        _write(path, text)
+    return text
+
+
+def _stack():
+    '''
+    returns: list of the stage paths open on this thread
+    '''
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+def _write(path, text):
+    # written aside and moved in place so a scraper never reads half a snapshot
+    with open(path + '.tmp', 'w') as f:
+        f.write(text)
+    os.replace(path + '.tmp', path)
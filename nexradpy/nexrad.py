@@ -1,169 +1,469 @@
-import pyart
-import os
-import math
-
-OUTFILE = '/Users/clancygreen/Dropbox/Uber/Data/Precipitation/sample3.csv'
-BASE = '/Users/clancygreen/Dropbox/Uber/Data/Precipitation/Sample NEXRAD Level 3 Files/'
-INDIRS = ['NWS_NEXRAD_NXL3_KOKX_20140703000000_20140703235959',
-		  'NWS_NEXRAD_NXL3_KOKX_20140516000000_20140516235959',
-		  'NWS_NEXRAD_NXL3_KOKX_20140715000000_20140715235959']
-
-
-## DAA: One hour precip (.13 nm x 1 deg)
-## N1P: One hour precip (1.1 nm x 1 deg)
-## Three hour precip (1.1 nm x 1 deg)
-## DTA: Storm total (.13 x 1 deg)\
-## OHA: One hour precip (1.1 x 1 deg)
-## Differential reflectivity (vertical / horizontal radar pulse diff)
-## NAR: Base reflectivity
-## N1R: Base reflectivity
-## NBR: Base reflectivity
-## N2R: Base reflectivity
-## NOQ: Digital base reflectivity
-## NAQ: Digital base reflectivity
-## N1Q: Digital base reflectivity
-## NBQ: Digital base reflectivity
-## N2Q: Digital base reflectivity
-## -- Vary the elevation angle 
-PRODUCTS = ['DAA','N1P','N3P','DTA','OHA','N0R','NAR','N1R','NBR','N2R','NOQ','NAQ','N1Q','NBQ','N2Q']
-OVERWRITE = False
-
-NYC = {
-	'name': 'NYC',
-	'a_s': 264,
-	'a_e': 266,
-	'd_s': 91250,
-	'd_e': 95500
-}
-
-LGA = {
-	'name': 'LGA',
-	'a_s': 263,
-	'a_e': 265,
-	'd_s': 84500,
-	'd_e': 87500
-}
-
-JFK = {
-	'name': 'JFK',
-	'a_s': 251,
-	'a_e': 253,
-	'd_s': 78250,
-	'd_e': 81500
-}
-
-STATS = [NYC, LGA, JFK]
-
-
-def get_days(folder):
-	'''Takes folder holding lvl. 3 day folders
-	To return list of day folders'''
-	days = []
-	for (dirpath, dirnames, filenames) in os.walk(folder):
-		continue
-
-def file_list(folder, product):
-	'''Takes folder and product code
-	Returns all files in folder matching given product code'''
-	files = []
-	for (dirpath, dirnames, filenames) in os.walk(folder):
-		files.extend(filenames) ## Extend is in place whereas + creates new list
-	
-	## Filter files based on product code
-	files = filter(lambda x: product in x, files)
-	
-	return files
-
-
-def get_time(filename):
-	'''Takes filename from filelist
-	Returns (hour, minute)
-	To be called in add_sample'''
-	month = filename[-8:-6]
-	day = filename[-6:-4]
-	hour = filename[-4:-2]
-	minute = filename[-2:]
-	
-	## Replace with dict for legibility and forcing deliberate unpacking
-	return (month, day, hour, minute)
-
-
-def flatten(outfile, infile, stat, prod):
-	'''Takes outfile name (global) and infile name (from file_list)
-	Writes rainfall from infile to outfile
-	NOTE: Does not handle opening / closing outfile!'''	
-	# print infile
-	try:
-		radar = pyart.io.nexradl3_read.read_nexrad_level3(infile)
-	except IOError:
-		print 'No such file'
-	except NotImplementedError:
-		print 'Product' + prod + ' not implemented'
-
-	## Azimuth start and end indices (also degrees)
-	## --based on ad hoc trig calcs (EPSG 2263)
-	a_s = stat['a_s']
-	a_e = stat['a_e']
-
-	## Range start and end indices (multiples of distance in m)
-	## --based on ad hoc distance calcs (EPSG 2263)
-	meters_between = int(radar.range['meters_between_gates'])
-	r_s = int(math.floor(stat['d_s']/meters_between))
-	r_e = int(math.ceil(stat['d_e']/meters_between))
-
-	## Looking a little like spaghetti
-	for i in range(len(radar.gate_longitude['data'][a_s:a_e])):
-		for j in range(len(radar.gate_longitude['data'][a_s:a_e][i][r_s:r_e])):
-			
-			## Get radar measurements
-			ray_angle = i + a_s ## Equal to the azimuth angle
-			gate_dist = radar.range['data'][r_s:r_e][j] ## One dim array (meters)
-			lon = radar.gate_longitude['data'][a_s:a_e][i][r_s:r_e][j]
-			lat = radar.gate_latitude['data'][a_s:a_e][i][r_s:r_e][j]
-
-			try:
-				ref = radar.fields['radar_estimated_rain_rate']['data'][a_s:a_e][i][r_s:r_e][j]
-			except KeyError:
-				ref = radar.fields['reflectivity']['data'][a_s:a_e][i][r_s:r_e][j]
-
-			## Get time 
-			mnth = get_time(infile)[0]
-			day = get_time(infile)[1]
-			hr = get_time(infile)[2]
-			mnt = get_time(infile)[3]
-			
-			## Maybe also re-write to return values, but not write out
-			## Re-write to avoid manual ordering!
-			values = (stat['name'],prod,ray_angle, gate_dist, lon, lat, ref, mnth, day, hr, mnt)
-			outfile.write('%s,%s,%d,%d,%s,%s,%s,%s,%s,%s,%s\r\n' % values)
-
-
-def main():
-	if OVERWRITE:
-		try:
-			print 'Re-writing...'
-			os.remove(OUTFILE)
-		except OSError:
-			print 'No existing file. Starting from scratch...'
-			return
-
-	## Append days
-	out = open(OUTFILE, 'a')
-	## Avoid manual ordering!
-	out.write('name,product,azimuth,dist,lon,lat,observation,month,day,hour,minute\r\n') 
-
-	## To be replaced with iterable from get_days()
-	abs_dirs = [BASE + d for d in INDIRS]
-
-	for d in abs_dirs:
-		print 'flattening ', d, "..."
-		for s in STATS:
-			print '-----------------------------' + s['name'] + '--------------------------------'
-			for p in PRODUCTS:
-				print p
-				for f in file_list(d, p):
-					flatten(out, d + '/' + f, s, p)
-		
-	out.close()
-
-main()
\ No newline at end of file
+import collections
+import concurrent.futures
+import csv
+import datetime
+import math
+import os
+
+import numpy as np
+import pyproj
+
+from . import metrics
+from .metadata import STATION_INDEX
+
+OUTFILE = '/Users/clancygreen/Dropbox/Uber/Data/Precipitation/sample3.parquet'
+BASE = '/Users/clancygreen/Dropbox/Uber/Data/Precipitation/Sample NEXRAD Level 3 Files/'
+INDIRS = ['NWS_NEXRAD_NXL3_KOKX_20140703000000_20140703235959',
+		  'NWS_NEXRAD_NXL3_KOKX_20140516000000_20140516235959',
+		  'NWS_NEXRAD_NXL3_KOKX_20140715000000_20140715235959']
+
+
+## DAA: One hour precip (.13 nm x 1 deg)
+## N1P: One hour precip (1.1 nm x 1 deg)
+## Three hour precip (1.1 nm x 1 deg)
+## DTA: Storm total (.13 x 1 deg)\
+## OHA: One hour precip (1.1 x 1 deg)
+## Differential reflectivity (vertical / horizontal radar pulse diff)
+## NAR: Base reflectivity
+## N1R: Base reflectivity
+## NBR: Base reflectivity
+## N2R: Base reflectivity
+## NOQ: Digital base reflectivity
+## NAQ: Digital base reflectivity
+## N1Q: Digital base reflectivity
+## NBQ: Digital base reflectivity
+## N2Q: Digital base reflectivity
+## -- Vary the elevation angle 
+PRODUCTS = ['DAA','N1P','N3P','DTA','OHA','N0R','NAR','N1R','NBR','N2R','NOQ','NAQ','N1Q','NBQ','N2Q']
+OVERWRITE = False
+
+## Output columns, in order, and their numpy types
+COLUMNS = [('name', object), ('product', object), ('azimuth', np.int16), ('dist', np.float32),
+		   ('lon', np.float64), ('lat', np.float64), ('observation', np.float32),
+		   ('month', np.int8), ('day', np.int8), ('hour', np.int8), ('minute', np.int8),
+		   ('scan_time', 'datetime64[s]')]
+## Rows buffered before a batch is written out
+BATCH_ROWS = 100000
+## Worker processes for extraction, None for one per cpu, 1 to extract in this process
+PROCESSES = None
+## Files in flight per worker, bounds the extracted batches held in memory
+QUEUE_DEPTH = 4
+
+NYC = {
+	'name': 'NYC',
+	'a_s': 264,
+	'a_e': 266,
+	'd_s': 91250,
+	'd_e': 95500
+}
+
+LGA = {
+	'name': 'LGA',
+	'a_s': 263,
+	'a_e': 265,
+	'd_s': 84500,
+	'd_e': 87500
+}
+
+JFK = {
+	'name': 'JFK',
+	'a_s': 251,
+	'a_e': 253,
+	'd_s': 78250,
+	'd_e': 81500
+}
+
+STATS = [NYC, LGA, JFK]
+
+## Half widths of the window around a gauge, about the size of the hand made windows above
+AZIMUTH_BUFFER = 1.0
+RANGE_BUFFER = 2250
+
+GEOD = pyproj.Geod(ellps='WGS84')
+
+## Gauge windows by (station, meters between gates, gauge points)
+_window_cache = {}
+
+
+def get_days(folder):
+	'''Takes folder holding lvl. 3 day folders
+	To return list of day folders'''
+	days = []
+	for (dirpath, dirnames, filenames) in os.walk(folder):
+		continue
+
+def file_list(folder, product):
+	'''Takes folder and product code
+	Returns paths of all files in folder matching given product code'''
+	return [path for timestamp, path in index_files(folder, [product]).get(product, [])]
+
+
+def product_code(filename, products=PRODUCTS):
+	'''Takes filename and product codes to look for
+	Returns product code of the file or None
+	NCDC names look like KOKX_SDUS51_N1PKOKX_201407031756, the code leads the third part'''
+	parts = filename.split('_')
+	if len(parts) >= 3 and parts[2][:3] in products:
+		return parts[2][:3]
+
+	## Other names, first product code found in the name
+	for product in products:
+		if product in filename:
+			return product
+	return None
+
+
+def index_files(folder, products=PRODUCTS):
+	'''Takes folder and product codes
+	Returns dict of product code to [(timestamp, path)] sorted by timestamp
+	Walks the folder once for all products'''
+	index = {}
+	for (dirpath, dirnames, filenames) in os.walk(folder):
+		for filename in filenames:
+			product = product_code(filename, products)
+			if product is not None:
+				index.setdefault(product, []).append((filename[-12:], os.path.join(dirpath, filename)))
+
+	for files in index.values():
+		files.sort()
+	return index
+
+
+def get_time(filename):
+	'''Takes filename from filelist
+	Returns (month, day, hour, minute)
+	To be called once per file'''
+	month = filename[-8:-6]
+	day = filename[-6:-4]
+	hour = filename[-4:-2]
+	minute = filename[-2:]
+	
+	## Replace with dict for legibility and forcing deliberate unpacking
+	return (month, day, hour, minute)
+
+
+def get_scan_time(filename):
+	'''Takes filename from filelist
+	Returns numpy datetime64 of the YYYYMMDDHHMM suffix, NaT if there isn't one'''
+	try:
+		return np.datetime64(datetime.datetime.strptime(filename[-12:], '%Y%m%d%H%M'), 's')
+	except ValueError:
+		return np.datetime64('NaT', 's')
+
+
+def extract(radar, infile, stat, prod):
+	'''Takes radar (pyart obj), infile name (from index_files), stat and product code
+	Returns dict of COLUMNS for every gate in the stat's azimuth / range window
+	The window is sliced once and the columns are built by broadcasting'''
+
+	## Range start and end indices (multiples of distance in m)
+	## --based on ad hoc distance calcs (EPSG 2263), gauge_windows has them already
+	meters_between = int(radar.range['meters_between_gates'])
+	if stat.get('meters_between') == meters_between:
+		r_s = stat['r_s']
+		r_e = stat['r_e']
+	else:
+		r_s = int(math.floor(stat['d_s']/meters_between))
+		r_e = int(math.ceil(stat['d_e']/meters_between))
+
+	## Rays of the window: picked by azimuth for gauge windows (see resolve_stats), else
+	## ray indices (also degrees) based on ad hoc trig calcs (EPSG 2263), windows across
+	## north wrap around, others are plain slices
+	if 'rays' in stat:
+		rays = stat['rays']
+	elif stat['a_s'] < 0 or stat['a_e'] > radar.nrays:
+		rays = np.arange(stat['a_s'], stat['a_e']) % radar.nrays
+	else:
+		rays = slice(stat['a_s'], stat['a_e'])
+
+	if 'radar_estimated_rain_rate' in radar.fields:
+		field = radar.fields['radar_estimated_rain_rate']['data']
+	else:
+		field = radar.fields['reflectivity']['data']
+
+	## Window as (rays, gates), gates past the end of the scan are dropped
+	## just like the slices in the loop version
+	lon = radar.gate_longitude['data'][rays, r_s:r_e]
+	lat = radar.gate_latitude['data'][rays, r_s:r_e]
+	obs = np.ma.masked_invalid(field[rays, r_s:r_e])
+	shape = lon.shape
+	rows = lon.size
+
+	## Azimuth of each ray to the nearest degree, scans don't start at north
+	ray_angle = (np.round(radar.azimuth['data'][rays]) % 360).astype(np.int16)
+	gate_dist = radar.range['data'][r_s:r_s + shape[1]]
+	month, day, hour, minute = get_time(infile)
+
+	return {
+		'name': np.full(rows, stat['name'], dtype=object),
+		'product': np.full(rows, prod, dtype=object),
+		'azimuth': np.broadcast_to(ray_angle[:, None], shape).ravel(),
+		'dist': np.broadcast_to(gate_dist[None, :], shape).ravel().astype(np.float32),
+		'lon': lon.ravel().astype(np.float64),
+		'lat': lat.ravel().astype(np.float64),
+		'observation': obs.ravel().astype(np.float32),
+		'month': np.full(rows, int(month), dtype=np.int8),
+		'day': np.full(rows, int(day), dtype=np.int8),
+		'hour': np.full(rows, int(hour), dtype=np.int8),
+		'minute': np.full(rows, int(minute), dtype=np.int8),
+		'scan_time': np.full(rows, get_scan_time(infile), dtype='datetime64[s]'),
+	}
+
+
+def gauge_points(path, station_id, name_column='station', lat_column='lat', lon_column='lon'):
+	'''Takes gauge metadata csv (ex. data/raw/nyc_gauges_metadata.csv), radar station id
+	(from metadata.STATION_INDEX) and the csv's name / lat / lon column names
+	Returns list of gauge points for gauge_windows'''
+	with open(path) as f:
+		return [{'name': row[name_column], 'station': station_id,
+				 'lat': float(row[lat_column]), 'lon': float(row[lon_column])}
+				for row in csv.DictReader(f)]
+
+
+def gauge_windows(points, meters_between):
+	'''Takes list of gauge points (from gauge_points) and meters between gates
+	Returns list of windows with the gauge's 'azimuth' in degrees from north and the gate
+	range 'r_s' / 'r_e' for that resolution, resolve_stats picks the rays of each scan
+	Azimuth and distance of all gauges come from one vectorized geodesic inverse per
+	station and the windows are cached per (station, resolution), so they are
+	computed once for all the files of a product'''
+	key = (int(meters_between), tuple((p['station'], p['name'], p['lat'], p['lon']) for p in points))
+	if key in _window_cache:
+		return _window_cache[key]
+
+	locations = {station['station_id']: station for station in STATION_INDEX}
+	windows = [None] * len(points)
+	for station_id in set(p['station'] for p in points):
+		which = [i for i, p in enumerate(points) if p['station'] == station_id]
+		station = locations[station_id]
+		lats = np.array([points[i]['lat'] for i in which])
+		lons = np.array([points[i]['lon'] for i in which])
+
+		azimuth, back_azimuth, dist = GEOD.inv(np.full(len(which), station['longitude']),
+											   np.full(len(which), station['latitude']), lons, lats)
+		azimuth = azimuth % 360
+
+		d_s = np.maximum(dist - RANGE_BUFFER, 0)
+		d_e = dist + RANGE_BUFFER
+		r_s = np.floor(d_s / int(meters_between)).astype(int)
+		r_e = np.ceil(d_e / int(meters_between)).astype(int)
+
+		for k, i in enumerate(which):
+			windows[i] = {'name': points[i]['name'], 'azimuth': float(azimuth[k]),
+						  'd_s': float(d_s[k]), 'd_e': float(d_e[k]),
+						  'meters_between': int(meters_between), 'r_s': int(r_s[k]), 'r_e': int(r_e[k])}
+
+	_window_cache[key] = windows
+	return windows
+
+
+def resolve_stats(radar, stats):
+	'''Takes radar (pyart obj) and list of stats and / or gauge points
+	Returns list of stats with gauge points replaced by their windows at the radar's resolution,
+	each with the 'rays' whose azimuth is within AZIMUTH_BUFFER degrees of the gauge
+	Level 3 scans start at an arbitrary angle, so rays are matched on radar.azimuth rather
+	than assumed to start at north'''
+	points = [stat for stat in stats if 'a_s' not in stat]
+	if not points:
+		return stats
+
+	windows = gauge_windows(points, radar.range['meters_between_gates'])
+	## Angle between every ray and every gauge, wrapped to [0, 180]
+	azimuths = np.array([window['azimuth'] for window in windows])
+	difference = np.abs((radar.azimuth['data'][:, None] - azimuths[None, :] + 180) % 360 - 180)
+	in_window = difference <= AZIMUTH_BUFFER
+
+	windows = iter([dict(window, rays=np.flatnonzero(in_window[:, k])) for k, window in enumerate(windows)])
+	return [stat if 'a_s' in stat else next(windows) for stat in stats]
+
+
+def read_level3(infile, prod):
+	'''Takes infile name (from index_files) and product code
+	Returns radar (pyart obj) or None if the file can't be read'''
+	## pyart takes seconds to load, only pay for it once there are files to decode
+	import pyart
+
+	try:
+		with metrics.stage('decode'):
+			radar = pyart.io.nexradl3_read.read_nexrad_level3(infile)
+		metrics.count('files_decoded')
+		return radar
+	except IOError:
+		print('No such file')
+	except NotImplementedError:
+		print('Product ' + prod + ' not implemented')
+	return None
+
+
+class ColumnWriter:
+	'''Buffers extracted columns and writes them out in batches of typed columns,
+	as Parquet (default) or CSV. Observations that are masked are written as nulls.'''
+
+	def __init__(self, path, fmt='parquet', batch_rows=BATCH_ROWS):
+		'''Takes output path, 'parquet' or 'csv' and rows to buffer per batch'''
+		if fmt not in ('parquet', 'csv'):
+			raise ValueError('Unsupported format: ' + fmt)
+		self.path = path
+		self.fmt = fmt
+		self.batch_rows = batch_rows
+		self.batches = []
+		self.buffered = 0
+		self.rows = 0
+		self.writer = None
+
+	def write(self, columns):
+		'''Takes dict of COLUMNS (from extract)'''
+		self.batches.append(columns)
+		self.buffered += len(columns['name'])
+		if self.buffered >= self.batch_rows:
+			self.flush()
+
+	def flush(self):
+		if not self.buffered:
+			return
+		columns = {}
+		for name, dtype in COLUMNS:
+			## keep the observation mask through the concatenation
+			concatenate = np.ma.concatenate if name == 'observation' else np.concatenate
+			columns[name] = concatenate([batch[name] for batch in self.batches])
+
+		if self.fmt == 'parquet':
+			self._write_parquet(columns)
+		else:
+			self._write_csv(columns)
+
+		self.rows += self.buffered
+		self.batches = []
+		self.buffered = 0
+
+	def _write_parquet(self, columns):
+		## Only needed for Parquet output
+		import pyarrow as pa
+		import pyarrow.parquet as pq
+
+		arrays = []
+		for name, dtype in COLUMNS:
+			if name == 'observation':
+				arrays.append(pa.array(columns[name].filled(np.nan), mask=np.ma.getmaskarray(columns[name])))
+			elif dtype is object:
+				arrays.append(pa.array(columns[name], type=pa.string()))
+			else:
+				arrays.append(pa.array(columns[name]))
+		table = pa.Table.from_arrays(arrays, names=[name for name, dtype in COLUMNS])
+
+		if self.writer is None:
+			self.writer = pq.ParquetWriter(self.path, table.schema)
+		self.writer.write_table(table)
+
+	def _write_csv(self, columns):
+		import pandas as pd
+
+		frame = pd.DataFrame({name: columns[name] for name, dtype in COLUMNS}, columns=[name for name, dtype in COLUMNS])
+		frame['observation'] = columns['observation'].filled(np.nan)
+		frame.to_csv(self.path, mode='a' if self.writer else 'w', header=not self.writer, index=False)
+		self.writer = True
+
+	def close(self):
+		self.flush()
+		if self.fmt == 'parquet' and self.writer is not None:
+			self.writer.close()
+
+
+@metrics.stage('flatten')
+def flatten(writer, infile, stats, prod):
+	'''Takes writer (ColumnWriter), infile name (from index_files), list of stats and / or
+	gauge points and product code
+	Writes rainfall from infile to writer for every stat, decoding infile once
+	NOTE: Does not handle opening / closing writer!'''	
+	radar = read_level3(infile, prod)
+	if radar is None:
+		return
+	for stat in resolve_stats(radar, stats):
+		columns = extract(radar, infile, stat, prod)
+		metrics.count('gates_processed', len(columns['name']))
+		writer.write(columns)
+
+
+def extract_file(infile, stats, prod):
+	'''Takes infile name (from index_files), list of stats and / or gauge points and product code
+	Returns list of column dicts, one per stat, or None if infile can't be read
+	Runs in the pool workers'''
+	radar = read_level3(infile, prod)
+	if radar is None:
+		return None
+	return [extract(radar, infile, stat, prod) for stat in resolve_stats(radar, stats)]
+
+
+@metrics.stage('flatten_parallel')
+def flatten_parallel(writer, tasks, stats=STATS, processes=PROCESSES, queue_depth=QUEUE_DEPTH):
+	'''Takes writer (ColumnWriter), list of (infile, product code), list of stats and / or
+	gauge points, number of worker processes and files in flight per worker
+	Extracts stats from every file across a process pool and writes the batches in task
+	order, so the output is the same as extracting one file at a time
+	NOTE: Does not handle opening / closing writer!'''
+	if processes == 1:
+		for infile, prod in tasks:
+			flatten(writer, infile, stats, prod)
+		return
+
+	window = queue_depth * (processes or os.cpu_count())
+	with concurrent.futures.ProcessPoolExecutor(processes) as pool:
+		tasks = iter(tasks)
+		pending = collections.deque()
+		while True:
+			## Keep the window full
+			for infile, prod in tasks:
+				pending.append(pool.submit(extract_file, infile, stats, prod))
+				if len(pending) >= window:
+					break
+			if not pending:
+				break
+
+			## Wait on the whole window so a failed file stops the run right away, the
+			## files queued behind it are cancelled rather than extracted and written
+			done, running = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+			for future in done:
+				if future.exception() is not None:
+					for other in pending:
+						other.cancel()
+					raise future.exception()
+
+			## Write the files that are done, oldest first
+			while pending and pending[0].done():
+				batches = pending.popleft().result()
+				## Decoding happens in the workers, count it here where the totals are kept
+				if batches is not None:
+					metrics.count('files_decoded')
+				for columns in batches or []:
+					metrics.count('gates_processed', len(columns['name']))
+					writer.write(columns)
+
+
+def main():
+	if OVERWRITE:
+		try:
+			print('Re-writing...')
+			os.remove(OUTFILE)
+		except OSError:
+			print('No existing file. Starting from scratch...')
+			return
+
+	writer = ColumnWriter(OUTFILE, fmt='csv' if OUTFILE.endswith('.csv') else 'parquet')
+
+	## To be replaced with iterable from get_days()
+	abs_dirs = [BASE + d for d in INDIRS]
+
+	tasks = []
+	for d in abs_dirs:
+		print('indexing ', d, "...")
+		index = index_files(d)
+		for p in PRODUCTS:
+			tasks.extend((f, p) for timestamp, f in index.get(p, []))
+
+	print('flattening ', len(tasks), ' files...')
+	flatten_parallel(writer, tasks)
+	writer.close()
+
+
+if __name__ == '__main__':
+	main()
@@ -1,19 +1,26 @@
 #!/usr/bin/env python3
 
+import bz2
 import datetime
-import math
-import multiprocessing
+import gzip
+import hashlib
+import io
+import itertools
 import os
+import queue
+import threading
 import time
 
-import boto
-import matplotlib
 import numpy
-import trianglesolver
-import utm
 
+# boto (S3 access) and utm (WRF domains) are imported where they are used, so station
+# lookups and catalog searches start without them
+from . import metrics
 # get STATION_INDEX
-from metadata import *
+from .metadata import *
+from .catalog import S3ListingCatalog
+from .stations import (EARTH_RADIUS_KM, WSR88D_BEAM_DISTANCE, WSR88D_LOW_ANGLE, WSR88D_HIGH_ANGLE,
+        STATION_IDS, STATION_LATLONS, beamRadiusAtHeight, stationRadiiAtHeight, stationsInDomain)
 
 
 # From https://en.wikipedia.org/wiki/NEXRAD
@@ -31,42 +38,56 @@ S3_NEXRAD_START_DATE=datetime.datetime(month=6, year=1991, day=1)
 
 DATASET_START_DATE=DUAL_POLE_DEPLOYMENT_COMPLETION
 
-# beam distance from: https://www.roc.noaa.gov/WSR88D/Engineering/NEXRADTechInfo.aspx
-WSR88D_BEAM_DISTANCE=230
-
-# Lowest angle of WSR88D
-WSR88D_LOW_ANGLE=math.radians(0.5)
-
-# Highest angle of WSR88D
-WSR88D_HIGH_ANGLE=math.radians(19.5)
-
-# Earth radius in km
-EARTH_RADIUS_KM=6371.0
-
 # Coefficent for the distance of the radius of a radar station that would be relevant
 RELEVANT_DISTANCE_COEFFICENT=0.5
 
+NEXRAD_BUCKET="noaa-nexrad-level2"
+
+# Suffix of a download in progress, renamed to the final file name once complete
+PARTIAL_SUFFIX=".part"
+
+# Retries for listing one prefix, waiting LIST_BACKOFF seconds doubled on each retry
+LIST_RETRIES=3
+LIST_BACKOFF=0.5
 
-STATION_IDS = [station["station_id"] for station in STATION_INDEX]
-STATION_LATLONS = [(station["latitude"], station["longitude"]) for station in STATION_INDEX]
+# Tasks per worker that may be queued, running or finished but not yet consumed, so a slow
+# consumer of in memory volumes holds back the downloads instead of piling them up
+IN_FLIGHT_PER_WORKER=2
 
 
 class S3NEXRADHelper:
 
-    def __init__(self, verbose=True, threads=1):
+    def __init__(self, verbose=True, threads=1, bucket_factory=None, catalog=None, list_concurrency=8):
         """Initalizes variables for this class
 
         verbose: Boolean of if we should print non-error information
         threads: The amount of threads to use for downloading from S3
+        bucket_factory: callable returning a boto bucket, or a stand-in with the same
+            list/get_key interface. It is called on first use of self.bucket and once per
+            download and listing worker. Defaults to an anonymous connection to the NEXRAD bucket
+        catalog: catalog.S3ListingCatalog to answer repeat listings from and fill with new
+            ones, or None to always list S3
+        list_concurrency: The amount of prefixes to list from S3 at once
         """
-        self.s3conn = boto.connect_s3(anon=True)
-        self.bucket = self.s3conn.get_bucket("noaa-nexrad-level2")
+        self.bucket_factory = bucket_factory or _connectNEXRADBucket
+        self._bucket = None
+        self.catalog = catalog
         self.verbose = verbose
         self.thread_max = threads
-        self.threads = []
-        self.thread_count = 0
-
-    def findNEXRADKeysByTimeAndDomain(self, start_datetime, end_datetime, maxlat, maxlon, minlat, minlon, height):
+        self.list_concurrency = list_concurrency
+        self._download_pool = None
+        self._list_pool = None
+
+    @property
+    def bucket(self):
+        """Bucket connection, made on first use so station lookups never connect to S3"""
+        if self._bucket is None:
+            self._bucket = self.bucket_factory()
+        return self._bucket
+
+    @metrics.stage('search')
+    def findNEXRADKeysByTimeAndDomain(self, start_datetime, end_datetime, maxlat, maxlon, minlat, minlon, height,
+            print_keys=True):
         """Get list of keys to nexrad files on s3 from a time range and lat/lon domain.
 
         start_datetime: start of time range in a datetime.datetime object
@@ -76,6 +97,7 @@ class S3NEXRADHelper:
         minlat: minimum lattitude of domain
         minlon: minimum longitude of domain
         height: height above sealevel in meters for domain
+        print_keys: Boolean of if every key found should be printed when verbose
 
         returns: List of keys in nexrad s3 bucket corespopnding to the parameters
         """
@@ -92,33 +114,148 @@ class S3NEXRADHelper:
             print("Found files for time range: %s to %s" % (
                     start_datetime.strftime("%Y-%m-%d %H:%M:%S"),
                     end_datetime.strftime("%Y-%m-%d %H:%M:%S")))
-            for filekey in files:
-                print(filekey)
+            if print_keys:
+                for filekey in files:
+                    print(filekey)
 
         return files
 
-    def downloadNEXRADFiles(self, download_dir, s3keys):
+    def findNEXRADKeysForQueries(self, queries):
+        """Get lists of keys to nexrad files on s3 for many time ranges and lat/lon domains.
+
+        The queries are resolved to stations first and collapsed into the unique
+        day/station prefixes they need, so each prefix is listed once however many
+        queries overlap it.
+
+        queries: list of (start_datetime, end_datetime, maxlat, maxlon, minlat, minlon, height)
+            tuples, with the same meaning as the findNEXRADKeysByTimeAndDomain arguments
+
+        returns: list with the list of keys for each query, in query order
+        """
+        resolved = []
+        prefixes = {}
+        for start_datetime, end_datetime, maxlat, maxlon, minlat, minlon, height in queries:
+            start, end = self._clampTimeRange(start_datetime, end_datetime)
+            station_list = self.getStationsFromDomain(maxlat, maxlon, minlat, minlon, height)
+            resolved.append((start, end, station_list))
+
+            for dir_key, marker, stop in self._dayPrefixes(start, end, station_list):
+                if dir_key in prefixes:
+                    # widen the bounds to cover both queries, "" is unbounded
+                    known_marker, known_stop = prefixes[dir_key]
+                    marker = min(marker, known_marker) if marker and known_marker else ""
+                    stop = max(stop, known_stop) if stop and known_stop else ""
+                prefixes[dir_key] = (marker, stop)
+
+        listings = self._listPrefixes([(dir_key, marker, stop) for dir_key, (marker, stop) in prefixes.items()])
+        key_index = NEXRADKeyIndex(key for keys in listings.values() for key in keys)
+        files = [key_index.keysBetween(start, end, station_list) for start, end, station_list in resolved]
+
+        if self.verbose:
+            print("Found %d files for %d queries from %d listings" % (
+                    sum(len(query_files) for query_files in files), len(queries), len(prefixes)))
+
+        return files
+
+    @metrics.stage('download')
+    def downloadNEXRADFiles(self, download_dir, s3keys, verify=False):
         """Download files from S3 NEXRAD bucket
 
+        Files already in download_dir with the remote size are skipped and interrupted
+        downloads are resumed, so re-running after a crash only transfers missing bytes.
+
         download_dir: The directory to download the file to
         s3keys: list of keys in the nexrad bucket to download
+        verify: Boolean of if local files should also match the remote ETag (md5)
 
         returns: list of downloaded file paths
         """
         if not os.path.exists(download_dir):
             print("Unable to find download directory, skipping downloads")
             return
-        file_paths = []
-        for key in s3keys:
-            file_path = os.path.join(download_dir, key.split('/')[-1])
-            file_paths.append(file_path)
+        file_paths = [os.path.join(download_dir, key.split('/')[-1]) for key in s3keys]
+        for key, file_path, downloaded in self.iterDownloadNEXRADFiles(download_dir, s3keys, verify):
+            pass
 
-            self._addToThreadPool(_downloadFile, (key, file_path, self.verbose))
-            self._waitForThreadPool()
+        return file_paths
 
-        self._waitForThreadPool(thread_max=0)
+    def iterDownloadNEXRADFiles(self, download_dir, s3keys, verify=False):
+        """Download files from S3 NEXRAD bucket, reporting each key as it completes.
 
-        return file_paths
+        Keys are queued to a pool of self.thread_max workers that stays up between calls,
+        each worker reusing its own bucket connection for every key it takes.
+
+        download_dir: The directory to download the file to
+        s3keys: list of keys in the nexrad bucket to download
+        verify: Boolean of if local files should also match the remote ETag (md5)
+
+        returns: generator of (key, file_path, downloaded) tuples in completion order
+        """
+        if self._download_pool is None:
+            self._download_pool = _BucketWorkerPool(self.bucket_factory, self.thread_max)
+
+        tasks = [(key, os.path.join(download_dir, key.split('/')[-1]), verify) for key in s3keys]
+        for (key, file_path, verify), transferred, error in self._download_pool.imapUnordered(_downloadFile, tasks):
+            if error is not None:
+                print("Unable to download %s: %s" % (key, error))
+            elif transferred is None:
+                print("Unable to find file %s, skipping" % key)
+            elif self.verbose and transferred == 0:
+                print("%s already downloaded" % file_path)
+            elif self.verbose:
+                print("%s downloaded" % file_path)
+
+            yield key, file_path, error is None and transferred is not None
+
+    def iterNEXRADBuffers(self, s3keys, download_dir=None):
+        """Fetch files from S3 NEXRAD bucket into memory, reporting each key as it completes.
+
+        s3keys: list of keys in the nexrad bucket to fetch
+        download_dir: The directory to also write each file to, or None to never touch disk
+
+        returns: generator of (key, buffer) tuples in completion order, buffer is an io.BytesIO
+            of the file as stored in the bucket
+        """
+        if self._download_pool is None:
+            self._download_pool = _BucketWorkerPool(self.bucket_factory, self.thread_max)
+
+        for (key,), data, error in self._download_pool.imapUnordered(_fetchFile, [(key,) for key in s3keys]):
+            if error is not None:
+                print("Unable to download %s: %s" % (key, error))
+                continue
+            if data is None:
+                print("Unable to find file %s, skipping" % key)
+                continue
+
+            if download_dir is not None:
+                file_path = os.path.join(download_dir, key.split('/')[-1])
+                with open(file_path + PARTIAL_SUFFIX, 'wb') as dfile:
+                    dfile.write(data)
+                os.replace(file_path + PARTIAL_SUFFIX, file_path)
+                if self.verbose:
+                    print("%s downloaded" % file_path)
+
+            yield key, io.BytesIO(data)
+
+    def iterNEXRADVolumes(self, s3keys, download_dir=None):
+        """Fetch files from S3 NEXRAD bucket and decode them in memory with pyart.
+
+        s3keys: list of keys in the nexrad bucket to fetch
+        download_dir: The directory to also write each file to, or None to never touch disk
+
+        returns: generator of (key, radar) tuples in completion order, radar is a pyart Radar
+        """
+        for key, buffer in self.iterNEXRADBuffers(s3keys, download_dir):
+            yield key, readNEXRADBuffer(buffer)
+
+    def close(self):
+        """Stop the download and listing workers"""
+        if self._download_pool is not None:
+            self._download_pool.close()
+            self._download_pool = None
+        if self._list_pool is not None:
+            self._list_pool.close()
+            self._list_pool = None
 
     def getStationsFromWRFDomain(self, dx, dy, e_sn, e_we, ref_lat, ref_lon, height):
         """Searches station list for radar stations that would be relevant
@@ -133,6 +270,8 @@ class S3NEXRADHelper:
 
         returns: list of station ids ex. ['KIND', 'KLVX']
         """
+        import utm
+
         center_east, center_north, zone_number, zone_letter = utm.from_latlon(ref_lat, ref_lon)
         maxlat, maxlon = utm.to_latlon(center_east + (e_we/2.0*dx), center_north + (e_sn/2.0*dy),
                                        zone_number, zone_letter, strict=False)
@@ -155,89 +294,9 @@ class S3NEXRADHelper:
         returns: list of station ids ex. ['KIND', 'KLVX']
         """
 
-        # http://geokov.com/education/utm.aspx
-        # easting values increase towards east
-        # max lon is east side
-        # max lat is north 
-
-        maxeast_domain, maxnorth_domain, max_zone_number, max_zone_letter = utm.from_latlon(maxlat, maxlon)
-
-        mineast_domain, minnorth_domain, min_zone_number, min_zone_letter = utm.from_latlon(minlat, minlon)
-
-        relevant_stations = []
-        possibly_relevant_stations = []
-        for i, latlon in enumerate(STATION_LATLONS): 
-            lat, lon = latlon
-
-            station_radius = self._calculateRadiusAtHeight(height, 
-                    STATION_INDEX[i]['station_elevation'])
-            if station_radius is None:
-                continue
-
-            relevant_radius = RELEVANT_DISTANCE_COEFFICENT*station_radius
-
-            maxeast = maxeast_domain + relevant_radius
-            maxnorth = maxnorth_domain + relevant_radius
-            domain_maxlat, domain_maxlon = utm.to_latlon(maxeast, maxnorth, max_zone_number,
-                max_zone_letter, strict=False)
-
-            mineast = mineast_domain - relevant_radius
-            minnorth = minnorth_domain - relevant_radius
-            domain_minlat, domain_minlon = utm.to_latlon(mineast, minnorth, min_zone_number,
-                    min_zone_letter, strict=False)
-
-            # Vertical band of relevant domain bounded by user-given domain
-            if ((lat <= domain_maxlat and lat >= domain_minlat) and
-                    (lon <= maxlon and lon >= minlon)):
-                relevant_stations.append(STATION_INDEX[i]['station_id'])
-
-            # Horizontal band of relevant domain bounded by user-given domain
-            elif ((lat <= maxlat and lat >= minlat) and
-                    (lon <= domain_maxlon and lon >= domain_minlon)):
-                relevant_stations.append(STATION_INDEX[i]['station_id'])
-
-            # north east corner of relevant domain
-            elif ((lat <= domain_maxlat and lat >= maxlat) and 
-                    (lon <= domain_maxlon and lon >= maxlon) and
-                    _isStationInDomainCorner(maxlat, maxlon,
-                        STATION_INDEX[i]['latitude'], 
-                        STATION_INDEX[i]['longitude'],
-                        relevant_radius)):
-
-                relevant_stations.append(STATION_INDEX[i]['station_id'])
-
-            # south east corner of relevant domain
-            elif ((lat <= domain_minlat and lat >= minlat) and
-                    (lon <= domain_maxlon and lon >= maxlon) and
-                    _isStationInDomainCorner(minlat, maxlon,
-                        STATION_INDEX[i]['latitude'], 
-                        STATION_INDEX[i]['longitude'],
-                        relevant_radius)):
-
-                relevant_stations.append(STATION_INDEX[i]['station_id'])
-
-            # south west corner of relevant domain
-            elif ((lat <= domain_minlat and lat >= minlat) and
-                    (lon <= domain_minlon and lon >= minlon) and
-                    _isStationInDomainCorner(minlat, minlon,
-                        STATION_INDEX[i]['latitude'], 
-                        STATION_INDEX[i]['longitude'],
-                        relevant_radius)):
-
-                relevant_stations.append(STATION_INDEX[i]['station_id'])
-
-            # north west corner of relevant domain
-            elif ((lat <= domain_maxlat and lat >= maxlat) and
-                    (lon <= domain_minlon and lon >= minlon) and
-                    _isStationInDomainCorner(maxlat, minlon,
-                        STATION_INDEX[i]['latitude'], 
-                        STATION_INDEX[i]['longitude'],
-                        relevant_radius)):
-
-                relevant_stations.append(STATION_INDEX[i]['station_id'])
-
-        return relevant_stations
+        return getStationsFromDomain(maxlat, maxlon, minlat, minlon, height)
 
+    @metrics.stage('listing')
     def searchNEXRADS3(self, start_datetime, end_datetime, station_list):
         """Find available files from a date range and a station list
 
@@ -247,61 +306,110 @@ class S3NEXRADHelper:
 
         returns: list of keys in the nexrad s3 bucket within the time range for the specified stations
         """
+        start, end = self._clampTimeRange(start_datetime, end_datetime)
+        station_list = [station_id for station_id in station_list if self._isKnownStation(station_id)]
+        listings = self._listPrefixes(self._dayPrefixes(start, end, station_list))
+        key_index = NEXRADKeyIndex(key for keys in listings.values() for key in keys)
+        keys = key_index.keysBetween(start, end, station_list)
+        metrics.count('keys_listed', len(keys))
+
+        return keys
+
+    def _clampTimeRange(self, start_datetime, end_datetime):
+        """Clamp a time range to the dataset start and the current time
+
+        returns: tuple of (start, end) datetime.datetime objects
+        """
         start = start_datetime
         if start_datetime < DATASET_START_DATE:
-            if verbose:
+            if self.verbose:
                 print("Start time is before the dataset start date, will use dataset start time instead")
             start = DATASET_START_DATE
 
         end = end_datetime
         if end_datetime > datetime.datetime.now():
-            if verbose:
+            if self.verbose:
                 print("End time is in the future, will use today as end time")
             end = datetime.datetime.now()
 
+        return start, end
 
-        dir_key_list = []
-        for station_id in station_list:
-            if station_id not in STATION_IDS:
-                print("Station %s not found, skipping") % station_id
-                continue
-            current_date = start.replace(hour=0)
-            while current_date < end:
-                dir_key_list.append("%d/%02d/%02d/%s" % (current_date.year, current_date.month,
-                    current_date.day, station_id))
-                current_date = current_date + datetime.timedelta(days=1)
-
-        start_dir = "%d/%02d/%02d/" % (start.year, start.month ,start.day)
-        end_dir = "%d/%02d/%02d/" % (end.year, end.month, end.day)
-        files_list = []
+    def _isKnownStation(self, station_id):
+        if station_id not in STATION_IDS:
+            print("Station %s not found, skipping" % station_id)
+            return False
+        return True
 
-        # 2015/05/06/KSGF/KSGF20150506_224351_V06.gz
-        # drop everything except the time the time
-        before_time_index = 20
-        after_time_index = 35
-        for dir_key in dir_key_list:
-            for file in self.bucket.list("%s/" % dir_key, "/"):
-                file_name = file.name 
-
-                if not file_name.endswith('gz'):
-                    continue
-
-                if file_name.startswith(start_dir):
-                    file_datetime = datetime.datetime.strptime(
-                            file_name[before_time_index:after_time_index],
-                            "%Y%m%d_%H%M%S")
-                    if file_datetime <= start:
-                        continue
-
-                if file_name.startswith(end_dir):
-                    file_datetime = datetime.datetime.strptime(
-                            file_name[before_time_index:after_time_index],
-                            "%Y%m%d_%H%M%S")
-                    if file_datetime >= end:
-                        continue
-
-                files_list.append(file_name)
-        return files_list
+    def _dayPrefixes(self, start, end, station_list):
+        """Day/station prefixes covering a time range.
+
+        Without a catalog, the first and last day are bounded so their listing starts after
+        the window start and stops at the window end. With a catalog every day is listed
+        whole so it can be cached.
+
+        start: start of time range in a datetime.datetime object
+        end: end of time range in a datetime.datetime object
+        station_list: list of station ids as strings ex. ["KIND", "KVBX"]
+
+        returns: list of (prefix, marker, stop) tuples ex. ("2015/05/06/KSGF", "", ""),
+            marker and stop are key names to list after and stop at, "" for unbounded
+        """
+        prefixes = []
+        day = start.date()
+        last_day = (end - datetime.timedelta(microseconds=1)).date()
+        while day <= last_day:
+            for station_id in station_list:
+                dir_key = "%d/%02d/%02d/%s" % (day.year, day.month, day.day, station_id)
+                marker = ""
+                stop = ""
+                if self.catalog is None:
+                    if day == start.date():
+                        marker = "%s/%s%s" % (dir_key, station_id, start.strftime("%Y%m%d_%H%M%S"))
+                    if day == last_day:
+                        stop = "%s/%s%s" % (dir_key, station_id, _ceilSecond(end).strftime("%Y%m%d_%H%M%S"))
+                prefixes.append((dir_key, marker, stop))
+            day += datetime.timedelta(days=1)
+
+        return prefixes
+
+    def _listPrefixes(self, prefixes):
+        """List the keys under each day/station prefix, from the catalog where possible.
+        Prefixes missing from the catalog are listed on self.list_concurrency workers.
+
+        prefixes: list of (prefix, marker, stop) tuples from _dayPrefixes
+
+        returns: dict of prefix to list of key names
+        """
+        listings = {}
+        missing = []
+        for dir_key, marker, stop in prefixes:
+            keys = None if self.catalog is None else self.catalog.get(dir_key)
+            if keys is None:
+                missing.append((dir_key, marker, stop))
+            else:
+                listings[dir_key] = keys
+
+        if not missing:
+            return listings
+
+        if self._list_pool is None:
+            self._list_pool = _BucketWorkerPool(self.bucket_factory, self.list_concurrency)
+
+        fetched = {}
+        bounded = set()
+        for (dir_key, marker, stop), keys, error in self._list_pool.imapUnordered(_listPrefix, missing):
+            if error is not None:
+                raise error
+            fetched[dir_key] = keys
+            if marker or stop:
+                bounded.add(dir_key)
+
+        # bounded listings only hold part of a day, keep them out of the catalog
+        if fetched and self.catalog is not None:
+            self.catalog.putMany({dir_key: keys for dir_key, keys in fetched.items() if dir_key not in bounded})
+        listings.update(fetched)
+
+        return listings
 
     def _calculateRadiusAtHeight(self, height, station_elevation):
         """This function calculates the radius at the specified height above sealevel.
@@ -314,170 +422,289 @@ class S3NEXRADHelper:
 
         returns: ground distance radius of radar in meters or None if height is not available
         """
-        # anything bigger can throw errors and this is outside of the operational specs of
-        # the current and future VCPs - https://en.wikipedia.org/wiki/NEXRAD
-        if height > 90000: return None
+        ground_distance = beamRadiusAtHeight(height, station_elevation)
+        if numpy.isnan(ground_distance):
+            return None
+
+        return float(ground_distance)
 
-        # There should probably be a lower bound here but I haven't been able to find it yet
-        #if height < ?: return None
 
-        # highest point above sea level
-        if station_elevation > 6267: return None
+class NEXRADKeyIndex:
+    """Level II keys of each station as a sorted array of scan times, so a time window
+    is two binary searches.
+    """
 
-        # radar must be lower than specified height
-        if station_elevation >= height: return None
+    def __init__(self, key_names):
+        """Parse and sort key names
 
-        # based on figure 2 of http://www.radartutorial.eu/01.basics/Calculation%20of%20height.en.html
-        # TODO: include refraction in the calculation
-        height_km = height/1000.0 - station_elevation/1000
+        key_names: iterable of key names ex. "2015/05/06/KSGF/KSGF20150506_224351_V06.gz",
+            names that aren't gzipped Level II volumes are dropped
+        """
+        station_keys = {}
+        for key_name in key_names:
+            if not key_name.endswith('gz') or key_name[_KEY_DATE_END] != '_':
+                continue
+            station_keys.setdefault(key_name[_KEY_STATION], []).append(key_name)
 
-        localized_radius = EARTH_RADIUS_KM + station_elevation/1000
+        self.stations = {}
+        for station_id, keys in station_keys.items():
+            times = numpy.array([_keyTime(key_name) for key_name in keys], dtype=numpy.int64)
+            order = numpy.argsort(times, kind='mergesort')
+            self.stations[station_id] = (times[order], [keys[i] for i in order])
 
-        # Create an triange on a circle (2d earth), the three side are the length of
-        # localized radius connected, the radar beam and the height + localized_radius 
-        # connecting to the beam end and the earth center
+    def keysBetween(self, start, end, station_list):
+        """Keys strictly inside a time range
 
-        height_of_beam_end = localized_radius + height_km
+        start: start of time range in a datetime.datetime object
+        end: end of time range in a datetime.datetime object
+        station_list: list of station ids as strings ex. ["KIND", "KVBX"]
 
-        # lowest angle at the radar site
-        # 90 degrees + radar beam angle
-        radar_site_angle = math.radians(90) + WSR88D_LOW_ANGLE
-        #######
-        # Calculate max ground distance at 0.5 degrees for WSR88D_MAX_RADIUS constant
-        #a, b, beam_distance, beam_point_angle, B, earth_center_angle = trianglesolver.solve(
-        #        a = EARTH_RADIUS_KM, c = WSR88D_BEAM_DISTANCE, B = radar_site_angle, ssa_flag='acute')
-        #print earth_center_angle * EARTH_RADIUS_KM
-        # WSR88D_MAX_RADIUS=229819.074224
-        #######
+        returns: list of keys in time order
+        """
+        start_time = int(start.strftime("%Y%m%d%H%M%S"))
+        end_time = int(_ceilSecond(end).strftime("%Y%m%d%H%M%S"))
 
-        a, b, beam_distance, beam_point_angle, B, earth_center_angle = trianglesolver.solve(
-                a = localized_radius, b = height_of_beam_end, B = radar_site_angle, ssa_flag='acute')
+        files_list = []
+        for station_id in station_list:
+            if station_id not in self.stations:
+                continue
+            times, keys = self.stations[station_id]
+            first = numpy.searchsorted(times, start_time, side='right')
+            last = numpy.searchsorted(times, end_time, side='left')
+            files_list.extend(keys[first:last])
+
+        if len(station_list) > 1:
+            files_list.sort(key=lambda key_name: (_keyTime(key_name), key_name))
+        return files_list
 
-        # if our beam_distance is too high then check the highest beam
-        if (beam_distance > WSR88D_BEAM_DISTANCE):
-        
-            # angle at the radar site
-            # 90 degrees + radar beam angle
-            radar_site_angle = math.radians(90) + WSR88D_HIGH_ANGLE
 
-            a, b, beam_distance, beam_point_angle, B, earth_center_angle = trianglesolver.solve(
-                    a = localized_radius, b = height_of_beam_end, B = radar_site_angle, ssa_flag='acute')
+# 2015/05/06/KSGF/KSGF20150506_224351_V06.gz
+_KEY_STATION = slice(11, 15)
+_KEY_DATE = slice(20, 28)
+_KEY_DATE_END = 28
+_KEY_TIME = slice(29, 35)
 
-            # if we still don't have a reasonable beam distance, return None
-            if (beam_distance > WSR88D_BEAM_DISTANCE):
-                return None
 
-            # If beam distance is fine, solve for this height at max beam_distance so we can 
-            # get the appropriate ground distance for the radar's radius at this height
-            a, b, c, A, radar_site_angle, earth_center_angle = trianglesolver.solve(
-                    a = localized_radius, b = height_of_beam_end, c = WSR88D_BEAM_DISTANCE)
+def _keyTime(key_name):
+    """Scan time of a key as an integer YYYYMMDDHHMMSS"""
+    return int(key_name[_KEY_DATE] + key_name[_KEY_TIME])
 
-        #print math.degrees(radar_site_angle)
 
-        # the ground distance is the circular segment with angle earth_center_angle and r of localized_radius
-        # this assumes a smooth earth (and a shperical cow)
-        ground_distance_km = earth_center_angle * localized_radius
+def _ceilSecond(time):
+    """Round a datetime.datetime up to a whole second"""
+    if time.microsecond:
+        return time.replace(microsecond=0) + datetime.timedelta(seconds=1)
+    return time
 
-        ground_distance = ground_distance_km * 1000
 
-        return ground_distance
+class _BucketWorkerPool:
+    """Persistent worker threads that take tasks from a queue. Each worker opens one
+    bucket connection on first use and keeps it (and its HTTP connection) for every
+    task after that.
+    """
 
-    def _isStationInDomainCorner(self, corner_lat, corner_lon, station_lat, station_lon,
-            radius):
-        """Take the relevant domain distance as the radius for a circle around the point
-        of the corner of the user-provided domain. Create this shape and check to see if the 
-        station lies within it.
+    def __init__(self, bucket_factory, workers):
+        self.bucket_factory = bucket_factory
+        self.tasks = queue.Queue()
+        self.workers = [threading.Thread(target=self._work, daemon=True) for i in range(max(workers, 1))]
+        for worker in self.workers:
+            worker.start()
 
-        corner_lat: lattitude of a corner point of the user-provided domain
-        corner_lon: longitude of the same corner point of the user-provided domain
-        station_lat: latitude of the station to be checked
-        station_lon: longitude of the station to be checked
-        radius: distance from the corner point to check 
-            Highly suggested: the radius is the same distance to calculate the relevant domain
+    def imapUnordered(self, function, task_args, max_in_flight=None):
+        """Run function(bucket, *args) for every args in task_args.
 
+        At most max_in_flight tasks (default IN_FLIGHT_PER_WORKER per worker) are queued,
+        running or holding a result the consumer has not taken yet. The next task is only
+        queued when the consumer asks for the next result.
 
-        return: Boolean of if the station is within the domain
+        returns: generator of (args, result, error) tuples in completion order
         """
-        easting_points, northing_points, zone_number, zone_letter =_createGeographicCircle(
-                corner_lat, corner_lon, radius)
-        shape = []
-        for i in range(0, len(easting_points)):
-            shape.append([easting_points[i], northing_points[i]])
+        max_in_flight = max_in_flight or IN_FLIGHT_PER_WORKER*len(self.workers)
+        results = queue.Queue()
+        task_args = iter(task_args)
+        in_flight = 0
+        for args in itertools.islice(task_args, max_in_flight):
+            self.tasks.put((function, args, results))
+            in_flight += 1
+
+        while in_flight:
+            result = results.get()
+            in_flight -= 1
+            yield result
+            for args in itertools.islice(task_args, 1):
+                self.tasks.put((function, args, results))
+                in_flight += 1
+
+    def close(self):
+        for worker in self.workers:
+            self.tasks.put(None)
+        for worker in self.workers:
+            worker.join()
+
+    def _work(self):
+        bucket = None
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                return
+            function, args, results = task
+            try:
+                if bucket is None:
+                    bucket = self.bucket_factory()
+                results.put((args, function(bucket, *args), None))
+            except Exception as error:
+                results.put((args, None, error))
+
+
+def _connectNEXRADBucket():
+    import boto
 
-        relevant_domain = matplotlib.path.Path(numpy_array(shape))
+    s3conn = boto.connect_s3(anon=True)
+    return s3conn.get_bucket(NEXRAD_BUCKET)
 
-        station_easting, station_northing, station_zone_number, station_zone_letter = utm.from_latlon(
-            lat, lon, force_zone_number=zone_number)
 
-        return relevant_domain.contains_point(station_easting, station_northing)
+@metrics.stage('list_prefix')
+def _listPrefix(bucket, dir_key, marker="", stop=""):
+    """List the key names under a day/station prefix, retrying with exponential backoff.
 
-    def _createGeographicCircle(self, lat, lon, radius):
-        """Create points on circumfrence of circle centered at lat,lon.
-        
-        lat: lattiude of center of circle
-        lon: longitude of center of circle
-        radius: radius of circle in meters
+    dir_key: day/station prefix ex. "2015/05/06/KSGF"
+    marker: key name to start listing after, "" to start at the beginning of the prefix
+    stop: key name to stop listing at, "" to list to the end of the prefix
 
-        returns: tuple of (easting_points, northing_points, zone_number, zone_letter)
-        """
-        center_easting, center_northing, zone_number, zone_letter = utm.from_latlon(lat, lon)
+    returns: list of key names
+    """
+    import boto.exception
 
-        points_in_shape = 45
+    for attempt in range(LIST_RETRIES + 1):
+        try:
+            names = []
+            for file in bucket.list("%s/" % dir_key, "/", marker=marker):
+                if stop and file.name >= stop:
+                    break
+                names.append(file.name)
+            return names
+        except (boto.exception.BotoServerError, boto.exception.BotoClientError, OSError):
+            if attempt == LIST_RETRIES:
+                raise
+            time.sleep(LIST_BACKOFF * 2**attempt)
 
-        easting_points = []
-        northing_points = []
 
-        theta = (math.pi*2) / points_in_shape
-        for i in range(1, points_in_shape + 1):
-            angle = theta * i
+@metrics.stage('stations')
+def getStationsFromDomain(maxlat, maxlon, minlat, minlon, height):
+    """Searches station list for radar stations that would be relevant
+    to the domain provided, without connecting to S3.
 
-            point_easting = radius * math.cos(angle) + center_easting
-            point_northing  = radius * math.sin(angle) + center_northing
+    maxlat: maximum latitude of domain
+    maxlon: maximum longitude of domain
+    minlat: minimum lattitude of domain
+    minlon: minimum longitude of domain
+    height: height above sealevel in meters for domain
 
-        easting_points.append(point_easting)
-        northing_points.append(point_northing)
+    returns: list of station ids ex. ['KIND', 'KLVX']
+    """
+    # relevant radius of every station at height from the station radius table, NaN
+    # where the station has no coverage at this height
+    radii = RELEVANT_DISTANCE_COEFFICENT*stationRadiiAtHeight(height)
 
-        return (easting_points, northing_points, zone_number, zone_letter)
+    return stationsInDomain(maxlat, maxlon, minlat, minlon, radii)
 
-    def _addToThreadPool(self, function, args):
-        proc = multiprocessing.Process(target=function, args=args)
-        proc.start()
-        self.threads.append(proc)
-        self.thread_count += 1
 
-    def _waitForThreadPool(self, thread_max=None):
-        if thread_max is None:
-            thread_limit = self.thread_max - 1
-        else:
-            thread_limit = thread_max
-        count = 0
-        while len(self.threads) > thread_limit:
-            time.sleep(.1)
-            if count > len(self.threads) - 1:
-                count = 0
-            if self.threads[count].exitcode is not None:
-                self.threads[count].join(1)
-                self.threads.pop(count)
-            else: 
-                count += 1
+def readNEXRADBuffer(buffer):
+    """Decode a Level II file held in memory into a pyart Radar, decompressing
+    whole-file gzip or bzip2 first (pyart only does that for files on disk).
 
+    buffer: file-like object or bytes of a Level II file
 
-def _downloadFile(key, file_path, verbose):
-    s3conn = boto.connect_s3(anon=True)
-    bucket = s3conn.get_bucket("noaa-nexrad-level2")
+    returns: pyart Radar object
+    """
+    # pyart is only needed for decoding, keep it out of searching and downloading
+    import pyart
+
+    with metrics.stage('decode'):
+        data = buffer if isinstance(buffer, bytes) else buffer.read()
+        if data.startswith(b"\x1f\x8b"):
+            data = gzip.decompress(data)
+        elif data.startswith(b"BZh"):
+            data = bz2.decompress(data)
+
+        radar = pyart.io.read_nexrad_archive(io.BytesIO(data))
+    metrics.count('files_decoded')
+
+    return radar
+
+
+@metrics.stage('fetch_file')
+def _fetchFile(bucket, key):
+    """Fetch key into memory over an existing bucket connection.
+
+    returns: bytes of the file or None if the key was not found
+    """
+    keyobj = bucket.get_key(key)
+    if keyobj is None:
+        return None
+
+    buffer = io.BytesIO()
+    keyobj.get_file(buffer)
+    metrics.count('bytes_downloaded', keyobj.size)
+    return buffer.getvalue()
+
+
+@metrics.stage('download_file')
+def _downloadFile(bucket, key, file_path, verify=False):
+    """Download key to file_path over an existing bucket connection.
+
+    A complete local copy is left alone. Otherwise the key is written to
+    file_path + PARTIAL_SUFFIX, resuming a previous partial file with a range request,
+    and renamed to file_path once it has the remote size (and ETag if verify).
+
+    returns: bytes transferred, 0 if the file was already present, None if the key was not found
+    """
     keyobj = bucket.get_key(key)
     if keyobj is None:
-        if self.verbose: print("Unable to find file %s, skipping" % key)
-        return
+        return None
+
+    if (os.path.exists(file_path) and os.path.getsize(file_path) == keyobj.size and
+            (not verify or _matchesETag(file_path, keyobj))):
+        return 0
+
+    partial_path = file_path + PARTIAL_SUFFIX
+    offset = os.path.getsize(partial_path) if os.path.exists(partial_path) else 0
+    if offset > keyobj.size:
+        offset = 0
+
+    if offset < keyobj.size:
+        dfile = open(partial_path, 'ab' if offset else 'wb')
+        try:
+            keyobj.get_file(dfile, headers={"Range": "bytes=%d-" % offset} if offset else None)
+        finally:
+            dfile.close()
+
+    if os.path.getsize(partial_path) != keyobj.size:
+        raise IOError("%s is incomplete, will resume on the next download" % partial_path)
+
+    if verify and not _matchesETag(partial_path, keyobj):
+        os.remove(partial_path)
+        raise IOError("%s does not match the remote ETag" % key)
+
+    os.replace(partial_path, file_path)
+    metrics.count('bytes_downloaded', keyobj.size - offset)
+
+    return keyobj.size - offset
+
 
-    dfile = open(file_path, 'wb')
-    try:
-        keyobj.get_file(dfile)
-    finally:
-        dfile.close()
+def _matchesETag(file_path, keyobj):
+    """Boolean of if the md5 of file_path matches the ETag of keyobj. Multipart ETags
+    are not an md5 of the object so they always match.
+    """
+    etag = keyobj.etag.strip('"')
+    if '-' in etag:
+        return True
 
-    if verbose:
-        print("%s downloaded" % file_path)
+    md5 = hashlib.md5()
+    with open(file_path, 'rb') as dfile:
+        for chunk in iter(lambda: dfile.read(1 << 20), b''):
+            md5.update(chunk)
+    return md5.hexdigest() == etag
 
 
 # TODO: make public main() for nexradpy <<api>>: get_nexrad()
@@ -486,12 +713,13 @@ def _downloadFile(key, file_path, verbose):
 
 def main():
     ## EXAMPLE USAGE
-    nexrad = S3NEXRADHelper(threads=20)
+    nexrad = S3NEXRADHelper(threads=20, catalog=S3ListingCatalog())
     s3keys = nexrad.findNEXRADKeysByTimeAndDomain(
             datetime.datetime(day=5, month=5, year=2015, hour=5),
             datetime.datetime(day=5, month=5, year=2015, hour=6), 
             40.901954, -73.632802, 40.460969, -74.363177, 20000)
     nexrad.downloadNEXRADFiles(os.path.abspath(os.path.join(os.path.dirname(__file__), '../..', 'data/raw/temp')), s3keys)
+    nexrad.close()
 
 
 if __name__ == "__main__":
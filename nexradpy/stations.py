@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+
+import math
+
+import numpy
+
+# get STATION_INDEX
+from .metadata import STATION_INDEX
+
+
+# Earth radius in km
+EARTH_RADIUS_KM=6371.0
+
+# beam distance from: https://www.roc.noaa.gov/WSR88D/Engineering/NEXRADTechInfo.aspx
+WSR88D_BEAM_DISTANCE=230
+
+# Lowest angle of WSR88D
+WSR88D_LOW_ANGLE=math.radians(0.5)
+
+# Highest angle of WSR88D
+WSR88D_HIGH_ANGLE=math.radians(19.5)
+
+# anything bigger can throw errors and this is outside of the operational specs of
+# the current and future VCPs - https://en.wikipedia.org/wiki/NEXRAD
+MAX_BEAM_HEIGHT=90000
+
+# highest point above sea level
+MAX_STATION_ELEVATION=6267
+
+# Points in each segment of the per-station radius table
+RADIUS_TABLE_POINTS=512
+
+
+STATION_IDS = [station["station_id"] for station in STATION_INDEX]
+STATION_LATLONS = [(station["latitude"], station["longitude"]) for station in STATION_INDEX]
+
+# Station coordinates as arrays so a domain query tests every station at once
+STATION_LATITUDES = numpy.array([station["latitude"] for station in STATION_INDEX])
+STATION_LONGITUDES = numpy.array([station["longitude"] for station in STATION_INDEX])
+STATION_ELEVATIONS = numpy.array([station["station_elevation"] for station in STATION_INDEX])
+
+_STATION_LATS_RAD = numpy.radians(STATION_LATITUDES)
+_STATION_LONS_RAD = numpy.radians(STATION_LONGITUDES)
+_STATION_COS_LATS = numpy.cos(_STATION_LATS_RAD)
+
+
+def distanceToDomain(maxlat, maxlon, minlat, minlon):
+    """Ground distance from every station to the closest point of a lat/lon domain.
+
+    The closest point is found by clamping the station into the domain, so stations
+    inside the domain are at distance 0, stations beside an edge are measured
+    perpendicular to it and stations off a corner are measured to that corner.
+
+    maxlat: maximum latitude of domain
+    maxlon: maximum longitude of domain
+    minlat: minimum lattitude of domain
+    minlon: minimum longitude of domain
+
+    returns: numpy array of great circle distances in meters, ordered like STATION_INDEX
+    """
+    closest_lats = numpy.radians(numpy.clip(STATION_LATITUDES, minlat, maxlat))
+    closest_lons = numpy.radians(numpy.clip(STATION_LONGITUDES, minlon, maxlon))
+
+    # haversine
+    half_dlat = numpy.sin((closest_lats - _STATION_LATS_RAD) / 2.0)
+    half_dlon = numpy.sin((closest_lons - _STATION_LONS_RAD) / 2.0)
+    a = half_dlat**2 + _STATION_COS_LATS * numpy.cos(closest_lats) * half_dlon**2
+
+    return 2.0 * EARTH_RADIUS_KM * 1000 * numpy.arcsin(numpy.sqrt(numpy.minimum(a, 1.0)))
+
+
+def stationsInDomain(maxlat, maxlon, minlat, minlon, radii):
+    """Find the stations whose relevant radius reaches the domain provided.
+
+    maxlat: maximum latitude of domain
+    maxlon: maximum longitude of domain
+    minlat: minimum lattitude of domain
+    minlon: minimum longitude of domain
+    radii: numpy array of relevant radius in meters per station, ordered like
+        STATION_INDEX, NaN for stations that should never match
+
+    returns: list of station ids ex. ['KIND', 'KLVX']
+    """
+    # NaN radii compare False so unavailable stations drop out here
+    relevant = distanceToDomain(maxlat, maxlon, minlat, minlon) <= radii
+    return [STATION_IDS[i] for i in numpy.flatnonzero(relevant)]
+
+
+def beamRadiusAtHeight(heights, station_elevations):
+    """Vectorized ground radius of the radar at the specified heights above sealevel.
+
+    This is the closed form of the triangle s3_nexrad_search used to hand to
+    trianglesolver: the localized earth radius, the radar beam and the height +
+    localized radius connecting the beam end and the earth center. It is a rough
+    estimate that does not take into account refraction or beam width and assumes
+    a spherical earth.
+
+    heights: height above sea level in meters, scalar or array
+    station_elevations: radar site height above sea level in meters, scalar or array
+        broadcastable against heights
+
+    returns: numpy array of ground distance radius in meters, NaN where the height
+        is not available
+    """
+    heights, station_elevations = numpy.broadcast_arrays(
+            numpy.asarray(heights, dtype=float), numpy.asarray(station_elevations, dtype=float))
+
+    # There should probably be a lower bound here but I haven't been able to find it yet
+    # radar must be lower than specified height
+    # based on figure 2 of http://www.radartutorial.eu/01.basics/Calculation%20of%20height.en.html
+    # TODO: include refraction in the calculation
+    available = ((heights <= MAX_BEAM_HEIGHT) & (station_elevations <= MAX_STATION_ELEVATION) &
+            (station_elevations < heights))
+
+    localized_radius = EARTH_RADIUS_KM + station_elevations/1000.0
+    height_of_beam_end = localized_radius + (heights - station_elevations)/1000.0
+
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        earth_center_angle, beam_distance = _solveBeamTriangle(
+                localized_radius, height_of_beam_end, WSR88D_LOW_ANGLE)
+
+        # if our beam_distance is too high then check the highest beam
+        too_far = beam_distance > WSR88D_BEAM_DISTANCE
+        high_center_angle, high_beam_distance = _solveBeamTriangle(
+                localized_radius, height_of_beam_end, WSR88D_HIGH_ANGLE)
+
+        # if we still don't have a reasonable beam distance the height is not available
+        available &= ~(too_far & (high_beam_distance > WSR88D_BEAM_DISTANCE))
+
+        # If beam distance is fine, solve for this height at max beam_distance so we can
+        # get the appropriate ground distance for the radar's radius at this height
+        # (law of cosines in its half angle form, which keeps precision for thin triangles)
+        height_km = height_of_beam_end - localized_radius
+        max_beam_center_angle = 2*numpy.arcsin(numpy.sqrt(
+                (WSR88D_BEAM_DISTANCE**2 - height_km**2) / (4*localized_radius*height_of_beam_end)))
+        earth_center_angle = numpy.where(too_far, max_beam_center_angle, earth_center_angle)
+
+    # the ground distance is the circular segment with angle earth_center_angle and r of localized_radius
+    # this assumes a smooth earth (and a shperical cow)
+    ground_distance = earth_center_angle * localized_radius * 1000
+    return numpy.where(available, ground_distance, numpy.nan)
+
+
+def _solveBeamTriangle(localized_radius, height_of_beam_end, beam_angle):
+    """Solve the beam triangle for a beam leaving the radar at beam_angle.
+
+    The angle at the radar site is 90 degrees + beam angle, opposite the side
+    height_of_beam_end. The law of sines gives the (acute) angle at the beam end and
+    the earth center angle closes the triangle.
+
+    returns: tuple of (earth_center_angle, beam_distance in km)
+    """
+    radar_site_angle = math.radians(90) + beam_angle
+    beam_point_angle = numpy.arcsin(localized_radius*math.sin(radar_site_angle)/height_of_beam_end)
+    earth_center_angle = math.pi - radar_site_angle - beam_point_angle
+    beam_distance = height_of_beam_end*numpy.sin(earth_center_angle)/math.sin(radar_site_angle)
+    return earth_center_angle, beam_distance
+
+
+def _beamEndHeight(localized_radius, beam_angle):
+    """Height in km above the radar site of a beam at beam_angle after WSR88D_BEAM_DISTANCE."""
+    return numpy.sqrt(localized_radius**2 + WSR88D_BEAM_DISTANCE**2 +
+            2*localized_radius*WSR88D_BEAM_DISTANCE*math.sin(beam_angle)) - localized_radius
+
+
+def _buildRadiusTable():
+    """Tabulate radius versus height above each station.
+
+    The radius grows with height until the lowest beam runs out of range, then shrinks
+    along the maximum beam distance until the highest beam runs out of range. Each of
+    those two segments gets RADIUS_TABLE_POINTS evenly spaced heights so the kink
+    between them is a table point and linear interpolation stays accurate.
+
+    returns: tuple of (table, kink heights, top heights) with heights in meters above
+        the station and table shaped (stations, 2, RADIUS_TABLE_POINTS)
+    """
+    localized_radius = EARTH_RADIUS_KM + STATION_ELEVATIONS/1000.0
+    kink_heights = _beamEndHeight(localized_radius, WSR88D_LOW_ANGLE)*1000
+    top_heights = numpy.minimum(_beamEndHeight(localized_radius, WSR88D_HIGH_ANGLE)*1000,
+            MAX_BEAM_HEIGHT - STATION_ELEVATIONS)
+
+    steps = numpy.linspace(0.0, 1.0, RADIUS_TABLE_POINTS)
+    low_heights = kink_heights[:, None]*steps
+    high_heights = kink_heights[:, None] + (top_heights - kink_heights)[:, None]*steps
+
+    # the top table point sits exactly where the highest beam runs out of range, step
+    # a micrometer down so rounding can't push it out of coverage
+    high_heights[:, -1] -= 1e-6
+
+    elevations = STATION_ELEVATIONS[:, None]
+    table = numpy.stack([
+        beamRadiusAtHeight(elevations + low_heights, elevations),
+        beamRadiusAtHeight(elevations + high_heights, elevations)], axis=1)
+    # the lowest table point is the station itself, which has no coverage but radius 0
+    table[:, 0, 0] = 0.0
+
+    return table, kink_heights, top_heights
+
+
+_RADIUS_TABLE, _RADIUS_KINK_HEIGHTS, _RADIUS_TOP_HEIGHTS = _buildRadiusTable()
+
+
+def stationRadiiAtHeight(height):
+    """Radius of every station at the specified height, interpolated from the radius table.
+
+    height: height above sea level in meters
+
+    returns: numpy array of ground distance radius in meters ordered like STATION_INDEX,
+        NaN where the height is not available for the station
+    """
+    above_station = height - STATION_ELEVATIONS
+    available = ((height <= MAX_BEAM_HEIGHT) & (STATION_ELEVATIONS <= MAX_STATION_ELEVATION) &
+            (above_station > 0) & (above_station <= _RADIUS_TOP_HEIGHTS))
+
+    high = above_station > _RADIUS_KINK_HEIGHTS
+    position = numpy.where(high,
+            (above_station - _RADIUS_KINK_HEIGHTS) / (_RADIUS_TOP_HEIGHTS - _RADIUS_KINK_HEIGHTS),
+            above_station / _RADIUS_KINK_HEIGHTS) * (RADIUS_TABLE_POINTS - 1)
+    position = numpy.clip(position, 0, RADIUS_TABLE_POINTS - 1)
+    index = numpy.minimum(position.astype(int), RADIUS_TABLE_POINTS - 2)
+    fraction = position - index
+
+    rows = numpy.arange(len(STATION_IDS))
+    segment = high.astype(int)
+    radii = (_RADIUS_TABLE[rows, segment, index]*(1 - fraction) +
+            _RADIUS_TABLE[rows, segment, index + 1]*fraction)
+    return numpy.where(available, radii, numpy.nan)
@@ -3,16 +3,22 @@
 from functools import wraps
 from time import time
 
+from . import metrics
+
 
 def timing(f):
 	'''
 	see https://codereview.stackexchange.com/questions/169870/decorator-to-measure-execution-time-of-a-function
+	also records every call as a metrics stage named after f, so repeated and nested
+	calls can be collected with metrics.snapshot() when metrics are enabled
 	'''
+	timed = metrics.stage(f.__name__)(f)
+
 	@wraps(f)
 	def wrapper(*args, **kwargs):
 		start = time()
-		result = f(*args, **kwargs)
+		result = timed(*args, **kwargs)
 		end = time()
 		print(f'Elapsed time running {f.__name__}: {(end - start) / 60} minutes')
 		return result
-	return wrapper
\ No newline at end of file
+	return wrapper
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+
+import numpy
+import pytest
+
+from context import nexradpy
+
+from nexradpy import accumulation
+
+
+def minutes(*values):
+    return [numpy.datetime64('2014-07-03T00:00') + numpy.timedelta64(value, 'm') for value in values]
+
+
+def test_hours_close_as_scans_pass_them():
+    accumulator = accumulation.HourlyAccumulator((2,))
+    times = minutes(0, 4, 13, 20, 29, 37, 44, 52, 58, 61, 70, 80, 87, 97, 104, 113, 120)
+
+    emitted = []
+    for i, scan_time in enumerate(times):
+        hours = accumulator.add(scan_time, numpy.array([6.0, numpy.nan if i == 3 else 6.0]))
+        # the first hour comes out with the first scan after 01:00 and not before
+        assert bool(hours) == (scan_time in minutes(61, 120))
+        emitted.extend(hours)
+    assert accumulator.flush() == []
+
+    assert [hour for hour, total, covered in emitted] == minutes(0, 60)
+    hour, total, covered = emitted[0]
+    numpy.testing.assert_allclose(total[0], 6.0)
+    numpy.testing.assert_allclose(covered, [1.0, (60 - 16) / 60.0])
+
+
+def test_linear_rates_gaps_and_offset():
+    rates = [0.0, 6.0, 12.0, 12.0, 12.0]
+    scans = [(time, numpy.array([rate])) for time, rate in zip(minutes(0, 10, 20, 60, 70), rates)]
+    hours = list(accumulation.hourly_totals(scans, (1,), max_gap=15 * 60, hour_offset=5 * 60))
+
+    # hours run from :05, the 00:20-01:00 gap is too long to integrate
+    assert [hour for hour, total, covered in hours] == minutes(-55, 5, 65)
+    numpy.testing.assert_allclose([total[0] for hour, total, covered in hours],
+                                  [1.5 * 5 / 60, 4.5 * 5 / 60 + 9.0 * 10 / 60 + 12.0 * 5 / 60, 12.0 * 5 / 60])
+    numpy.testing.assert_allclose([covered[0] for hour, total, covered in hours], [5 / 60, 20 / 60, 5 / 60])
+
+
+def test_hours_inside_a_long_gap_are_missing():
+    scans = [(time, numpy.array([6.0, 0.0])) for time in minutes(0, 10, 200, 210)]
+    hours = list(accumulation.hourly_totals(scans, (2,)))
+
+    # 01:00 and 02:00 had no scans at all, they come out as NaN rather than 0 mm
+    assert [hour for hour, total, covered in hours] == minutes(0, 60, 120, 180)
+    numpy.testing.assert_allclose(hours[0][1], [1.0, 0.0])
+    for hour, total, covered in hours[1:3]:
+        assert numpy.isnan(total).all() and (covered == 0).all()
+    numpy.testing.assert_allclose(hours[3][2], [10 / 60, 10 / 60])
+
+
+def test_out_of_order_scans_rejected():
+    accumulator = accumulation.HourlyAccumulator((1,))
+    accumulator.add(minutes(10)[0], numpy.zeros(1))
+    with pytest.raises(ValueError):
+        accumulator.add(minutes(5)[0], numpy.zeros(1))
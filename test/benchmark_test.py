@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+
+import json
+import pytest
+
+from context import nexradpy
+
+pytest.importorskip("pyart")
+from nexradpy import benchmark, clean, nexrad
+
+
+def test_small_run_writes_report(tmp_path):
+    cache_dir = clean.CACHE_DIR
+    output = tmp_path / 'benchmark.json'
+    report = benchmark.run(str(output), repeats=1, size='small')
+
+    with open(str(output)) as f:
+        assert json.load(f) == json.loads(json.dumps(report))
+    assert set(report['results']) == {'station_search', 'listing', 'download', 'grid_cold', 'grid',
+                                      'grid_pyart', 'ibounds_cold', 'ibounds', 'flatten', 'flatten_parallel'}
+    for timing in report['results'].values():
+        assert timing['repeats'] == 1
+        assert timing['min'] > 0
+    assert report['results']['download']['bytes'] == 4 * benchmark.SIZES['small']['file_bytes']
+    # both flatten runs walk the whole generated tree and write the same rows
+    flatten = report['results']['flatten']
+    assert flatten['files'] == benchmark.SIZES['small']['level3_files'] * len(benchmark.LEVEL3_PRODUCTS)
+    assert flatten['rows'] == report['results']['flatten_parallel']['rows'] > 0
+    # the repo cache is left alone
+    assert clean.CACHE_DIR == cache_dir
+    assert nexrad.read_level3 is not benchmark.read_synthetic_level3
+
+
+def test_compare_flags_regressions():
+    baseline = {'results': {'grid': {'median': 1.0}, 'listing': {'median': 1.0}}}
+    current = {'results': {'grid': {'median': 1.1}, 'listing': {'median': 2.0}, 'new': {'median': 1.0}}}
+    assert benchmark.compare(baseline, current) == {'listing': 2.0}
+    assert benchmark.compare(baseline, current, threshold=1.05) == {'grid': pytest.approx(1.1), 'listing': 2.0}
@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+
+import calendar
+import datetime
+import time
+
+from context import nexradpy
+from nexradpy.catalog import S3ListingCatalog
+
+
+def test_closed_day_never_expires():
+    catalog = S3ListingCatalog(':memory:', current_day_ttl=0)
+    catalog.putMany({"2015/05/05/KOKX": ["2015/05/05/KOKX/KOKX20150505_050626_V06.gz"], "2015/05/06/KOKX": []})
+    time.sleep(0.01)
+    assert catalog.get("2015/05/05/KOKX") == ["2015/05/05/KOKX/KOKX20150505_050626_V06.gz"]
+    assert catalog.get("2015/05/06/KOKX") == []
+    assert catalog.get("2015/05/07/KOKX") is None
+
+
+def test_current_day_expires():
+    today = datetime.datetime.utcnow().strftime("%Y/%m/%d/KOKX")
+    catalog = S3ListingCatalog(':memory:', current_day_ttl=60)
+    catalog.putMany({today: ["a"]})
+    assert catalog.get(today) == ["a"]
+
+    catalog.current_day_ttl = 0
+    time.sleep(0.01)
+    assert catalog.get(today) is None
+
+
+def test_listing_made_during_its_day_expires_after_midnight():
+    yesterday = datetime.datetime.utcnow() - datetime.timedelta(days=1)
+    prefix = yesterday.strftime("%Y/%m/%d/KOKX")
+    catalog = S3ListingCatalog(':memory:', current_day_ttl=60)
+    catalog.putMany({prefix: ["a"]})
+    # listed at noon yesterday, while the folder was still filling
+    noon = calendar.timegm(yesterday.replace(hour=12, minute=0, second=0).timetuple())
+    with catalog.connection:
+        catalog.connection.execute('UPDATE listings SET listed_at = ?', (noon,))
+    assert catalog.get(prefix) is None
+
+    catalog.putMany({prefix: ["a", "b"]})
+    assert catalog.get(prefix) == ["a", "b"]
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+import json
+
+import numpy
+import pytest
+
+from context import nexradpy
+
+pyart = pytest.importorskip("pyart")
+from nexradpy import clean, gridding
+
+
+def make_grid():
+    grid = pyart.testing.make_empty_grid((1, 41, 41), ((2000, 2000), (-60000.0, 60000.0), (-60000.0, 60000.0)))
+    grid.origin_latitude['data'][0] = 40.865
+    grid.origin_longitude['data'][0] = -72.864
+    grid.init_point_longitude_latitude()
+    grid.add_field('reflectivity', {'data': numpy.arange(41*41.0).reshape(1, 41, 41)})
+    return grid
+
+
+def test_grid_ibounds_match_point_loop(tmp_path, monkeypatch):
+    monkeypatch.setattr(clean, "CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(clean, "IBOUNDS_CACHE", str(tmp_path / "grid_ibounds.json"))
+    monkeypatch.setattr(clean, "_ibounds_cache", None)
+    grid = make_grid()
+    bbox = [-73.3, 40.6, -72.7, 41.0]
+
+    inside = [(i, j) for i, row in enumerate(grid.point_longitude['data'][0]) for j, lon in enumerate(row)
+              if bbox[0] <= lon <= bbox[2] and bbox[1] <= grid.point_latitude['data'][0][i][j] <= bbox[3]]
+    expected = (min(i for i, j in inside), max(i for i, j in inside),
+                min(j for i, j in inside), max(j for i, j in inside))
+
+    assert clean.get_grid_ibounds(grid, bbox) == expected
+    assert list(json.load(open(clean.IBOUNDS_CACHE)).values()) == [list(expected)]
+
+    # later scans on the same grid come from the cache
+    monkeypatch.setattr(clean, "_ibounds_cache", None)
+    monkeypatch.setattr(clean, "compute_grid_ibounds", None)
+    assert clean.get_grid_ibounds(make_grid(), bbox) == expected
+
+    trimmed = clean.trim_grid(grid, 'reflectivity', expected)
+    assert trimmed.shape == (1, expected[1] - expected[0] + 1, expected[3] - expected[2] + 1)
+    assert trimmed[0, 0, 0] == expected[0]*41 + expected[2]
+
+
+def test_unreadable_ibounds_cache_is_rebuilt(tmp_path, monkeypatch):
+    path = tmp_path / "grid_ibounds.json"
+    # ex. half written by another process
+    path.write_text('{"[[40.865, -72.864]')
+    monkeypatch.setattr(clean, "IBOUNDS_CACHE", str(path))
+    monkeypatch.setattr(clean, "_ibounds_cache", None)
+    bbox = [-73.3, 40.6, -72.7, 41.0]
+
+    bounds = clean.get_grid_ibounds(make_grid(), bbox)
+    assert list(json.load(open(str(path))).values()) == [list(bounds)]
+    assert [p.name for p in tmp_path.iterdir()] == ["grid_ibounds.json"]
+
+
+def test_bbox_grid_matches_full_grid(monkeypatch):
+    monkeypatch.setattr(gridding, "_weights_cache", {})
+    radar = pyart.testing.make_empty_ppi_radar(160, 180, 1)
+    radar.range['data'] = numpy.arange(160) * 250.0 + 125.0
+    radar.elevation['data'][:] = 0.5
+    radar.init_gate_x_y_z()
+    radar.init_gate_altitude()
+    radar.add_field('reflectivity', {'data': numpy.random.RandomState(0).uniform(0, 60, (180, 160))})
+    bbox = [-97.45, 36.55, -97.35, 36.62]
+
+    grid_shape, grid_limits = clean.bbox_grid_limits(radar, bbox, spacing=1000.0, height=500)
+    assert grid_shape[0] == 1 and grid_shape[1] < 15 and grid_shape[2] < 15
+    grid = clean.get_bbox_grid(radar, bbox, ['reflectivity'], spacing=1000.0, height=500)
+
+    # the bbox is covered
+    lons, lats = grid.get_point_longitude_latitude()
+    assert lons.min() <= bbox[0] and lons.max() >= bbox[2] and lats.min() <= bbox[1] and lats.max() >= bbox[3]
+
+    # and the bbox grid is the matching window of the full grid
+    full = clean.grid_from_radar(radar, (1, 81, 81), ((500, 500), (-40000.0, 40000.0), (-40000.0, 40000.0)),
+                                 ['reflectivity'])
+    i0 = int(grid_limits[1][0] / 1000.0) + 40
+    j0 = int(grid_limits[2][0] / 1000.0) + 40
+    window = full.fields['reflectivity']['data'][:, i0:i0 + grid_shape[1], j0:j0 + grid_shape[2]]
+    numpy.testing.assert_allclose(grid.fields['reflectivity']['data'], window)
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+import numpy
+import pytest
+
+from context import nexradpy
+
+pyart = pytest.importorskip("pyart")
+netCDF4 = pytest.importorskip("netCDF4")
+from nexradpy import cube, gridding
+
+
+BBOX = [-97.45, 36.55, -97.35, 36.62]
+
+
+def write_scan(path, minute):
+    radar = pyart.testing.make_empty_ppi_radar(160, 180, 1)
+    radar.range['data'] = numpy.arange(160) * 250.0 + 125.0
+    radar.elevation['data'][:] = 0.5
+    radar.time['units'] = 'seconds since 2015-05-05T05:%02d:00Z' % minute
+    radar.add_field('reflectivity', {'data': numpy.full((180, 160), float(minute)), 'units': 'dBZ'})
+    pyart.io.write_cfradial(str(path), radar)
+    return str(path)
+
+
+@pytest.mark.parametrize("processes", [1, 2])
+def test_scans_append_to_cube(tmp_path, monkeypatch, processes):
+    monkeypatch.setattr(gridding, "_weights_cache", {})
+    paths = [write_scan(tmp_path / ('scan%d.nc' % minute), minute) for minute in (0, 5, 10)]
+    bad = tmp_path / 'bad.nc'
+    bad.write_bytes(b'not a radar')
+    cube_path = str(tmp_path / 'cube.nc')
+
+    assert cube.grid_files_to_cube(paths[:2] + [str(bad)], cube_path, BBOX, spacing=1000.0,
+                                   processes=processes, verbose=False) == 2
+    # rerunning only appends the scans that are missing
+    assert cube.grid_files_to_cube(paths, cube_path, BBOX, spacing=1000.0,
+                                   processes=processes, verbose=False) == 1
+
+    dataset = netCDF4.Dataset(cube_path)
+    reflectivity = dataset.variables['reflectivity']
+    assert reflectivity.dimensions == ('time', 'y', 'x')
+    assert dataset.dimensions['time'].isunlimited()
+    assert reflectivity.chunking() == [1, len(dataset.dimensions['y']), len(dataset.dimensions['x'])]
+    assert reflectivity.filters()['zlib']
+    numpy.testing.assert_allclose(reflectivity[:, 2, 2], [0, 5, 10], atol=1e-4)
+
+    times = netCDF4.num2date(dataset.variables['time'][:], dataset.variables['time'].units)
+    assert [t.minute for t in times] == [0, 5, 10]
+    assert dataset.variables['lat'][:].min() <= BBOX[1]
+    dataset.close()
+
+
+def test_cube_rejects_other_fields(tmp_path, monkeypatch):
+    monkeypatch.setattr(gridding, "_weights_cache", {})
+    path = write_scan(tmp_path / 'scan0.nc', 0)
+    cube_path = str(tmp_path / 'cube.nc')
+    assert cube.grid_files_to_cube([path], cube_path, BBOX, spacing=1000.0, processes=1, verbose=False) == 1
+
+    with pytest.raises(ValueError):
+        cube.GridCube(cube_path, fields=['reflectivity', 'velocity'])
+    with pytest.raises(ValueError):
+        cube.grid_files_to_cube([path], cube_path, BBOX, fields=('velocity',), processes=1, verbose=False)
+    existing = cube.GridCube(cube_path, fields=['reflectivity'])
+    assert existing.fields == ['reflectivity'] and len(existing) == 1
+    existing.close()
+
+
+def test_pool_is_joined_on_success_and_terminated_on_error(tmp_path, monkeypatch):
+    calls = []
+
+    class FakePool:
+        def __init__(self, processes):
+            pass
+
+        def imap(self, function, tasks, chunksize):
+            return map(function, tasks)
+
+        def close(self):
+            calls.append('close')
+
+        def join(self):
+            calls.append('join')
+
+        def terminate(self):
+            calls.append('terminate')
+
+    monkeypatch.setattr(cube.multiprocessing, "Pool", FakePool)
+    monkeypatch.setattr(gridding, "_weights_cache", {})
+    path = write_scan(tmp_path / 'scan0.nc', 0)
+    assert cube.grid_files_to_cube([path], str(tmp_path / 'cube.nc'), BBOX, spacing=1000.0, processes=2,
+                                   verbose=False) == 1
+    assert calls == ['close', 'join']
+
+    del calls[:]
+    monkeypatch.setattr(cube.GridCube, "append", lambda self, scan_time, arrays: 1 / 0)
+    with pytest.raises(ZeroDivisionError):
+        cube.grid_files_to_cube([path], str(tmp_path / 'other.nc'), BBOX, spacing=1000.0, processes=2,
+                                verbose=False)
+    assert calls == ['terminate']
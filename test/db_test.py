@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+
+import io
+import threading
+
+import numpy
+import pytest
+
+from context import nexradpy
+
+pytest.importorskip("psycopg2")
+from nexradpy import db
+
+
+class FakeCursor:
+    def __init__(self, connection=None, fail=False):
+        self.connection = connection
+        self.fail = fail
+        self.copies = []
+        self.executed = []
+
+    def execute(self, query, values=None):
+        if self.fail:
+            raise RuntimeError('lock timeout')
+        self.executed.append((query, values, self.connection.autocommit))
+
+    def copy_expert(self, query, buf):
+        self.copies.append((query, buf.read()))
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self, fail=False):
+        self.cursor_obj = FakeCursor(self, fail)
+        self.autocommit = False
+        self.commits = 0
+
+    def cursor(self):
+        return self.cursor_obj
+
+    def commit(self):
+        self.commits += 1
+
+
+class FakePool:
+    def __init__(self, maxconn=8, fail=False):
+        self.maxconn = maxconn
+        self.fail = fail
+        self.connections = []
+        self.returned = []
+        self.lock = threading.Lock()
+
+    def getconn(self):
+        with self.lock:
+            # like psycopg2's pools, no more than maxconn connections out at once
+            if len(self.connections) - len(self.returned) >= self.maxconn:
+                raise db.psycopg2.pool.PoolError("connection pool exhausted")
+            self.connections.append(FakeConnection(self.fail))
+            return self.connections[-1]
+
+    def putconn(self, conn):
+        with self.lock:
+            self.returned.append(conn)
+
+
+def make_columns(rows, minute=56):
+    return {
+        'name': numpy.full(rows, 'NYC', dtype=object),
+        'product': numpy.full(rows, 'N1P', dtype=object),
+        'azimuth': numpy.arange(rows, dtype=numpy.int16),
+        'dist': numpy.full(rows, 91500.0, dtype=numpy.float32),
+        'lon': numpy.full(rows, -73.9),
+        'lat': numpy.full(rows, 40.7),
+        'observation': numpy.ma.masked_array(numpy.full(rows, 1.5, dtype=numpy.float32), numpy.arange(rows) == 0),
+        'month': numpy.full(rows, 7, dtype=numpy.int8),
+        'day': numpy.full(rows, 3, dtype=numpy.int8),
+        'hour': numpy.full(rows, 17, dtype=numpy.int8),
+        'minute': numpy.full(rows, minute, dtype=numpy.int8),
+        'scan_time': numpy.full(rows, numpy.datetime64('2014-07-03T17:56:00'), dtype='datetime64[s]'),
+    }
+
+
+def test_copy_batches_and_commits(monkeypatch):
+    monkeypatch.setattr(db, "_partitions", set())
+    pool = FakePool()
+    loader = db.BulkLoader(db_pool=pool, copy_rows=10, commit_rows=20)
+    for i in range(5):
+        loader.write(make_columns(6))
+    loader.close()
+
+    connection = pool.connections[0]
+    copies = connection.cursor_obj.copies
+    # 12 rows per COPY, commits once 20 rows are uncommitted and on close
+    assert [text.count('\n') for query, text in copies] == [12, 12, 6]
+    assert connection.commits == 2
+    # the partition connection came and went before the first COPY
+    assert pool.returned == [pool.connections[1], connection] and loader.rows == 30
+
+    query, text = copies[0]
+    assert query.startswith('COPY ' + db.partition_name('observations', numpy.datetime64('2014-07'), 'NYC') +
+                            ' (name, product, azimuth, dist, lon, lat, observation,')
+    assert text.splitlines()[:2] == ['NYC,N1P,0,91500.0,-73.9,40.7,,2014-07-03 17:56:00',
+                                     'NYC,N1P,1,91500.0,-73.9,40.7,1.5,2014-07-03 17:56:00']
+
+
+def test_parallel_writers_use_their_own_connections(monkeypatch):
+    monkeypatch.setattr(db, "_partitions", set())
+    pool = FakePool()
+    sources = [[make_columns(5, minute)] * 3 for minute in range(4)]
+    assert db.load_parallel(sources, db_pool=pool) == 60
+    # a writer per source plus the partition connection
+    assert len(pool.connections) == 5 and len(pool.returned) == 5
+
+
+def test_more_sources_than_connections(monkeypatch):
+    monkeypatch.setattr(db, "_partitions", set())
+    pool = FakePool(maxconn=3)
+    sources = [[make_columns(5, minute)] * 2 for minute in range(10)]
+    assert db.load_parallel(sources, db_pool=pool) == 100
+    assert len(pool.connections) == len(pool.returned) == 11
+
+
+def test_load_parallel_without_sources_or_pool(monkeypatch):
+    monkeypatch.setattr(db, "pool", None)
+    assert db.load_parallel([]) == 0
+    with pytest.raises(ValueError):
+        db.load_parallel([[make_columns(5)]])
+
+
+def test_benchmark_never_drops_the_default_table():
+    with pytest.raises(ValueError):
+        db.benchmark(table_name=db.TABLE)
+
+
+def test_partitions_created_once_per_month_and_station(monkeypatch):
+    monkeypatch.setattr(db, "_partitions", set())
+    pool = FakePool()
+    columns = make_columns(4)
+    columns['scan_time'] = numpy.array(['2014-07-31T23:56', '2014-08-01T00:01'] * 2, dtype='datetime64[s]')
+    columns['name'] = numpy.array(['NYC', 'NYC', 'JFK Airport', 'JFK Airport'], dtype=object)
+
+    loader = db.BulkLoader(db_pool=pool, copy_rows=1)
+    loader.write(columns)
+    loader.write(columns)
+    loader.close()
+
+    # the writer never runs DDL, partitions are made once on an autocommit connection
+    assert pool.connections[0].cursor_obj.executed == []
+    assert len(pool.connections) == 2 and pool.connections[1] in pool.returned
+    executed = pool.connections[1].cursor_obj.executed
+    assert all(autocommit for query, values, autocommit in executed)
+    assert not pool.connections[1].autocommit
+    tables = [query.split()[5] for query, values, autocommit in executed if query.startswith('CREATE TABLE')]
+    months = [numpy.datetime64('2014-07'), numpy.datetime64('2014-08')]
+    assert sorted(set(tables)) == sorted(['observations_201407', 'observations_201408'] +
+                                         [db.partition_name('observations', month, name)
+                                          for month in months for name in ('NYC', 'JFK Airport')])
+    assert len(tables) == 8
+    assert executed[0][0] == 'SET lock_timeout = %s' and executed[-1][0] == 'RESET lock_timeout'
+    assert ('CREATE TABLE IF NOT EXISTS observations_201407 PARTITION OF observations '
+            'FOR VALUES FROM (%s) TO (%s) PARTITION BY LIST (name)', ['2014-07-01', '2014-08-01'], True) in executed
+    brin = [query for query, values, autocommit in executed if 'USING brin (scan_time)' in query]
+    assert len(brin) == 4
+
+    # each partition gets its own rows
+    copies = pool.connections[0].cursor_obj.copies
+    assert sorted(query.split()[1] for query, text in copies[:4]) == sorted(
+            db.partition_name('observations', month, name) for month in months for name in ('NYC', 'JFK Airport'))
+    assert all(text.count('\n') == 1 for query, text in copies)
+
+
+def test_failed_partition_is_not_remembered(monkeypatch):
+    monkeypatch.setattr(db, "_partitions", set())
+    with pytest.raises(RuntimeError):
+        db.ensure_partitions([(numpy.datetime64('2014-07'), 'NYC')], db_pool=FakePool(fail=True))
+    assert db._partitions == set()
+
+    pool = FakePool()
+    db.ensure_partitions([(numpy.datetime64('2014-07'), 'NYC')], db_pool=pool)
+    assert db._partitions == {('observations', numpy.datetime64('2014-07'), 'NYC')}
+
+
+def test_partition_names_are_unique_and_fit():
+    month = numpy.datetime64('2014-07')
+    names = ['JFK Airport', 'jfk_airport', 'JFK-AIRPORT', 'Station ' + 'x' * 80 + ' 1', 'Station ' + 'x' * 80 + ' 2']
+    partitions = [db.partition_name('observations', month, name) for name in names]
+    assert len(set(partitions)) == len(names)
+    assert all(len(partition) <= db.MAX_PARTITION_NAME for partition in partitions)
+    assert partitions[0].startswith('observations_201407_jfk_airport_')
+
+
+def test_loader_needs_a_connection(monkeypatch):
+    monkeypatch.setattr(db, "pool", None)
+    with pytest.raises(ValueError):
+        db.BulkLoader()
+
+
+def test_writer_commits_before_new_partitions(monkeypatch):
+    monkeypatch.setattr(db, "_partitions", set())
+    pool = FakePool()
+    loader = db.BulkLoader(db_pool=pool, copy_rows=1, commit_rows=100)
+    loader.write(make_columns(3))
+    # rows of a known partition neither commit nor wait on the partition lock
+    monkeypatch.setattr(db, "_partitions_lock", None)
+    loader.write(make_columns(3))
+    assert pool.connections[0].commits == 0
+    monkeypatch.setattr(db, "_partitions_lock", threading.Lock())
+
+    # a new month commits the open transaction before its DDL
+    columns = make_columns(3)
+    columns['scan_time'] = numpy.full(3, numpy.datetime64('2014-08-01T00:01:00'), dtype='datetime64[s]')
+    loader.write(columns)
+    assert pool.connections[0].commits == 1 and loader.uncommitted == 3
+    loader.close()
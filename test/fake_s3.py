@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+import hashlib
+import time
+
+
+class FakeKey:
+
+    def __init__(self, name, data):
+        self.name = name
+        self.data = data
+        self.size = len(data)
+        self.etag = '"%s"' % hashlib.md5(data).hexdigest()
+
+    def get_file(self, fp, headers=None):
+        offset = 0
+        if headers and "Range" in headers:
+            offset = int(headers["Range"][len("bytes="):-1])
+        fp.write(self.data[offset:])
+
+
+class FakeBucket:
+    """Stand-in for a boto bucket holding NEXRAD style keys in memory"""
+
+    def __init__(self, keys):
+        self.keys = keys
+        self.list_calls = 0
+        self.markers = []
+        self.bytes_sent = 0
+
+    def get_key(self, name):
+        if name not in self.keys:
+            return None
+        bucket = self
+
+        class CountingKey(FakeKey):
+            def get_file(self, fp, headers=None):
+                start = fp.tell()
+                super().get_file(fp, headers)
+                bucket.bytes_sent += fp.tell() - start
+
+        return CountingKey(name, self.keys[name])
+
+    def list(self, prefix="", delimiter="", marker=""):
+        self.list_calls += 1
+        if marker:
+            self.markers.append(marker)
+        return [FakeKey(name, data) for name, data in sorted(self.keys.items())
+                if name.startswith(prefix) and name > marker]
+
+
+class SlowFlakyBucket(FakeBucket):
+    """FakeBucket that adds latency to every listing and fails the first ones"""
+
+    def __init__(self, keys, latency=0.0, failures=0):
+        super().__init__(keys)
+        self.latency = latency
+        self.failures = failures
+
+    def list(self, prefix="", delimiter="", marker=""):
+        time.sleep(self.latency)
+        if self.failures > 0:
+            self.failures -= 1
+            raise OSError("connection reset")
+        return super().list(prefix, delimiter, marker)
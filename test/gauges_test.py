@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+import os
+
+import numpy
+import pytest
+
+from context import nexradpy
+
+pd = pytest.importorskip("pandas")
+pytest.importorskip("pyarrow")
+from nexradpy import gauges
+
+
+def write_csv(path):
+    rows = ['station,valid,lon,lat,p01i']
+    for station, lon, lat in (('JFK', -73.76, 40.63), ('LGA', -73.88, 40.78), ('NYC', -73.97, 40.78)):
+        for hour, value in zip(pd.date_range('2013-12-31 22:51', periods=6, freq='60min'), ['0.00', 'T', 'M', '0.12', '0.01', '0.00']):
+            rows.append('%s,%s,%s,%s,%s' % (station, hour.strftime('%Y-%m-%d %H:%M'), lon, lat, value))
+    path.write_text('\n'.join(rows) + '\n')
+    return str(path)
+
+
+def test_load_filters_and_reuses_cache(tmp_path, monkeypatch):
+    path = write_csv(tmp_path / 'gauges.csv')
+    cache_dir = str(tmp_path / 'cache')
+
+    frame = gauges.load_gauges(path, cache_dir=cache_dir)
+    assert len(frame) == 18
+    assert frame['valid'].dtype.kind == 'M' and frame['p01i'].dtype == numpy.float32
+    assert frame['p01i'][:3].tolist()[1] == pytest.approx(gauges.TRACE_VALUE)
+    assert numpy.isnan(frame['p01i'][2])
+
+    # later loads read the cache only
+    monkeypatch.setattr(gauges, "read_csv", None)
+    lga = gauges.load_gauges(path, stations=['LGA'], start='2014-01-01 00:00', end='2014-01-01 02:00',
+                             columns=['p01i'], cache_dir=cache_dir)
+    assert list(lga.columns) == ['station', 'valid', 'p01i']
+    assert lga['station'].tolist() == ['LGA', 'LGA']
+    assert lga['valid'].tolist() == [pd.Timestamp('2014-01-01 00:51'), pd.Timestamp('2014-01-01 01:51')]
+
+    # editing the csv invalidates the cache
+    monkeypatch.undo()
+    with open(path, 'a') as f:
+        f.write('EWR,2014-01-01 03:51,-74.17,40.69,0.30\n')
+    assert gauges.load_gauges(path, stations=['EWR'], cache_dir=cache_dir)['p01i'].tolist() == [pytest.approx(0.3)]
+
+
+def test_csv_hashed_only_when_it_changes(tmp_path, monkeypatch):
+    path = write_csv(tmp_path / 'gauges.csv')
+    cache_dir = str(tmp_path / 'cache')
+    hashed = []
+    file_hash = gauges.file_hash
+    monkeypatch.setattr(gauges, "file_hash", lambda path: hashed.append(path) or file_hash(path))
+
+    target = gauges.build_cache(path, cache_dir)
+    assert gauges.load_gauges(path, cache_dir=cache_dir).shape[0] == 18
+    assert len(hashed) == 1
+
+    # a new mtime is hashed again, same contents keep the same cache
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert gauges.build_cache(path, cache_dir) == target and len(hashed) == 2
+
+
+def test_cache_built_by_another_process_is_kept(tmp_path, monkeypatch):
+    path = write_csv(tmp_path / 'gauges.csv')
+    cache_dir = str(tmp_path / 'cache')
+    read_csv = gauges.read_csv
+    built = []
+
+    def racing_read_csv(path, **args):
+        # another process finishes the cache while this one is still parsing
+        monkeypatch.setattr(gauges, "read_csv", read_csv)
+        built.append(gauges.build_cache(path, cache_dir))
+        return read_csv(path, **args)
+
+    monkeypatch.setattr(gauges, "read_csv", racing_read_csv)
+    target = gauges.build_cache(path, cache_dir)
+    assert built == [target]
+    assert sorted(os.listdir(cache_dir)) == [gauges.HASHES_FILE, os.path.basename(target)]
+    assert len(gauges.load_gauges(path, cache_dir=cache_dir)) == 18
+
+
+def test_metadata_without_times_is_cached(tmp_path, monkeypatch):
+    path = tmp_path / 'metadata.csv'
+    path.write_text('station,lat,lon\nLGA,40.78,-73.88\nJFK,40.63,-73.76\nNYC,40.78,-73.97\n')
+    cache_dir = str(tmp_path / 'cache')
+
+    with pytest.raises(ValueError):
+        gauges.load_gauges(str(path), cache_dir=cache_dir)
+    frame = gauges.load_metadata(str(path), cache_dir=cache_dir)
+    assert frame['station'].tolist() == ['JFK', 'LGA', 'NYC']
+    assert frame['lat'].dtype == numpy.float32
+
+    monkeypatch.setattr(gauges, "read_csv", None)
+    lga = gauges.load_metadata(str(path), stations=['LGA'], columns=['lat'], cache_dir=cache_dir)
+    assert list(lga.columns) == ['station', 'lat'] and lga['lat'].tolist() == [pytest.approx(40.78)]
+    with pytest.raises(ValueError):
+        gauges.load_gauges(str(path), start='2014-01-01', cache_dir=cache_dir, time_column=None)
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+
+import numpy
+import pytest
+
+from context import nexradpy
+
+pyart = pytest.importorskip("pyart")
+from nexradpy import gridding
+
+
+GRID_SHAPE = (3, 21, 21)
+GRID_LIMITS = ((500, 3000), (-20000.0, 20000.0), (-20000.0, 20000.0))
+
+
+def make_radar(seed=0, azimuth_jitter=0.0):
+    radar = pyart.testing.make_empty_ppi_radar(120, 90, 3)
+    radar.range['data'] = numpy.arange(120) * 250.0 + 125.0
+    radar.azimuth['data'] = (numpy.tile(numpy.arange(90) * 4.0, 3) + azimuth_jitter) % 360
+    radar.elevation['data'] = numpy.repeat([0.5, 1.5, 2.5], 90).astype(float)
+    radar.fixed_angle['data'] = numpy.array([0.5, 1.5, 2.5])
+    radar.init_gate_x_y_z()
+    radar.init_gate_altitude()
+
+    rng = numpy.random.RandomState(seed)
+    data = numpy.ma.masked_array(rng.uniform(-10, 60, (270, 120)), rng.uniform(size=(270, 120)) < 0.1)
+    radar.add_field('reflectivity', {'data': data, 'units': 'dBZ'})
+    return radar
+
+
+def test_weights_match_grid_from_radars():
+    radar = make_radar()
+    expected = pyart.map.grid_from_radars((radar,), GRID_SHAPE, GRID_LIMITS, fields=['reflectivity'])
+    grid = gridding.grid_from_radar(radar, GRID_SHAPE, GRID_LIMITS, ['reflectivity'])
+
+    expected = expected.fields['reflectivity']['data']
+    data = grid.fields['reflectivity']['data']
+    assert numpy.array_equal(numpy.ma.getmaskarray(data), numpy.ma.getmaskarray(expected))
+    # pyart accumulates in float32
+    numpy.testing.assert_allclose(data.compressed(), expected.compressed(), rtol=1e-4, atol=1e-3)
+    assert grid.origin_latitude['data'][0] == radar.latitude['data'][0]
+
+
+def test_weights_reused_across_scans(tmp_path, monkeypatch):
+    monkeypatch.setattr(gridding, "_weights_cache", {})
+    weights = gridding.get_grid_weights(make_radar(), GRID_SHAPE, GRID_LIMITS, cache_dir=str(tmp_path))
+
+    # a later scan with slightly different azimuths is gridded with the same weights
+    later = make_radar(seed=1, azimuth_jitter=0.3)
+    assert gridding.get_grid_weights(later, GRID_SHAPE, GRID_LIMITS, cache_dir=str(tmp_path)) is weights
+    assert numpy.array_equal(weights.ray_order(later), numpy.arange(270))
+
+    # and the persisted weights load without rebuilding
+    monkeypatch.setattr(gridding, "_weights_cache", {})
+    monkeypatch.setattr(gridding, "build_grid_weights", None)
+    loaded = gridding.get_grid_weights(later, GRID_SHAPE, GRID_LIMITS, cache_dir=str(tmp_path))
+    assert (loaded.matrix != weights.matrix).nnz == 0
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+
+import os
+import subprocess
+import sys
+
+from context import nexradpy
+
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+# seconds for a fresh interpreter to import nexradpy and look up stations, pyart alone
+# takes several seconds to import
+IMPORT_BUDGET = 0.75
+HEAVY_MODULES = ['boto', 'pyart', 'pandas', 'matplotlib', 'geopandas', 'rtree', 'utm', 'scipy',
+                 'netCDF4', 'pyarrow', 'psycopg2']
+
+SCRIPT = '''
+import sys, time
+start = time.perf_counter()
+%s
+print(time.perf_counter() - start)
+print(' '.join(module for module in %r if module in sys.modules))
+'''
+
+
+def run(code):
+    '''
+    returns: seconds code took in a fresh interpreter, list of HEAVY_MODULES it loaded
+    '''
+    output = subprocess.check_output([sys.executable, '-c', SCRIPT % (code, HEAVY_MODULES)], cwd=ROOT,
+                                     universal_newlines=True).splitlines()
+    return float(output[-2]), output[-1].split()
+
+
+def test_station_lookup_within_budget():
+    code = ('import nexradpy\n'
+            'assert "KOKX" in nexradpy.getStationsFromDomain(40.901954, -73.632802, 40.460969, -74.363177, 20000)')
+    # best of a few runs so a busy machine doesn't fail the budget
+    timings = [run(code) for _ in range(3)]
+    assert min(seconds for seconds, loaded in timings) < IMPORT_BUDGET
+    assert timings[0][1] == []
+
+
+def test_submodules_defer_pyart():
+    seconds, loaded = run('from nexradpy import clean, cube, gridding, nexrad, s3_nexrad_search')
+    assert 'pyart' not in loaded
+    assert 'boto' not in loaded
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+import numpy
+import pytest
+
+from context import nexradpy
+
+pd = pytest.importorskip("pandas")
+pytest.importorskip("scipy")
+from nexradpy import matching
+
+
+def make_gauges():
+    return pd.DataFrame({'station': ['JFK', 'LGA'], 'lat': [40.63, 40.78], 'lon': [-73.76, -73.88]})
+
+
+def make_observations():
+    hours = pd.date_range('2014-07-03 00:51', periods=3, freq='60min')
+    return pd.DataFrame({'station': ['JFK'] * 3 + ['LGA'] * 3, 'valid': list(hours) * 2,
+                         'p01i': [0.0, 0.1, numpy.nan, 0.2, 0.3, 0.4]})
+
+
+def test_nearest_points_match_brute_force():
+    lats, lons = numpy.meshgrid(numpy.linspace(40.4, 41.0, 31), numpy.linspace(-74.2, -73.4, 41), indexing='ij')
+    locator = matching.get_locator('test-grid', lats, lons)
+    assert matching.get_locator('test-grid', None, None) is locator
+
+    matches = matching.nearest_points(make_gauges(), locator)
+    for gauge, point in zip(make_gauges().itertuples(), matches['point']):
+        brute = numpy.argmin((lats.ravel() - gauge.lat)**2 + ((lons.ravel() - gauge.lon) * numpy.cos(numpy.radians(gauge.lat)))**2)
+        assert point == brute
+    assert (matches['distance'] < 1500).all()
+
+
+def test_match_scans_pairs_each_hour_with_its_window():
+    scan_times = pd.to_datetime(['2014-07-03 00:05', '2014-07-03 00:51', '2014-07-03 01:20',
+                                 '2014-07-03 00:30', '2014-07-03 02:55']).values
+    matched = matching.match_scans(make_observations(), scan_times)
+
+    jfk = matched[matched['station'] == 'JFK']
+    # (23:51, 00:51] has 00:05, 00:30, 00:51, (00:51, 01:51] has 01:20, (01:51, 02:51] none
+    assert jfk['scan'].tolist() == [0, 3, 1, 2]
+    assert jfk['valid'].dt.hour.tolist() == [0, 0, 0, 1]
+
+    latest = matching.latest_scan(make_observations(), scan_times)
+    # 02:51 is more than an hour after the 01:20 scan
+    assert latest['scan'].tolist()[:2] == [1, 2] and numpy.isnan(latest['scan'][2])
+    assert latest['valid'].tolist() == make_observations()['valid'].tolist()
+
+
+def test_training_set_averages_scans_and_points():
+    lats, lons = numpy.meshgrid(numpy.linspace(40.5, 40.9, 5), numpy.linspace(-74.0, -73.6, 5), indexing='ij')
+    locator = matching.PointLocator(lats, lons)
+    scan_times = pd.to_datetime(['2014-07-03 00:10', '2014-07-03 00:40', '2014-07-03 01:30']).values
+    values = numpy.arange(3 * 25, dtype=float).reshape(3, 5, 5)
+
+    result = matching.training_set(make_gauges(), make_observations(), scan_times, values, locator)
+    point = matching.nearest_points(make_gauges(), locator)['point'].tolist()
+
+    assert result['station'].tolist() == ['JFK', 'JFK', 'LGA', 'LGA']
+    assert result['scans'].tolist() == [2, 1, 2, 1]
+    assert result['radar'].tolist() == [(point[0] + point[0] + 25) / 2.0, point[0] + 50,
+                                        (point[1] + point[1] + 25) / 2.0, point[1] + 50]
+    assert result['p01i'].tolist() == [0.0, 0.1, 0.2, 0.3]
+
+
+class OrthogonalArray:
+    # indexes each axis on its own like a netCDF4 variable, recording what is read
+    def __init__(self, values):
+        self.values = values
+        self.shape = values.shape
+        self.reads = []
+
+    def __getitem__(self, key):
+        box = self.values[numpy.ix_(*key)]
+        self.reads.append(box.shape)
+        return box
+
+
+def test_training_set_reads_matched_points_in_scan_chunks():
+    lats, lons = numpy.meshgrid(numpy.linspace(40.5, 40.9, 50), numpy.linspace(-74.0, -73.6, 60), indexing='ij')
+    locator = matching.PointLocator(lats, lons)
+    scan_times = pd.date_range('2014-07-02 23:55', '2014-07-03 02:50', freq='5min').values
+    values = numpy.random.RandomState(0).uniform(0, 10, (len(scan_times), 50, 60))
+    gauges = make_gauges().rename(columns={'station': 'name'})
+    observations = make_observations().rename(columns={'station': 'name'})
+
+    expected = matching.training_set(gauges, observations, scan_times, values, locator, k=4, name_column='name')
+    cube = OrthogonalArray(values)
+    result = matching.training_set(gauges, observations, scan_times, cube, locator, k=4,
+                                   name_column='name', scan_chunk=10)
+
+    assert result['name'].tolist() == ['JFK'] * 3 + ['LGA'] * 3
+    assert numpy.allclose(result['radar'], expected['radar']) and result['scans'].tolist() == [12] * 6
+    # 36 scans in chunks of 10, each only the rows and columns around the two gauges
+    assert [scans for scans, rows, columns in cube.reads] == [10, 10, 10, 6]
+    assert all(rows * columns <= 20 for scans, rows, columns in cube.reads)
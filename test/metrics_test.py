@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+import json
+import threading
+import pytest
+
+from context import nexradpy
+
+from nexradpy import metrics, utils
+
+
+@pytest.fixture
+def enabled(monkeypatch):
+    monkeypatch.setattr(metrics, "ENABLED", True)
+    metrics.reset()
+    yield
+    metrics.reset()
+
+
+def test_stages_nest_and_aggregate(enabled):
+    @metrics.stage('grid')
+    def grid():
+        with metrics.stage('interpolate'):
+            metrics.count('gates_processed', 10)
+
+    for _ in range(3):
+        grid()
+    # another thread starts its own nesting
+    thread = threading.Thread(target=lambda: metrics.stage('interpolate')(lambda: None)())
+    thread.start()
+    thread.join()
+
+    current = metrics.snapshot()
+    assert current['counters'] == {'gates_processed': 30}
+    assert sorted(current['stages']) == ['grid', 'grid/interpolate', 'interpolate']
+    assert current['stages']['grid']['count'] == 3
+    assert sum(current['stages']['grid']['buckets'].values()) == 3
+    assert current['stages']['grid/interpolate']['sum'] <= current['stages']['grid']['sum']
+
+
+def test_exports(enabled, tmp_path):
+    metrics.count('bytes_downloaded', 2048)
+    metrics.observe('download', 0.003)
+    metrics.observe('download', 1000.0)
+
+    assert json.loads(metrics.to_json(str(tmp_path / 'metrics.json'))) == json.loads(
+            (tmp_path / 'metrics.json').read_text())
+
+    text = metrics.to_prometheus(str(tmp_path / 'metrics.prom'))
+    assert (tmp_path / 'metrics.prom').read_text() == text
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['metrics.json', 'metrics.prom']
+    assert 'nexradpy_bytes_downloaded_total 2048\n' in text
+    assert 'nexradpy_stage_seconds_bucket{stage="download",le="0.0025"} 0\n' in text
+    assert 'nexradpy_stage_seconds_bucket{stage="download",le="0.005"} 1\n' in text
+    assert 'nexradpy_stage_seconds_bucket{stage="download",le="300.0"} 1\n' in text
+    assert 'nexradpy_stage_seconds_bucket{stage="download",le="+Inf"} 2\n' in text
+    assert 'nexradpy_stage_seconds_count{stage="download"} 2\n' in text
+
+
+def test_disabled_records_nothing(monkeypatch):
+    monkeypatch.setattr(metrics, "ENABLED", False)
+    metrics.reset()
+
+    @utils.timing
+    def work():
+        metrics.count('files_decoded')
+        return 1
+
+    with metrics.stage('flatten'):
+        assert work() == 1
+    assert metrics.snapshot() == {'counters': {}, 'stages': {}}
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+
+import time
+
+import numpy
+import pytest
+
+from context import nexradpy
+
+pyart = pytest.importorskip("pyart")
+from nexradpy import nexrad
+
+
+INFILE = 'KOKX_SDUS51_N1PKOKX_201407031756'
+
+
+def make_level3():
+    radar = pyart.testing.make_empty_ppi_radar(230, 360, 1)
+    radar.range['data'] = numpy.arange(230) * 1000.0 + 500.0
+    radar.range['meters_between_gates'] = 1000.0
+    radar.azimuth['data'] = numpy.arange(360.0)
+    radar.init_gate_longitude_latitude()
+    data = numpy.ma.masked_array(numpy.arange(360 * 230.0).reshape(360, 230) / 100.0,
+                                 numpy.arange(360 * 230).reshape(360, 230) % 3 == 0)
+    radar.add_field('radar_estimated_rain_rate', {'data': data})
+    return radar
+
+
+def loop_rows(radar, stat):
+    # the per gate loop extract replaces
+    meters_between = int(radar.range['meters_between_gates'])
+    r_s = int(numpy.floor(stat['d_s']/meters_between))
+    r_e = int(numpy.ceil(stat['d_e']/meters_between))
+    rows = []
+    for i in range(len(radar.gate_longitude['data'][stat['a_s']:stat['a_e']])):
+        for j in range(len(radar.gate_longitude['data'][stat['a_s']:stat['a_e']][i][r_s:r_e])):
+            rows.append((i + stat['a_s'], radar.range['data'][r_s:r_e][j],
+                         radar.gate_longitude['data'][stat['a_s']:stat['a_e']][i][r_s:r_e][j],
+                         radar.gate_latitude['data'][stat['a_s']:stat['a_e']][i][r_s:r_e][j],
+                         radar.fields['radar_estimated_rain_rate']['data'][stat['a_s']:stat['a_e']][i][r_s:r_e][j]))
+    return rows
+
+
+def test_extract_matches_loop():
+    radar = make_level3()
+    columns = nexrad.extract(radar, INFILE, nexrad.NYC, 'N1P')
+    rows = loop_rows(radar, nexrad.NYC)
+
+    assert len(columns['name']) == len(rows)
+    assert list(columns['azimuth']) == [row[0] for row in rows]
+    numpy.testing.assert_allclose(columns['dist'], [row[1] for row in rows])
+    numpy.testing.assert_allclose(columns['lon'], [row[2] for row in rows])
+    assert list(numpy.ma.getmaskarray(columns['observation'])) == [row[4] is numpy.ma.masked for row in rows]
+    numpy.testing.assert_allclose(columns['observation'].compressed(),
+                                  [row[4] for row in rows if row[4] is not numpy.ma.masked], rtol=1e-6)
+    assert set(columns['hour']) == {17} and set(columns['minute']) == {56}
+    assert columns['scan_time'][0] == numpy.datetime64('2014-07-03T17:56:00')
+
+
+@pytest.mark.parametrize("fmt", ["parquet", "csv"])
+def test_writer_batches_typed_columns(tmp_path, fmt):
+    pd = pytest.importorskip("pandas")
+    if fmt == "parquet":
+        pytest.importorskip("pyarrow")
+    radar = make_level3()
+    path = str(tmp_path / ('out.' + fmt))
+
+    writer = nexrad.ColumnWriter(path, fmt=fmt, batch_rows=10)
+    for stat in nexrad.STATS:
+        writer.write(nexrad.extract(radar, INFILE, stat, 'N1P'))
+    writer.close()
+
+    frame = pd.read_parquet(path) if fmt == "parquet" else pd.read_csv(path)
+    assert list(frame.columns) == [name for name, dtype in nexrad.COLUMNS]
+    assert len(frame) == writer.rows == sum(len(loop_rows(radar, stat)) for stat in nexrad.STATS)
+    assert list(frame['name'].unique()) == ['NYC', 'LGA', 'JFK']
+    assert frame['observation'].isnull().any()
+    if fmt == "parquet":
+        assert frame['azimuth'].dtype == numpy.int16
+        assert frame['observation'].dtype == numpy.float32
+
+
+def test_files_indexed_once_and_decoded_once(tmp_path, monkeypatch):
+    names = ['KOKX_SDUS51_N1PKOKX_201407031756', 'KOKX_SDUS51_N1PKOKX_201407031700',
+             'KOKX_SDUS51_DAAKOKX_201407031756', 'KOKX_SDUS51_N0VKOKX_201407031756']
+    for i, name in enumerate(names):
+        (tmp_path / str(i)).mkdir()
+        (tmp_path / str(i) / name).write_bytes(b'')
+
+    index = nexrad.index_files(str(tmp_path))
+    assert sorted(index) == ['DAA', 'N1P']
+    assert [timestamp for timestamp, path in index['N1P']] == ['201407031700', '201407031756']
+
+    decoded = []
+    radar = make_level3()
+    monkeypatch.setattr(nexrad, "read_level3", lambda infile, prod: decoded.append(infile) or radar)
+    writer = nexrad.ColumnWriter(str(tmp_path / 'out.csv'), fmt='csv')
+    for timestamp, path in index['N1P']:
+        nexrad.flatten(writer, path, nexrad.STATS, 'N1P')
+    writer.close()
+
+    assert decoded == [path for timestamp, path in index['N1P']]
+    assert writer.rows == 2 * sum(len(loop_rows(radar, stat)) for stat in nexrad.STATS)
+
+
+def fake_read_level3(infile, prod):
+    radar = make_level3()
+    # tell files apart by their observations
+    radar.fields['radar_estimated_rain_rate']['data'] += int(infile[-2:])
+    return radar
+
+
+def slow_or_broken_read_level3(infile, prod):
+    if infile.endswith('00'):
+        raise RuntimeError('corrupt file')
+    time.sleep(0.5)
+    return make_level3()
+
+
+def test_parallel_stops_on_first_failure(tmp_path, monkeypatch):
+    monkeypatch.setattr(nexrad, "read_level3", slow_or_broken_read_level3)
+    tasks = [('KOKX_SDUS51_N1PKOKX_2014070317%02d' % minute, 'N1P') for minute in range(20)]
+    writer = nexrad.ColumnWriter(str(tmp_path / 'out.csv'), fmt='csv')
+
+    started = time.time()
+    with pytest.raises(RuntimeError):
+        nexrad.flatten_parallel(writer, tasks, processes=2, queue_depth=10)
+    # the window behind the failed file is cancelled, extracting it would take 5 s
+    assert time.time() - started < 2.5
+    assert writer.rows == 0
+
+
+@pytest.mark.parametrize("processes", [1, 3])
+def test_parallel_output_in_task_order(tmp_path, monkeypatch, processes):
+    pd = pytest.importorskip("pandas")
+    monkeypatch.setattr(nexrad, "read_level3", fake_read_level3)
+    tasks = [('KOKX_SDUS51_N1PKOKX_2014070317%02d' % minute, 'N1P') for minute in range(20)]
+    path = str(tmp_path / 'out.csv')
+
+    writer = nexrad.ColumnWriter(path, fmt='csv', batch_rows=50)
+    nexrad.flatten_parallel(writer, tasks, processes=processes, queue_depth=1)
+    writer.close()
+
+    frame = pd.read_csv(path)
+    per_file = sum(len(loop_rows(make_level3(), stat)) for stat in nexrad.STATS)
+    assert len(frame) == 20 * per_file
+    assert list(frame['minute']) == [minute for minute in range(20) for row in range(per_file)]
+    assert list(frame['name'][:per_file].unique()) == ['NYC', 'LGA', 'JFK']
+
+
+def test_gauge_windows_from_geometry(tmp_path, monkeypatch):
+    monkeypatch.setattr(nexrad, "_window_cache", {})
+    path = tmp_path / 'gauges.csv'
+    path.write_text('station,lat,lon\nCPK,40.7790,-73.9692\nNORTH,41.5,-72.8638548\n')
+    points = nexrad.gauge_points(str(path), 'KOKX')
+
+    windows = nexrad.gauge_windows(points, 1000)
+    # Central Park lands in the hand made NYC window
+    assert nexrad.NYC['a_s'] < windows[0]['azimuth'] < nexrad.NYC['a_e']
+    assert nexrad.NYC['d_s'] < windows[0]['d_s'] + nexrad.RANGE_BUFFER < nexrad.NYC['d_e']
+    assert windows[0]['r_s'] == int(windows[0]['d_s'] // 1000)
+    # due north
+    assert windows[1]['azimuth'] < nexrad.AZIMUTH_BUFFER or windows[1]['azimuth'] > 360 - nexrad.AZIMUTH_BUFFER
+
+    # the geometry is only done once per station and resolution
+    monkeypatch.setattr(nexrad, "GEOD", None)
+    assert nexrad.gauge_windows(points, 1000) is windows
+
+    radar = make_level3()
+    columns = [nexrad.extract(radar, INFILE, stat, 'N1P') for stat in nexrad.resolve_stats(radar, points)]
+    assert set(columns[0]['name']) == {'CPK'}
+    # the north window wraps around azimuth 0
+    assert 0 in columns[1]['azimuth'] and 359 in columns[1]['azimuth']
+
+
+def test_gauge_rays_follow_radar_azimuths(tmp_path, monkeypatch):
+    monkeypatch.setattr(nexrad, "_window_cache", {})
+    path = tmp_path / 'gauges.csv'
+    path.write_text('station,lat,lon\nCPK,40.7790,-73.9692\nNORTH,41.5,-72.8638548\n')
+    points = nexrad.gauge_points(str(path), 'KOKX')
+
+    # a scan that starts at 137.5 degrees, ray index and azimuth don't line up
+    radar = make_level3()
+    radar.azimuth['data'] = (numpy.arange(360.0) + 137.5) % 360
+    radar.latitude['data'] = numpy.array([40.8655093])
+    radar.longitude['data'] = numpy.array([-72.8638548])
+    radar.init_gate_longitude_latitude()
+
+    for window in nexrad.resolve_stats(radar, points):
+        azimuths = radar.azimuth['data'][window['rays']]
+        difference = (azimuths - window['azimuth'] + 180) % 360 - 180
+        assert len(window['rays']) >= 2 and numpy.all(numpy.abs(difference) <= nexrad.AZIMUTH_BUFFER)
+
+    # the gates extracted for Central Park surround the gauge and carry their rays' azimuths
+    window = nexrad.resolve_stats(radar, points)[0]
+    columns = nexrad.extract(radar, INFILE, window, 'N1P')
+    assert sorted(set(columns['azimuth'])) == sorted(set(numpy.round(radar.azimuth['data'][window['rays']]).astype(int)))
+    assert numpy.all(numpy.abs(columns['azimuth'] - window['azimuth']) <= nexrad.AZIMUTH_BUFFER + 0.5)
+    assert abs(columns['lat'].mean() - 40.7790) < 0.02 and abs(columns['lon'].mean() + 73.9692) < 0.02
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+
+import datetime
+import gzip
+import threading
+import time
+
+import pytest
+
+from context import nexradpy
+from fake_s3 import FakeBucket, SlowFlakyBucket
+from nexradpy.catalog import S3ListingCatalog
+from nexradpy import s3_nexrad_search
+
+
+KEYS = {
+    "2015/05/05/KOKX/KOKX20150505_050626_V06.gz": b"first",
+    "2015/05/05/KOKX/KOKX20150505_055459_V06.gz": b"second",
+}
+
+
+def test_download_workers_reuse_bucket(tmp_path):
+    connections = []
+
+    def bucket_factory():
+        connections.append(threading.current_thread())
+        return FakeBucket(KEYS)
+
+    nexrad = s3_nexrad_search.S3NEXRADHelper(verbose=False, threads=2, bucket_factory=bucket_factory)
+    try:
+        for i in range(3):
+            file_paths = nexrad.downloadNEXRADFiles(str(tmp_path), sorted(KEYS))
+        completed = list(nexrad.iterDownloadNEXRADFiles(str(tmp_path), sorted(KEYS) + ["2015/05/05/KOKX/missing"]))
+    finally:
+        nexrad.close()
+
+    assert [open(path, 'rb').read() for path in file_paths] == [b"first", b"second"]
+    assert sorted(downloaded for key, path, downloaded in completed) == [False, True, True]
+    # one connection for searching plus at most one per worker
+    assert len(connections) <= 3
+
+
+def test_repeat_search_uses_catalog():
+    bucket = FakeBucket(KEYS)
+    nexrad = s3_nexrad_search.S3NEXRADHelper(verbose=False, bucket_factory=lambda: bucket,
+            catalog=S3ListingCatalog(':memory:'))
+    start = datetime.datetime(2015, 5, 4, 12)
+    end = datetime.datetime(2015, 5, 5, 5, 30)
+
+    cold = nexrad.searchNEXRADS3(start, end, ["KOKX"])
+    list_calls = bucket.list_calls
+    warm = nexrad.searchNEXRADS3(start, end, ["KOKX"])
+
+    assert cold == warm == ["2015/05/05/KOKX/KOKX20150505_050626_V06.gz"]
+    assert list_calls == 2
+    assert bucket.list_calls == list_calls
+
+
+def test_new_helper_on_warm_catalog(tmp_path):
+    path = str(tmp_path / 'listings.sqlite')
+    start = datetime.datetime(2015, 5, 4, 12)
+    end = datetime.datetime(2015, 5, 5, 5, 30)
+    cold = s3_nexrad_search.S3NEXRADHelper(verbose=False, bucket_factory=lambda: FakeBucket(KEYS),
+            catalog=S3ListingCatalog(path))
+    try:
+        files = cold.searchNEXRADS3(start, end, ["KOKX"])
+    finally:
+        cold.close()
+
+    # a later run opens the catalog again and never lists the bucket
+    bucket = FakeBucket(KEYS)
+    warm = s3_nexrad_search.S3NEXRADHelper(verbose=False, bucket_factory=lambda: bucket,
+            catalog=S3ListingCatalog(path))
+    try:
+        assert warm.searchNEXRADS3(start, end, ["KOKX"]) == files
+    finally:
+        warm.close()
+    assert bucket.list_calls == 0
+
+
+def test_concurrent_listing_with_retries(monkeypatch):
+    monkeypatch.setattr(s3_nexrad_search, "LIST_BACKOFF", 0)
+    keys = {"2015/05/%02d/%s/%s201505%02d_000000_V06.gz" % (day, station, station, day): b""
+            for day in range(1, 17) for station in ["KOKX", "KDIX"]}
+    nexrad = s3_nexrad_search.S3NEXRADHelper(verbose=False, list_concurrency=8,
+            bucket_factory=lambda: SlowFlakyBucket(keys, latency=0.05, failures=1))
+    try:
+        started = time.time()
+        files = nexrad.searchNEXRADS3(datetime.datetime(2015, 4, 30, 12), datetime.datetime(2015, 5, 17), ["KOKX", "KDIX"])
+        elapsed = time.time() - started
+    finally:
+        nexrad.close()
+
+    # 34 prefixes at 50 ms each would take 1.7 s in series
+    assert elapsed < 0.8
+    assert files == sorted(keys, key=lambda name: (name[20:35], name))
+
+
+def test_download_skips_complete_and_resumes_partial(tmp_path):
+    keys = {"2015/05/05/KOKX/KOKX20150505_050626_V06.gz": b"0123456789"}
+    bucket = FakeBucket(keys)
+    nexrad = s3_nexrad_search.S3NEXRADHelper(verbose=False, bucket_factory=lambda: bucket)
+    file_path = tmp_path / "KOKX20150505_050626_V06.gz"
+    try:
+        # interrupted transfer left the first 4 bytes behind
+        (tmp_path / ("KOKX20150505_050626_V06.gz" + s3_nexrad_search.PARTIAL_SUFFIX)).write_bytes(b"0123")
+        nexrad.downloadNEXRADFiles(str(tmp_path), sorted(keys), verify=True)
+        assert file_path.read_bytes() == b"0123456789"
+        assert bucket.bytes_sent == 6
+
+        nexrad.downloadNEXRADFiles(str(tmp_path), sorted(keys), verify=True)
+        assert bucket.bytes_sent == 6
+
+        # a corrupt copy of the right size is only caught by verify
+        file_path.write_bytes(b"9876543210")
+        nexrad.downloadNEXRADFiles(str(tmp_path), sorted(keys))
+        assert file_path.read_bytes() == b"9876543210"
+        nexrad.downloadNEXRADFiles(str(tmp_path), sorted(keys), verify=True)
+        assert file_path.read_bytes() == b"0123456789"
+    finally:
+        nexrad.close()
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["KOKX20150505_050626_V06.gz"]
+
+
+def test_in_memory_volumes(tmp_path, monkeypatch):
+    pyart = pytest.importorskip("pyart")
+    monkeypatch.setattr(pyart.io, "read_nexrad_archive", lambda fileobj: fileobj.read())
+    keys = {"2015/05/05/KOKX/KOKX20150505_050626_V06.gz": gzip.compress(b"AR2V0006.volume")}
+    nexrad = s3_nexrad_search.S3NEXRADHelper(verbose=False, bucket_factory=lambda: FakeBucket(keys))
+    try:
+        volumes = list(nexrad.iterNEXRADVolumes(sorted(keys)))
+        assert list(tmp_path.iterdir()) == []
+        buffers = list(nexrad.iterNEXRADBuffers(sorted(keys), download_dir=str(tmp_path)))
+    finally:
+        nexrad.close()
+
+    assert volumes == [("2015/05/05/KOKX/KOKX20150505_050626_V06.gz", b"AR2V0006.volume")]
+    assert buffers[0][1].getvalue() == (tmp_path / "KOKX20150505_050626_V06.gz").read_bytes()
+
+
+def test_slow_consumer_bounds_fetched_volumes():
+    keys = {"2015/05/05/KOKX/KOKX20150505_%02d0000_V06.gz" % hour: b"x" * 1000 for hour in range(24)}
+    bucket = FakeBucket(keys)
+    nexrad = s3_nexrad_search.S3NEXRADHelper(verbose=False, threads=2, bucket_factory=lambda: bucket)
+    try:
+        fetched = []
+        for key, buffer in nexrad.iterNEXRADBuffers(sorted(keys)):
+            time.sleep(0.02)
+            fetched.append(bucket.bytes_sent - 1000 * len(fetched))
+    finally:
+        nexrad.close()
+
+    # bytes fetched ahead of the consumer stay within the in flight window of 2 workers
+    assert len(fetched) == 24
+    assert max(fetched) <= 1000 * s3_nexrad_search.IN_FLIGHT_PER_WORKER * 2
+
+
+def test_short_window_lists_from_window_start():
+    keys = {"2015/05/05/KOKX/KOKX20150505_%02d%02d00_V06.gz" % (hour, minute): b""
+            for hour in range(24) for minute in range(0, 60, 5)}
+    keys["2015/05/05/KOKX/KOKX20150505_050000_MDM"] = b""
+    bucket = FakeBucket(keys)
+    nexrad = s3_nexrad_search.S3NEXRADHelper(verbose=False, bucket_factory=lambda: bucket)
+    try:
+        files = nexrad.searchNEXRADS3(datetime.datetime(2015, 5, 5, 5, 0), datetime.datetime(2015, 5, 5, 5, 20), ["KOKX"])
+    finally:
+        nexrad.close()
+
+    assert files == ["2015/05/05/KOKX/KOKX20150505_05%02d00_V06.gz" % minute for minute in (5, 10, 15)]
+    assert bucket.markers == ["2015/05/05/KOKX/KOKX20150505_050000"]
+
+
+def test_key_index_time_window():
+    key_index = s3_nexrad_search.NEXRADKeyIndex([
+        "2015/05/05/KDIX/KDIX20150505_050100_V06.gz",
+        "2015/05/05/KOKX/KOKX20150505_050626_V06.gz",
+        "2015/05/05/KOKX/KOKX20150505_050000_V06.gz",
+        "2015/05/05/KOKX/KOKX20150505_055459_V06.gz",
+        "2015/05/05/KOKX/KOKX20150505_055459_V06_MDM"])
+
+    assert key_index.keysBetween(datetime.datetime(2015, 5, 5, 5), datetime.datetime(2015, 5, 5, 5, 54, 59), ["KOKX", "KDIX"]) == [
+        "2015/05/05/KDIX/KDIX20150505_050100_V06.gz",
+        "2015/05/05/KOKX/KOKX20150505_050626_V06.gz"]
+    assert key_index.keysBetween(datetime.datetime(2015, 5, 5, 5), datetime.datetime(2015, 5, 5, 5, 54, 59, 1), ["KOKX"])[-1] == \
+        "2015/05/05/KOKX/KOKX20150505_055459_V06.gz"
+
+
+def test_batch_queries_share_listings():
+    keys = {"2015/05/%02d/%s/%s201505%02d_%02d0000_V06.gz" % (day, station, station, day, hour): b""
+            for day in (4, 5, 6) for hour in range(24) for station in ["KOKX", "KDIX"]}
+    bucket = FakeBucket(keys)
+    nexrad = s3_nexrad_search.S3NEXRADHelper(verbose=False, bucket_factory=lambda: bucket)
+    nyc = (40.901954, -73.632802, 40.460969, -74.363177, 20000)
+    queries = [
+        (datetime.datetime(2015, 5, 5, 4, 30), datetime.datetime(2015, 5, 5, 6, 30)) + nyc,
+        (datetime.datetime(2015, 5, 5, 5, 30), datetime.datetime(2015, 5, 6, 1, 30)) + nyc,
+        (datetime.datetime(2015, 5, 4, 22, 30), datetime.datetime(2015, 5, 5, 2, 30)) + nyc,
+    ]
+    try:
+        files = nexrad.findNEXRADKeysForQueries(queries)
+        assert bucket.list_calls == 6
+        for query, query_files in zip(queries, files):
+            assert query_files == nexrad.findNEXRADKeysByTimeAndDomain(*query)
+    finally:
+        nexrad.close()
+
+    assert files[0] == ["2015/05/05/%s/%s20150505_%02d0000_V06.gz" % (station, station, hour)
+            for hour in (5, 6) for station in ["KDIX", "KOKX"]]
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+
+import numpy
+
+from context import nexradpy
+from nexradpy import stations
+
+
+# NYC domain used in s3_nexrad_search.main()
+NYC_DOMAIN = (40.901954, -73.632802, 40.460969, -74.363177)
+
+
+def test_distance_inside_domain_is_zero():
+    # Long Island, around KOKX
+    distances = stations.distanceToDomain(41.0, -72.5, 40.6, -73.2)
+    assert distances[stations.STATION_IDS.index('KOKX')] == 0
+
+
+def test_distance_off_corner():
+    # KDIX sits south west of the domain, ~57 km from its south west corner
+    distances = stations.distanceToDomain(*NYC_DOMAIN)
+    assert 55000 < distances[stations.STATION_IDS.index('KDIX')] < 60000
+
+
+def test_stations_in_domain():
+    radii = numpy.full(len(stations.STATION_IDS), 100000.0)
+    assert stations.stationsInDomain(*NYC_DOMAIN, radii) == ['KOKX', 'KDIX']
+
+    radii[stations.STATION_IDS.index('KDIX')] = numpy.nan
+    assert stations.stationsInDomain(*NYC_DOMAIN, radii) == ['KOKX']
+
+
+def test_beam_radius_unavailable_heights():
+    radii = stations.beamRadiusAtHeight([100, 500, 85000, 95000], 200)
+    assert numpy.isnan(radii[0])
+    assert radii[1] > 0
+    assert numpy.isnan(radii[2])
+    assert numpy.isnan(radii[3])
+
+
+def test_beam_radius_lowest_beam_at_max_distance():
+    # lowest beam leaves its 230 km range ~6.2 km above a sea level radar, where the
+    # ground radius peaks at WSR88D_MAX_RADIUS=229819.074224 (trianglesolver)
+    heights = numpy.linspace(6000, 6400, 401)
+    assert abs(numpy.nanmax(stations.beamRadiusAtHeight(heights, 0)) - 229819.074224) < 1
+
+
+def test_radius_table_matches_closed_form():
+    for height in [0, 50, 1000, 2000, 6100, 6200, 20000, 79000, 81000, 90000]:
+        tabulated = stations.stationRadiiAtHeight(height)
+        exact = stations.beamRadiusAtHeight(height, stations.STATION_ELEVATIONS)
+        available = ~numpy.isnan(exact)
+        assert numpy.array_equal(~numpy.isnan(tabulated), available)
+        assert numpy.all(numpy.abs(tabulated - exact)[available] < 10)